@@ -10,7 +10,7 @@ Description:
     each ability as a JSON file which gets loaded into this class. This could be written more effectively.
 """
 
-import numpy as np
+import random
 from Environment.Effects import EffectFactory
 
 class Ability(object):
@@ -35,7 +35,7 @@ class Ability(object):
         :param adrenaline_increase: The adrenaline that this ability will provide when cast.
         :param adrenaline_threshold: The adrenaline threshold that must be met before this ability can be cast.
         :param cast_time_ticks: The number of ticks this ability must wait before its damage is applied after it is cast.
-        :param max_targets: The maximum number of targets this ability can apply to in a single cast (CURRENTLY NOT IMPLEMENTED)
+        :param max_targets: The maximum number of targets this ability can apply to in a single cast. See apply_damage_to().
         :param stun_damage_modifier: A scalar damage multiplier to be applied to this ability's damage if the target is
                                      stunned when this ability is cast.
         :param applies_hit: A flag to determine whether this ability should trigger on-hit effects on the entity it is cast on.
@@ -57,7 +57,11 @@ class Ability(object):
         self.cast_timer = 1
         self.cooldown_timer = self.cooldown_ticks
         self.damage_this_tick = 0
+        self.expected_damage_this_tick = 0
         self.ignores_damage_mod = True
+
+        # Optional RollSource to draw damage rolls from. See RollSource.py.
+        self.roll_source = None
         self.casting = False
 
         self.average_damage = 0
@@ -66,24 +70,36 @@ class Ability(object):
     def apply_damage_to(self, target):
         """
         Function to apply this ability's damage to a target, and update this ability's internal average damage tracker.
+        If the target stands in for a group of enemies, the damage is dealt once to every one of them this ability can
+        reach.
         :param target: Target to apply damage to. Must implement the apply_damage(scalar) function.
         :return: None.
         """
-        target.apply_damage(self.damage_this_tick)
+        num_hits = min(self.max_targets, target.num_targets)
+        target.apply_damage(self.damage_this_tick * num_hits, self.expected_damage_this_tick * num_hits)
         self.average_damage += self.damage_this_tick
         self.num_casts += 1
 
     def compute_damage_this_tick(self):
         """
-        Function to compute the damage that this ability will do when it is next applied.
+        Function to compute the damage that this ability will do when it is next applied. The damage this ability would
+        do on average is computed alongside it.
         :return: None
         """
 
         if type(self.damage_range) not in (float, int):
-            # I am assuming that Runescape uses uniform sampling, but I have no idea.
-            self.damage_this_tick = np.random.uniform(*self.damage_range)
+            low, high = self.damage_range
+            self.expected_damage_this_tick = (low + high) / 2
+
+            # I am assuming that Runescape uses uniform sampling, but I have no idea. This uses the standard library RNG
+            # rather than numpy so that the simulator can be imported without paying for a numpy import.
+            if self.roll_source is None:
+                self.damage_this_tick = random.uniform(low, high)
+            else:
+                self.damage_this_tick = low + (high - low)*self.roll_source.next_roll()
         else:
             self.damage_this_tick = self.damage_range
+            self.expected_damage_this_tick = self.damage_range
 
     def apply_damage_modifier(self, modifier):
         """
@@ -93,6 +109,7 @@ class Ability(object):
         """
         if not self.ignores_damage_mod:
             self.damage_this_tick *= modifier
+            self.expected_damage_this_tick *= modifier
 
     def tick_timers(self):
         """
@@ -0,0 +1,180 @@
+"""
+File name: AbilityBundle.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This compiles every ability JSON file in one of the ability folders into a single bundle file, so loading a player
+    only has to open and parse one file instead of one per ability. The bundle remembers the modification time and size
+    of every file it was built from, and is rebuilt automatically whenever any of them change. Abilities are always
+    stored in file name order, so the index of an ability is the same in every process and on every run.
+
+    The bundle also holds a content hash of every ability's stats, which is stored alongside evaluation results so we
+    can tell exactly which results a data change has made stale. Each hash has two parts, "timing:damage". The timing
+    part covers everything that decides when an ability can be cast, and the damage part covers everything else.
+"""
+
+import hashlib
+import json
+import os
+
+ABILITY_PATH = os.path.join("resources", "json_data", "abilities")
+BUNDLE_PATH = os.path.join("resources", "compiled")
+
+# Bump this whenever the layout of a bundle changes, so old bundles get recompiled.
+BUNDLE_VERSION = 2
+
+# The stats which decide when an ability can be cast, as opposed to how much damage it does when it is.
+TIMING_KEYS = ("cooldown ticks", "adrenaline cost", "adrenaline increase", "adrenaline threshold", "cast time ticks")
+
+# Bundles that have already been loaded by this process, keyed by ability folder.
+_loaded_bundles = {}
+
+
+def get_bundle_path(ability_folder):
+    return os.path.join(BUNDLE_PATH, "{}.json".format(ability_folder))
+
+
+def _scan_sources(ability_folder):
+    """
+    Function to find every ability JSON file in a folder, along with enough information to tell if it has changed.
+    :param ability_folder: The name of the folder inside the ability path to scan.
+    :return: A dict mapping each file name to a [modification time, size] pair.
+    """
+    base_path = os.path.join(ABILITY_PATH, ability_folder)
+    sources = {}
+    for entry in os.scandir(base_path):
+        if entry.name.endswith(".json"):
+            stat = entry.stat()
+            sources[entry.name] = [stat.st_mtime_ns, stat.st_size]
+
+    return sources
+
+
+def _stable_hash(data):
+    text = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+
+
+def hash_ability(json_data):
+    """
+    Function to compute the content hash of an ability's stats.
+    :param json_data: The ability's JSON data.
+    :return: A "timing:damage" hash string.
+    """
+    timing = {key: json_data[key] for key in TIMING_KEYS}
+    damage = {key: value for key, value in json_data.items() if key not in TIMING_KEYS}
+    return "{}:{}".format(_stable_hash(timing), _stable_hash(damage))
+
+
+def compile_abilities(ability_folder="ranged"):
+    """
+    Function to compile every ability in a folder into a bundle and write it to disk.
+    :param ability_folder: The name of the folder inside the ability path to compile.
+    :return: The compiled bundle.
+    """
+    base_path = os.path.join(ABILITY_PATH, ability_folder)
+    sources = _scan_sources(ability_folder)
+    auto_attack = None
+    abilities = []
+
+    for file_name in sorted(sources.keys()):
+        with open(os.path.join(base_path, file_name), 'r') as f:
+            json_data = json.load(f)
+
+        # The auto-attack is kept separately from the rest of the abilities. See Player.py for why.
+        if "AutoAttack" in file_name:
+            auto_attack = json_data
+        else:
+            abilities.append(json_data)
+
+    hashes = {ability["name"]: hash_ability(ability) for ability in abilities + [auto_attack]}
+
+    bundle = {"version": BUNDLE_VERSION,
+              "ability_folder": ability_folder,
+              "sources": sources,
+              "hashes": hashes,
+              "auto_attack": auto_attack,
+              "abilities": abilities}
+
+    os.makedirs(BUNDLE_PATH, exist_ok=True)
+    path = get_bundle_path(ability_folder)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(bundle, f)
+    os.replace(tmp_path, path)
+
+    _loaded_bundles[ability_folder] = bundle
+    return bundle
+
+
+def load_bundle(ability_folder="ranged"):
+    """
+    Function to load the compiled bundle for an ability folder, compiling it first if it is missing or out of date.
+    :param ability_folder: The name of the folder inside the ability path to load.
+    :return: A dict containing the auto-attack JSON under "auto_attack", and a list of every other ability's JSON under
+             "abilities".
+    """
+    bundle = _loaded_bundles.get(ability_folder)
+    sources = _scan_sources(ability_folder)
+
+    if bundle is None:
+        path = get_bundle_path(ability_folder)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                bundle = json.load(f)
+
+    if bundle is None or bundle.get("version") != BUNDLE_VERSION or bundle["sources"] != sources:
+        return compile_abilities(ability_folder)
+
+    _loaded_bundles[ability_folder] = bundle
+    return bundle
+
+
+def get_ability_names(ability_folder="ranged"):
+    """
+    Function to get the names of every ability in a folder, in the order the player will index them.
+    :param ability_folder: The name of the folder inside the ability path to look at.
+    :return: A list of ability names.
+    """
+    return [ability["name"] for ability in load_bundle(ability_folder)["abilities"]]
+
+
+def get_ability_hashes(ability_folder="ranged"):
+    """
+    Function to get the content hash of every ability in a folder, including the auto-attack.
+    :param ability_folder: The name of the folder inside the ability path to look at.
+    :return: A dict mapping ability names to hash strings.
+    """
+    return load_bundle(ability_folder)["hashes"]
+
+
+def get_data_hash(ability_folder="ranged"):
+    """
+    Function to get one hash covering the stats of every ability in a folder, which changes whenever any of them do.
+    :param ability_folder: The name of the folder inside the ability path to look at.
+    :return: A hash string.
+    """
+    return _stable_hash(get_ability_hashes(ability_folder))
+
+
+def find_stale_abilities(old_hashes, new_hashes, casts):
+    """
+    Function to decide which abilities have changed in a way that could change a recorded result. An ability whose
+    damage changed only matters if it was actually cast. An ability whose timing changed matters either way, because
+    that could decide whether it gets cast at all.
+    :param old_hashes: Hashes of the abilities at the time the result was recorded.
+    :param new_hashes: Current hashes of the abilities.
+    :param casts: Dict mapping ability names to the number of times they were cast when the result was recorded.
+    :return: A list of the names of every ability that makes the result stale.
+    """
+    stale = []
+    for name, old_hash in old_hashes.items():
+        new_hash = new_hashes.get(name)
+        if new_hash == old_hash:
+            continue
+
+        if new_hash is None or casts.get(name, 0) > 0 or new_hash.split(":")[0] != old_hash.split(":")[0]:
+            stale.append(name)
+
+    return stale
@@ -0,0 +1,70 @@
+"""
+File name: RollSource.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    A RollSource hands out the uniform random numbers that abilities use to roll their damage. By default abilities just
+    call the random module themselves, but when one of these is attached to them every roll goes through it instead.
+    That lets the evaluator record the rolls made during one fight and play them back in a controlled way during the
+    next, which is what makes antithetic sampling possible. It can also be told to always return 0.5, which makes every
+    ability deal exactly its mean damage.
+"""
+
+import random
+
+
+class RollSource(object):
+    RECORD = "record"
+    ANTITHETIC = "antithetic"
+    MEAN = "mean"
+
+    def __init__(self):
+        self.mode = RollSource.RECORD
+        self.rolls = []
+        self.position = 0
+
+    def record(self):
+        """
+        Function to start recording a fresh sequence of rolls.
+        :return: None
+        """
+        self.mode = RollSource.RECORD
+        self.rolls = []
+        self.position = 0
+
+    def replay_antithetic(self):
+        """
+        Function to start replaying the last recorded sequence of rolls, mirrored. Every roll u that was recorded is
+        played back as 1-u, in the same order.
+        :return: None
+        """
+        self.mode = RollSource.ANTITHETIC
+        self.position = 0
+
+    def use_mean(self):
+        """
+        Function to make every roll land exactly in the middle of the damage range.
+        :return: None
+        """
+        self.mode = RollSource.MEAN
+
+    def next_roll(self):
+        """
+        Function to get the next roll.
+        :return: A float in [0, 1).
+        """
+        if self.mode == RollSource.MEAN:
+            return 0.5
+
+        if self.mode == RollSource.ANTITHETIC and self.position < len(self.rolls):
+            u = 1 - self.rolls[self.position]
+            self.position += 1
+            return u
+
+        # If a replayed fight somehow asks for more rolls than were recorded, we just fall back to fresh ones.
+        u = random.random()
+        if self.mode == RollSource.RECORD:
+            self.rolls.append(u)
+
+        return u
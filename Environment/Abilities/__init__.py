@@ -1 +1,2 @@
-from .Ability import Ability
\ No newline at end of file
+from .Ability import Ability
+from .RollSource import RollSource
\ No newline at end of file
@@ -19,12 +19,24 @@ class CombatSimulator(object):
 
         self.player = player
         self.target = target
+        player.target = target
         self.current_ability = player.get_next_ability()
 
+        # If this is set to a list, the name of every ability will be appended to it as its cast completes.
+        self.cast_log = None
+
+        # Number of ticks the most recent simulation actually ran for, and the tick currently being simulated.
+        self.ticks_simulated = 0
+        self.current_tick = 0
+
+        # If this is set to a TraceRecorder, every completed cast will be recorded in it. See TraceRecorder.py.
+        self.trace = None
+
     def simulate(self, num_ticks):
         """
-        Function to simulate combat for some number of ticks.
-        :param num_ticks: Number of ticks to run the simulation for.
+        Function to simulate combat for some number of ticks. If the target has a health pool, the simulation stops on
+        the tick it dies. The number of ticks actually simulated is stored in self.ticks_simulated.
+        :param num_ticks: Maximum number of ticks to run the simulation for.
         :return: The cumulative damage taken by the target during this simulation.
         """
         #print()
@@ -33,15 +45,24 @@ class CombatSimulator(object):
         self.target.reset()
         self.player.reset()
         self.current_ability = self.player.get_next_ability()
+        self.current_tick = 0
+        if self.trace is not None:
+            self.trace.start_fight()
 
         # Simulate.
+        self.ticks_simulated = 0
         for i in range(num_ticks):
             self.tick()
+            self.ticks_simulated += 1
+
+            if self.target.is_dead():
+                break
 
         # Return.
         return self.target.damage_taken
 
     def tick(self):
+        self.current_tick += 1
         self.target.tick()
         self.player.tick()
         self.handle_current_ability()
@@ -61,13 +82,21 @@ class CombatSimulator(object):
             ability.compute_damage_this_tick()
             ability.apply_damage_modifier(self.player.get_current_damage_modifier())
 
-            if self.target.is_stunned():
+            stunned = self.target.is_stunned()
+            if stunned:
                 #print("APPLYING STUN MOD {} TO {}".format(ability.get_stun_damage_modifier(), ability))
                 ability.apply_damage_modifier(ability.get_stun_damage_modifier())
 
+            damage_before = self.target.damage_taken
             self.player.apply_ability(ability, friendly=True)
             self.target.apply_ability(ability, friendly=False)
 
+            if self.cast_log is not None:
+                self.cast_log.append(ability.name)
+
+            if self.trace is not None:
+                self._record_cast(ability, self.target.damage_taken - damage_before, stunned)
+
             ability.start_cooldown()
             self.current_ability = self.player.get_next_ability()
 
@@ -84,4 +113,21 @@ class CombatSimulator(object):
         #     print(ability.cast_timer, ability.cast_time_ticks, ability.cooldown_ticks, ability.cooldown_timer)
 
 
-        #print(self.target)
\ No newline at end of file
+        #print(self.target)
+
+    def _record_cast(self, ability, damage, stunned):
+        """
+        Function to record a completed cast in the trace.
+        :param ability: The ability that was cast.
+        :param damage: Damage the target took from the cast.
+        :param stunned: Whether the target was stunned when the cast completed.
+        :return: None
+        """
+        modifier = 1
+        if not ability.ignores_damage_mod:
+            modifier = self.player.get_current_damage_modifier()
+            if stunned:
+                modifier *= ability.get_stun_damage_modifier()
+
+        modifier *= self.target.get_damage_modifier()
+        self.trace.record(self.current_tick, ability, damage, modifier, stunned, self.player.adrenaline)
\ No newline at end of file
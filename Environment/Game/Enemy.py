@@ -12,14 +12,23 @@ Description:
 """
 
 class Enemy(object):
-    def __init__(self):
+    def __init__(self, hp=None, stun_immune=False, num_targets=1):
         """
         Just a basic constructor.
+        :param hp: Optional amount of health this enemy has. An enemy with no health pool never dies.
+        :param stun_immune: Whether this enemy ignores stuns.
+        :param num_targets: Number of identical targets this enemy stands in for. Abilities that can hit several targets
+                            deal their damage to as many of these as they can reach, and hp is the health of the whole
+                            group.
         """
+        self.hp = hp
+        self.stun_immune = stun_immune
+        self.num_targets = num_targets
         self.debuffs = []
         self.buffs = []
         self.damage_modifier = 1
         self.damage_taken = 0
+        self.expected_damage_taken = 0
         self.stunned = False
 
     def tick(self):
@@ -87,6 +96,7 @@ class Enemy(object):
         self.buffs = []
         self.damage_modifier = 1
         self.damage_taken = 0
+        self.expected_damage_taken = 0
         self.stunned = False
 
     def _handle_effect_timeout(self, effect, effect_list):
@@ -126,8 +136,14 @@ class Enemy(object):
 
         return out
 
-    def apply_damage(self, damage):
+    def apply_damage(self, damage, expected_damage=0):
+        # The damage we would have taken if every ability rolled its mean is tracked too. The evaluator uses it as a
+        # control variate.
         self.damage_taken += damage * self.damage_modifier
+        self.expected_damage_taken += expected_damage * self.damage_modifier
+
+    def is_dead(self):
+        return self.hp is not None and self.damage_taken >= self.hp
 
     def apply_buff(self, effect):
         self.buffs.append(effect)
@@ -142,7 +158,8 @@ class Enemy(object):
         self.damage_modifier = value
 
     def set_stunned(self, state):
-        self.stunned = state
+        if not self.stun_immune:
+            self.stunned = state
 
     def is_stunned(self):
         return self.stunned
\ No newline at end of file
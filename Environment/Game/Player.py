@@ -10,9 +10,8 @@ Description:
 
 """
 
-from Environment.Abilities import Ability
-import json
-import os
+from Environment.Abilities import Ability, AbilityBundle
+from Environment.Game.RotationPolicy import RotationPolicy, encode_name
 
 class Player(object):
     def __init__(self, attack_delay):
@@ -32,6 +31,14 @@ class Player(object):
         self.attack_delay = attack_delay
         self.rotation = []
 
+        # If this is set to a compiled RotationPolicy, it is used instead of the rotation to pick abilities. Its rules
+        # depend on whether the target is stunned, which is why we need the target too. The simulator sets that.
+        self.policy = None
+        self.target = None
+
+        # A player is always a single target.
+        self.num_targets = 1
+
         # Note that we store the auto attack as its own variable. This is because it has a cooldown of 0, and is the default
         # action to be taken at every tick if nothing else is available. When re-arranging rotations, we do not want the
         # position of the auto attack to change.
@@ -67,7 +74,11 @@ class Player(object):
         # Note here that we're not actually indexing our abilities directly, we have a list of integers called self.rotation
         # and we use the entries in that list to pull out an ability. This allows us to easily modify the rotation being
         # used by this player by simply changing the values in self.rotation instead of re-ordering our ability list.
-        for idx in self.rotation:
+        rotation = self.rotation
+        if self.policy is not None:
+            rotation = self.policy.lookup(self.target.is_stunned(), self.adrenaline, len(self.buffs) > 0)
+
+        for idx in rotation:
             ab = self.abilities[idx]
             if ab.can_cast(self.adrenaline):
                 ability = ab
@@ -119,41 +130,24 @@ class Player(object):
 
     def load_all_abilities(self, ability_folder="ranged"):
         """
-        Helper function to load all this player's abilities from a bunch of json files stored in the base_path folder.
-        This expects the resources/json_data/abilties/ranged folder to exist and contain a bunch of JSON files describing
-        abilities.
+        Helper function to load all this player's abilities from the compiled bundle of JSON files stored in the
+        resources/json_data/abilities/<ability_folder> folder. The bundle is rebuilt automatically if any of those files
+        have changed since it was last compiled. See AbilityBundle.py.
         :param ability_folder: The name of the folder inside the base path to load abilities from. Eventually, there will
                                be more than just the ranged abilities folder inside the base path.
         :return: None
         """
 
-        base_path = os.path.join("resources", "json_data", "abilities", ability_folder)
-        aa = None
-        abilities = []
-
-        # Load all JSON files located in the requested path.
-        for ability_name in os.listdir(base_path):
-            if '.json' not in ability_name:
-                continue
-
-            full_path = os.path.join(base_path, ability_name)
-            json_data = json.load(open(full_path, 'r'))
-
-            # Save the auto-attack for later. We will load this separately.
-            if "AutoAttack" in ability_name:
-                aa = json_data
-                continue
-
-            abilities.append(json_data)
+        bundle = AbilityBundle.load_bundle(ability_folder)
 
         #Load the auto-attack and assign it to our local variable.
         ability = Ability()
-        ability.load_from_json(aa)
+        ability.load_from_json(bundle["auto_attack"])
         ability.cast_time_ticks += self.attack_delay
         self.auto_attack = ability
 
         #Load all the other abilities into objects.
-        self.load_abilities_from_json(abilities)
+        self.load_abilities_from_json(bundle["abilities"])
 
     def load_abilities_from_json(self, ability_jsons):
         """
@@ -173,23 +167,54 @@ class Player(object):
             self.abilities.append(ability)
             #print("Loaded ability {}".format(ability))
 
-        # This is here to pre-organize a rotation so I can test it on its own after the optimizer has found something.
         # During optimization, the order of the player's rotation at this stage doesn't matter, so the rotation can be
-        # put in any order we like.
-        self.preload_rotation()
-        #self.rotation = [i for i in range(len(self.abilities))]
+        # put in any order we like. Call preload_rotation() to test a specific rotation on its own.
+        self.rotation = [i for i in range(len(self.abilities))]
+
+    def preload_rotation(self, rotation=None):
+        """
+        Function to set this player's rotation from a list of ability names. This is here to pre-organize a rotation so
+        I can test it on its own after the optimizer has found something.
+        :param rotation: List of ability names, in priority order. Defaults to the best rotation I have found so far.
+        :return: The rotation as a list of ability indices.
+        """
+        if rotation is None:
+            rotation = ['Needle Strike', 'Piercing Shot', 'Snap Shot', 'Fragmentation Shot', 'Binding Shot', 'Bombardment', 'Tight Bindings', "Death's Swiftness", 'Corruption Shot']
 
-    def preload_rotation(self):
-        rotation = ['Needle Strike', 'Piercing Shot', 'Snap Shot', 'Fragmentation Shot', 'Binding Shot', 'Bombardment', 'Tight Bindings', "Death's Swiftness", 'Corruption Shot']
+        self.rotation = self.get_rotation_indices(rotation)
+        return self.rotation
+
+    def get_rotation_indices(self, rotation):
+        """
+        Function to translate a list of ability names into a list of ability indices. A name may be followed by a
+        condition (e.g. "Snap Shot if stunned"), in which case its entry is encoded as described in RotationPolicy.py.
+        :param rotation: List of ability names.
+        :return: List of ability indices.
+        """
+        indices = {ability.name: i for i, ability in enumerate(self.abilities)}
         indexed_rotation = []
-        print("LOADED ROTATION",end=' [')
         for name in rotation:
-            for i in range(len(self.abilities)):
-                if self.abilities[i].name == name:
-                    indexed_rotation.append(i)
-                    print(self.abilities[i].name, end=' ')
-        print("]")
-        self.rotation = indexed_rotation
+            arg = encode_name(name, indices, len(self.abilities))
+            if arg is None:
+                raise ValueError("Unknown ability {}".format(name))
+            indexed_rotation.append(arg)
+
+        return indexed_rotation
+
+    def set_rotation(self, rotation):
+        """
+        Function to set this player's rotation from a list of ability indices. If any entry carries a condition, the
+        rotation is compiled into a RotationPolicy.
+        :param rotation: List of ability indices, possibly encoded with conditions. See RotationPolicy.py.
+        :return: None
+        """
+        num_abilities = len(self.abilities)
+        self.rotation = rotation
+        self.policy = None
+        for arg in rotation:
+            if arg >= num_abilities:
+                self.policy = RotationPolicy.from_encoded(rotation, num_abilities)
+                break
 
     def set_damage_modifier(self, value):
         self.damage_modifier = value
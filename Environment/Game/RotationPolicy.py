@@ -0,0 +1,171 @@
+"""
+File name: RotationPolicy.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements conditional rotations. A plain rotation is a fixed priority list, but real play uses rules like
+    "only use Snap Shot if the target is stunned" or "only use Rapid Fire with at least 50 adrenaline". A policy is a
+    priority list of rules, each of which is an ability and an optional set of conditions:
+        stunned: Whether the target must (True) or must not (False) be stunned.
+        min_adrenaline: The player must have at least this much adrenaline.
+        max_adrenaline: The player must have less than this much adrenaline.
+        buffed: Whether the player must (True) or must not (False) have any buffs active.
+
+    Checking those rules every time an ability is picked would make the simulator much slower, so they are compiled
+    ahead of time. Every adrenaline threshold used by any rule splits adrenaline into a small number of buckets, and the
+    state of a fight is reduced to a key made of the target's stun state, the adrenaline bucket, and whether the player
+    is buffed. For every possible key the policy stores the priority list of the rules that hold in that state, so
+    picking an ability only costs working out the key and indexing one list.
+
+    Rotations can also carry conditions directly, which is how the optimizer searches over policies. Each entry of such
+    a rotation is an ability index plus num_abilities times the index of a condition in CONDITIONS, so entries below
+    num_abilities are plain abilities and everything that handles rotations as small integers keeps working.
+"""
+
+import bisect
+
+# The conditions an entry of a rotation can carry, and the text appended to an ability's name to show each one.
+CONDITIONS = [{},
+              {"stunned": True},
+              {"stunned": False},
+              {"min_adrenaline": 50},
+              {"max_adrenaline": 50},
+              {"buffed": True},
+              {"buffed": False}]
+
+CONDITION_NAMES = ["",
+                   "if stunned",
+                   "if not stunned",
+                   "if adrenaline >= 50",
+                   "if adrenaline < 50",
+                   "if buffed",
+                   "if not buffed"]
+
+MAX_ADRENALINE = 100
+
+
+class RotationPolicy(object):
+    def __init__(self, rules):
+        """
+        :param rules: A list of (ability index, condition dict) pairs in priority order. See the description at the top
+                      of this file.
+        """
+        self.rules = rules
+
+        # Adrenaline bucket b covers [bounds[b], bounds[b+1]).
+        thresholds = sorted(set(value for ability, condition in rules
+                                for name, value in condition.items() if name in ("min_adrenaline", "max_adrenaline")))
+        bounds = [-1] + thresholds + [MAX_ADRENALINE + 1]
+        self.num_buckets = len(thresholds) + 1
+        self.adrenaline_buckets = [bisect.bisect_right(thresholds, adrenaline)
+                                   for adrenaline in range(MAX_ADRENALINE + 1)]
+
+        # One priority list per state key. See lookup().
+        self.table = []
+        for key in range(4*self.num_buckets):
+            bucket = key % self.num_buckets
+            stunned = (key // self.num_buckets) % 2 == 1
+            buffed = key // (2*self.num_buckets) == 1
+            self.table.append([ability for ability, condition in rules
+                               if _holds(condition, stunned, buffed, bounds[bucket], bounds[bucket + 1])])
+
+    def lookup(self, stunned, adrenaline, buffed):
+        """
+        Function to get the priority list for a state.
+        :param stunned: Whether the target is stunned.
+        :param adrenaline: The player's adrenaline.
+        :param buffed: Whether the player has any buffs active.
+        :return: A list of ability indices in priority order.
+        """
+        return self.table[self.adrenaline_buckets[int(adrenaline)] + self.num_buckets*(stunned + 2*buffed)]
+
+    @staticmethod
+    def from_encoded(rotation, num_abilities):
+        """
+        Function to compile a rotation whose entries carry conditions. See the description at the top of this file.
+        :param rotation: A list of encoded entries.
+        :param num_abilities: Number of abilities the player has.
+        :return: The compiled RotationPolicy.
+        """
+        return RotationPolicy([(arg % num_abilities, CONDITIONS[arg // num_abilities]) for arg in rotation])
+
+    @staticmethod
+    def from_json(data, ability_names):
+        """
+        Function to compile a policy described by JSON data, e.g.
+            {"rules": [{"ability": "Snap Shot", "stunned": true}, {"ability": "Needle Strike"}]}
+        :param data: The JSON data, as a dict.
+        :param ability_names: The names of the player's abilities, in index order.
+        :return: The compiled RotationPolicy.
+        """
+        indices = {name: i for i, name in enumerate(ability_names)}
+        rules = []
+        for rule in data["rules"]:
+            if rule["ability"] not in indices:
+                raise ValueError("Unknown ability {}".format(rule["ability"]))
+
+            condition = {name: value for name, value in rule.items() if name != "ability"}
+            for name in condition:
+                if name not in ("stunned", "min_adrenaline", "max_adrenaline", "buffed"):
+                    raise ValueError("Unknown condition {}".format(name))
+
+            rules.append((indices[rule["ability"]], condition))
+
+        return RotationPolicy(rules)
+
+
+def encode_name(name, indices, num_abilities):
+    """
+    Function to translate an ability name, optionally followed by one of CONDITION_NAMES (e.g. "Snap Shot if stunned"),
+    into an encoded rotation entry.
+    :param name: The name to translate.
+    :param indices: Dict mapping ability names to indices.
+    :param num_abilities: Number of abilities the player has.
+    :return: The encoded entry, or None if the name isn't an ability.
+    """
+    if name in indices:
+        return indices[name]
+
+    for condition, condition_name in enumerate(CONDITION_NAMES):
+        suffix = " " + condition_name
+        if condition > 0 and name.endswith(suffix) and name[:-len(suffix)] in indices:
+            return indices[name[:-len(suffix)]] + num_abilities*condition
+
+    return None
+
+
+def decode_name(arg, ability_names):
+    """
+    Function to translate an encoded rotation entry into a name that encode_name() understands.
+    :param arg: The encoded entry.
+    :param ability_names: The names of the player's abilities, in index order.
+    :return: The name.
+    """
+    num_abilities = len(ability_names)
+    condition = arg // num_abilities
+    if condition == 0:
+        return ability_names[arg]
+
+    return "{} {}".format(ability_names[arg % num_abilities], CONDITION_NAMES[condition])
+
+
+def _holds(condition, stunned, buffed, low, high):
+    """
+    Function to check whether a condition holds for every state in one entry of the table.
+    :param condition: Condition dict.
+    :param stunned: Whether the target is stunned.
+    :param buffed: Whether the player is buffed.
+    :param low: Lowest adrenaline in the bucket.
+    :param high: One more than the highest adrenaline in the bucket.
+    :return: True if the condition holds.
+    """
+    if "stunned" in condition and condition["stunned"] != stunned:
+        return False
+    if "buffed" in condition and condition["buffed"] != buffed:
+        return False
+    if "min_adrenaline" in condition and low < condition["min_adrenaline"]:
+        return False
+    if "max_adrenaline" in condition and high > condition["max_adrenaline"]:
+        return False
+    return True
@@ -0,0 +1,264 @@
+"""
+File name: GoldenTrace.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements the golden trace check, which pins down exactly what the simulator does so that any faster
+    way of simulating a fight can be checked against it. A golden trace is recorded by running a fixed set of cases
+    (a rotation, a seed, and the shape of the fights) through CombatSimulator and keeping two tables for each:
+        casts: One TraceRecorder record per completed cast. See TraceRecorder.py.
+        ticks: One record per simulated tick, holding the damage the target has taken so far, the player's adrenaline,
+               the damage modifiers of both sides, whether the target is stunned, and how many buffs and debuffs are
+               active once that tick has been handled.
+    Goldens are saved to resources/golden/<ability folder>/, as one .npy file per table plus cases.json, which describes
+    the cases and records the hash of the ability data they were recorded with.
+
+    Checking a backend runs every case through it and compares its tables to the golden ones, whole columns at a time.
+    For each case that doesn't match, the first tick on which anything differs is reported, along with the columns that
+    differ there. A backend is any object with a trace_case(case) method that returns (casts, ticks) arrays of
+    TRACE_DTYPE and TICK_DTYPE. SimulatorBackend is the reference one.
+
+    The default cases simulate a few thousand ticks in total, so checking takes about a second. Run it with
+        python Top.py golden
+    and re-record the goldens with --record only when a change to the simulator's behavior is intended.
+
+    Like TraceRecorder.py, this isn't imported by Environment/__init__.py because it needs numpy.
+"""
+
+from Environment.CombatSimulator import CombatSimulator
+from Environment.TraceRecorder import TraceRecorder, TRACE_DTYPE
+from Environment.Game import Player, Enemy
+from Environment.Abilities import AbilityBundle
+import numpy as np
+import importlib
+import random
+import json
+import os
+
+TICK_DTYPE = np.dtype([("fight", np.int32),
+                       ("tick", np.int32),
+                       ("damage_taken", np.float64),
+                       ("adrenaline", np.float32),
+                       ("player_modifier", np.float32),
+                       ("target_modifier", np.float32),
+                       ("stunned", np.bool_),
+                       ("buffs", np.int16),
+                       ("debuffs", np.int16)])
+
+GOLDEN_ROOT = os.path.join("resources", "golden")
+
+# The cases recorded for the ranged folder. Between them they cover plain priority lists, every ability, buffs,
+# stuns, a conditional rotation, a slower weapon, and a fight that ends when the enemy dies.
+DEFAULT_CASES = [
+    {"name": "full_bar",
+     "rotation": ["Needle Strike", "Piercing Shot", "Snap Shot", "Fragmentation Shot", "Binding Shot", "Bombardment",
+                  "Tight Bindings", "Death's Swiftness", "Corruption Shot"],
+     "seed": 1, "fights": 2, "ticks": 500},
+    {"name": "every_ability",
+     "rotation": ["Binding Shot", "Bombardment", "Corruption Shot", "Deadshot", "Death's Swiftness",
+                  "Fragmentation Shot", "Needle Strike", "Piercing Shot", "Rapid Fire", "Ricochet", "Snap Shot", "Snipe",
+                  "Tight Bindings"],
+     "seed": 2, "fights": 2, "ticks": 500},
+    {"name": "basics_only",
+     "rotation": ["Piercing Shot", "Snap Shot", "Ricochet", "Binding Shot"],
+     "seed": 3, "fights": 2, "ticks": 300},
+    {"name": "conditional",
+     "rotation": ["Snap Shot if stunned", "Rapid Fire if adrenaline >= 50", "Binding Shot", "Tight Bindings",
+                  "Needle Strike if not buffed", "Piercing Shot"],
+     "seed": 4, "fights": 2, "ticks": 500},
+    {"name": "slow_weapon",
+     "rotation": ["Snipe", "Deadshot", "Corruption Shot", "Fragmentation Shot", "Piercing Shot"],
+     "seed": 5, "fights": 1, "ticks": 500, "attack_delay": 4, "stun_immune": True},
+    {"name": "kill",
+     "rotation": ["Death's Swiftness", "Snap Shot", "Rapid Fire", "Needle Strike", "Piercing Shot", "Binding Shot"],
+     "seed": 6, "fights": 2, "ticks": 1000, "enemy_hp": 20000},
+]
+
+
+class _TickRecordingSimulator(CombatSimulator):
+    """
+    A CombatSimulator which also records the state of the fight after every tick. This lives here rather than in
+    CombatSimulator itself so the simulator the optimizer uses doesn't pay for it.
+    """
+    def __init__(self, player, target):
+        super().__init__(player, target)
+        self.tick_records = []
+
+    def tick(self):
+        super().tick()
+        player = self.player
+        target = self.target
+        self.tick_records.append((self.trace.fight, self.current_tick, target.damage_taken, player.adrenaline,
+                                  player.get_current_damage_modifier(), target.get_damage_modifier(),
+                                  target.is_stunned(), len(player.buffs), len(target.debuffs)))
+
+
+class SimulatorBackend(object):
+    def __init__(self, ability_folder="ranged"):
+        """
+        :param ability_folder: Ability folder the cases are simulated with.
+        """
+        self.ability_folder = ability_folder
+
+    def trace_case(self, case):
+        """
+        Function to simulate one case with CombatSimulator, recording every cast and every tick.
+        :param case: Case dict. See DEFAULT_CASES.
+        :return: A structured array of TRACE_DTYPE casts and one of TICK_DTYPE ticks.
+        """
+        player = Player(case.get("attack_delay", 3))
+        player.load_all_abilities(self.ability_folder)
+        player.set_rotation(player.get_rotation_indices(case["rotation"]))
+        enemy = Enemy(case.get("enemy_hp"), case.get("stun_immune", False), case.get("num_targets", 1))
+
+        sim = _TickRecordingSimulator(player, enemy)
+        sim.trace = TraceRecorder(player, capacity=case["fights"]*case["ticks"])
+
+        random.seed(case["seed"])
+        for i in range(case["fights"]):
+            sim.simulate(case["ticks"])
+
+        return sim.trace.to_array(), np.array(sim.tick_records, dtype=TICK_DTYPE)
+
+
+def load_backend(spec, ability_folder="ranged"):
+    """
+    Function to build a backend from a "module:Class" string, e.g. "Environment.GoldenTrace:SimulatorBackend".
+    :param spec: The backend to build. The class is constructed with the ability folder.
+    :param ability_folder: Ability folder the cases are simulated with.
+    :return: The backend.
+    """
+    if ":" not in spec:
+        raise ValueError("Backends are given as module:Class, not {}".format(spec))
+
+    module_name, class_name = spec.split(":", 1)
+    return getattr(importlib.import_module(module_name), class_name)(ability_folder)
+
+
+def get_golden_path(ability_folder):
+    return os.path.join(GOLDEN_ROOT, ability_folder)
+
+
+def record_golden(ability_folder="ranged", cases=None, path=None):
+    """
+    Function to record the golden traces of a set of cases with the reference simulator.
+    :param ability_folder: Ability folder to simulate with.
+    :param cases: List of case dicts. Defaults to DEFAULT_CASES.
+    :param path: Folder to save the goldens to. Defaults to resources/golden/<ability folder>.
+    :return: The number of casts and ticks recorded.
+    """
+    if cases is None:
+        cases = DEFAULT_CASES
+    if path is None:
+        path = get_golden_path(ability_folder)
+
+    backend = SimulatorBackend(ability_folder)
+    casts = []
+    ticks = []
+    for case in cases:
+        case_casts, case_ticks = backend.trace_case(case)
+        casts.append(case_casts)
+        ticks.append(case_ticks)
+
+    os.makedirs(path, exist_ok=True)
+    info = {"ability_folder": ability_folder,
+            "ability_hash": AbilityBundle.get_data_hash(ability_folder),
+            "cases": cases,
+            "num_casts": [len(case_casts) for case_casts in casts],
+            "num_ticks": [len(case_ticks) for case_ticks in ticks]}
+    with open(os.path.join(path, "cases.json"), 'w') as f:
+        json.dump(info, f, indent=2)
+
+    np.save(os.path.join(path, "casts.npy"), np.concatenate(casts))
+    np.save(os.path.join(path, "ticks.npy"), np.concatenate(ticks))
+    return sum(info["num_casts"]), sum(info["num_ticks"])
+
+
+def load_golden(path):
+    """
+    Function to load goldens saved by record_golden().
+    :param path: Folder the goldens were saved to.
+    :return: The description from cases.json, and lists of the golden casts and ticks of each case.
+    """
+    with open(os.path.join(path, "cases.json"), 'r') as f:
+        info = json.load(f)
+
+    casts = np.split(np.load(os.path.join(path, "casts.npy")), np.cumsum(info["num_casts"])[:-1])
+    ticks = np.split(np.load(os.path.join(path, "ticks.npy")), np.cumsum(info["num_ticks"])[:-1])
+    return info, casts, ticks
+
+
+def first_divergence(expected, actual):
+    """
+    Function to find the first record at which two traces differ. Every column is compared at once.
+    :param expected: Structured array of golden records.
+    :param actual: Structured array of records of the same dtype.
+    :return: None if the traces are identical. Otherwise the index of the first differing record and a list of the
+             columns that differ there. If one trace is a prefix of the other, the columns are ["length"].
+    """
+    num = min(len(expected), len(actual))
+    mismatched = np.zeros(num, dtype=np.bool_)
+    for column in expected.dtype.names:
+        mismatched |= expected[column][:num] != actual[column][:num]
+
+    if mismatched.any():
+        index = int(np.argmax(mismatched))
+        columns = [column for column in expected.dtype.names if expected[column][index] != actual[column][index]]
+        return index, columns
+
+    if len(expected) != len(actual):
+        return num, ["length"]
+
+    return None
+
+
+def check_backend(backend, path):
+    """
+    Function to run every golden case through a backend and compare the results to the goldens.
+    :param backend: The backend to check. See the description at the top of this file.
+    :param path: Folder the goldens were saved to.
+    :return: A list containing a dict describing the first divergence of each case that didn't match. Each dict holds
+             the case name, the fight and tick of the divergence, which table it was found in, the columns that differ,
+             and the golden and actual records there (None past the end of a trace).
+    """
+    info, golden_casts, golden_ticks = load_golden(path)
+    divergences = []
+    for case, expected_casts, expected_ticks in zip(info["cases"], golden_casts, golden_ticks):
+        casts, ticks = backend.trace_case(case)
+
+        # A cast and the tick it completed on share a (fight, tick), so the earliest of the two is where things went
+        # wrong. Ticks win ties, since a wrong cast always shows up in the state of its tick as well.
+        found = []
+        for table, expected, actual in (("ticks", expected_ticks, ticks.astype(TICK_DTYPE)),
+                                        ("casts", expected_casts, casts.astype(TRACE_DTYPE))):
+            divergence = first_divergence(expected, actual)
+            if divergence is None:
+                continue
+
+            index, columns = divergence
+            reference = expected if index < len(expected) else actual
+            found.append({"case": case["name"],
+                          "table": table,
+                          "fight": int(reference["fight"][index]),
+                          "tick": int(reference["tick"][index]),
+                          "columns": columns,
+                          "expected": _record_to_dict(expected, index),
+                          "actual": _record_to_dict(actual, index)})
+
+        if len(found) > 0:
+            divergences.append(min(found, key=lambda divergence: (divergence["fight"], divergence["tick"])))
+
+    return divergences
+
+
+def format_divergence(divergence):
+    return "{}: {} diverge at fight {} tick {} in {}.\n    expected {}\n    actual   {}".format(
+        divergence["case"], divergence["table"], divergence["fight"], divergence["tick"],
+        ", ".join(divergence["columns"]), divergence["expected"], divergence["actual"])
+
+
+def _record_to_dict(records, index):
+    if index >= len(records):
+        return None
+    return {column: records[column][index].item() for column in records.dtype.names}
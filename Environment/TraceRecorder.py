@@ -0,0 +1,144 @@
+"""
+File name: TraceRecorder.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements an opt-in recorder for the casts made during a simulation, as a replacement for the print
+    statements scattered through the simulator. Every completed cast is written as one fixed-width record into a
+    preallocated numpy structured array, which is used as a ring buffer. Once it is full, the oldest records are
+    overwritten, so memory use never depends on the length of the fight. A sample rate can be set to only keep every
+    Nth cast, which makes tracing very long fights cheap.
+
+    Each record holds the fight and tick it happened on, the index of the ability cast (-1 for the auto-attack), the
+    damage the target actually took, the total damage modifier applied to it, whether the target was stunned, and the
+    player's adrenaline once the cast had been paid for.
+
+    Traces can be saved either as a single .npy file of records, or as a folder with one .npy file per column (along
+    with the ability names), which is much nicer to load a few columns of at a time.
+
+    This isn't imported by Environment/__init__.py because it needs numpy, and the simulator itself doesn't.
+"""
+
+import numpy as np
+import json
+import os
+
+TRACE_DTYPE = np.dtype([("fight", np.int32),
+                        ("tick", np.int32),
+                        ("ability", np.int16),
+                        ("damage", np.float32),
+                        ("modifier", np.float32),
+                        ("stunned", np.bool_),
+                        ("adrenaline", np.float32)])
+
+AUTO_ATTACK_INDEX = -1
+
+
+class TraceRecorder(object):
+    def __init__(self, player, capacity=65536, sample_rate=1):
+        """
+        :param player: The player whose casts will be recorded. This is used to map abilities to their indices.
+        :param capacity: Maximum number of records to keep.
+        :param sample_rate: Only every sample_rate-th cast is recorded.
+        """
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self.records = np.zeros(capacity, dtype=TRACE_DTYPE)
+
+        self.ability_names = [ability.name for ability in player.abilities]
+        self.auto_attack_name = player.auto_attack.name
+        self.indices = {name: i for i, name in enumerate(self.ability_names)}
+        self.indices[self.auto_attack_name] = AUTO_ATTACK_INDEX
+
+        # Number of casts seen and records written since the trace was started, and the index of the current fight.
+        self.num_seen = 0
+        self.num_recorded = 0
+        self.fight = -1
+
+    def start_fight(self):
+        self.fight += 1
+
+    def record(self, tick, ability, damage, modifier, stunned, adrenaline):
+        """
+        Function to record one completed cast, unless it is skipped by the sample rate.
+        :param tick: Tick of the fight the cast completed on.
+        :param ability: The ability that was cast.
+        :param damage: Damage the target took from the cast.
+        :param modifier: Total damage modifier applied to the cast.
+        :param stunned: Whether the target was stunned.
+        :param adrenaline: Adrenaline of the player after the cast.
+        :return: None
+        """
+        self.num_seen += 1
+        if (self.num_seen - 1) % self.sample_rate != 0:
+            return
+
+        self.records[self.num_recorded % self.capacity] = (self.fight, tick, self.indices[ability.name], damage,
+                                                           modifier, stunned, adrenaline)
+        self.num_recorded += 1
+
+    def to_array(self):
+        """
+        Function to get every record still held in the buffer.
+        :return: A structured array of records, oldest first. This is a copy.
+        """
+        if self.num_recorded <= self.capacity:
+            return self.records[:self.num_recorded].copy()
+
+        start = self.num_recorded % self.capacity
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+    def num_dropped(self):
+        """
+        Function to get the number of records that have been overwritten because the buffer filled up.
+        :return: The number of records lost.
+        """
+        return max(0, self.num_recorded - self.capacity)
+
+    def save(self, path):
+        """
+        Function to save the trace as a single .npy file of records.
+        :param path: Path of the file to write.
+        :return: None
+        """
+        np.save(path, self.to_array())
+
+    def save_columns(self, folder):
+        """
+        Function to save the trace with one .npy file per column, plus a JSON file describing the trace.
+        :param folder: Folder to write to. It is created if it doesn't exist.
+        :return: None
+        """
+        os.makedirs(folder, exist_ok=True)
+        records = self.to_array()
+        for column in TRACE_DTYPE.names:
+            np.save(os.path.join(folder, "{}.npy".format(column)), np.ascontiguousarray(records[column]))
+
+        info = {"columns": list(TRACE_DTYPE.names),
+                "ability_names": self.ability_names,
+                "auto_attack_name": self.auto_attack_name,
+                "sample_rate": self.sample_rate,
+                "num_seen": self.num_seen,
+                "num_recorded": self.num_recorded,
+                "num_dropped": self.num_dropped()}
+        with open(os.path.join(folder, "trace.json"), 'w') as f:
+            json.dump(info, f, indent=2)
+
+
+def load_columns(folder, columns=None):
+    """
+    Function to load a trace saved with TraceRecorder.save_columns().
+    :param folder: Folder the trace was saved to.
+    :param columns: Optional list of the columns to load. Defaults to every column.
+    :return: A dict mapping each column name to its array, and the trace description under "info".
+    """
+    with open(os.path.join(folder, "trace.json"), 'r') as f:
+        info = json.load(f)
+
+    if columns is None:
+        columns = info["columns"]
+
+    trace = {column: np.load(os.path.join(folder, "{}.npy".format(column))) for column in columns}
+    trace["info"] = info
+    return trace
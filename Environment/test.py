@@ -10,6 +10,7 @@ Description:
 from Environment import CombatSimulator
 from Environment.Game import Player, Enemy
 from Environment.Abilities import Ability
+from Optimization.QuantileSketch import QuantileSketch
 import json
 import numpy as np
 import os
@@ -44,6 +45,7 @@ def run_test():
     target = Enemy()
     player = Player(3)
     player.load_all_abilities("ranged")
+    player.preload_rotation()
     #player.load_abilities_from_json(load_abilities())
 
     simulator = CombatSimulator(player, target)
@@ -56,12 +58,21 @@ def run_test():
     iters = 100
     iter_length = 1000//2
 
-    attempts = []
+    # Keep running statistics (Welford's method) and a quantile sketch instead of every attempt, so this can be run
+    # for as many iterations as we like.
+    sketch = QuantileSketch()
+    mean = 0
+    sum_squares = 0
     for i in range(iters):
         dmg = simulator.simulate(iter_length)
-        attempts.append(dmg / iter_length)
+        dpt = dmg / iter_length
+        sketch.update(dpt)
 
-    print(np.mean(attempts), np.std(attempts), np.min(attempts), np.max(attempts))
+        delta = dpt - mean
+        mean += delta / (i + 1)
+        sum_squares += delta * (dpt - mean)
+
+    print(mean, np.sqrt(sum_squares / iters), sketch.min, sketch.max, sketch.quantiles((0.1, 0.5, 0.9)))
 
 
     # for i in range(250):
@@ -0,0 +1,215 @@
+"""
+File name: AsyncRotationOptimizer.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements an asyncio front end for the genetic algorithm in RotationOptimizer.py. Instead of perturbing,
+    evaluating, and comparing a whole epoch in lock-step, each epoch is split into a few chunks. Every chunk goes
+    through the same batch path as any other population (evaluate_population(), so it is deduplicated, cached, stored
+    and run through the fidelity ladder, and spread over a SharedMemoryEvaluator's workers if there are several), on a
+    thread so the event loop stays free. As soon as a chunk comes back its best rotation is adopted if it beats the
+    best so far (a steady-state GA), so the next chunk is drawn around it without waiting for the rest of the epoch.
+    Metrics and checkpoints are written by background tasks so they never hold up the search.
+"""
+
+from Optimization import RotationOptimizer, TrainingResult
+from Optimization.Budget import Budget, BudgetExhausted
+import asyncio
+import time
+import os
+
+
+class AsyncRotationOptimizer(RotationOptimizer):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. Along with everything RotationOptimizer reads, the optional entry async_chunks sets the
+                    number of chunks each epoch is split into.
+        """
+        super().__init__(cfg)
+        self.num_chunks = cfg.get("async_chunks", 4)
+        self.background_tasks = set()
+        self.write_lock = None
+
+    def initialize(self):
+        # Without a worker count, use every core.
+        if self.cfg.get("num_workers") is None:
+            self.cfg["num_workers"] = os.cpu_count()
+
+        super().initialize()
+
+    def train(self, num_epochs=None, time_limit=None, max_ticks=None, target_dpt=None, verbose=True):
+        """
+        Function to run the asynchronous training loop until it finishes. See RotationOptimizer.train() for how the
+        limits work.
+        :param num_epochs: Number of epochs to train for. Defaults to basically infinity.
+        :param time_limit: Optional number of seconds to train for.
+        :param max_ticks: Optional number of ticks to simulate, across every fight of every rotation.
+        :param target_dpt: Optional DPT to stop at as soon as a rotation reaches it.
+        :param verbose: Whether to report every epoch.
+        :return: A TrainingResult describing the best rotation found and the budget spent finding it.
+        """
+        return asyncio.run(self.train_async(num_epochs, time_limit, max_ticks, target_dpt, verbose))
+
+    async def train_async(self, num_epochs=None, time_limit=None, max_ticks=None, target_dpt=None, verbose=True):
+        """
+        The asynchronous training loop. An epoch here is returns_per_update rotations, evaluated a chunk at a time.
+        :param num_epochs: Number of epochs to train for. Defaults to basically infinity.
+        :param time_limit: Optional number of seconds to train for.
+        :param max_ticks: Optional number of ticks to simulate, across every fight of every rotation.
+        :param target_dpt: Optional DPT to stop at as soon as a rotation reaches it.
+        :param verbose: Whether to report every epoch.
+        :return: A TrainingResult describing the best rotation found and the budget spent finding it.
+        """
+
+        if num_epochs is None:
+            num_epochs = 100000000
+
+        budget = None
+        if time_limit is not None or max_ticks is not None:
+            budget = Budget(time_limit, max_ticks)
+
+        t_start = time.time()
+        start_ticks = self.evaluator.total_ticks
+
+        # Score the starting rotation before the budget is attached, so there is always something to return.
+        if self.best_rotation is None:
+            self.evaluate_start()
+
+        self.evaluator.budget = budget
+        self.write_lock = asyncio.Lock()
+        num = self.cfg["returns_per_update"]
+        chunk_size = max(1, num // self.num_chunks)
+        stop_reason = "epochs"
+        rewards = []
+        epoch = 0
+        t1 = time.time()
+        profile_interval = self.start_memory_profile()
+
+        try:
+            while epoch < num_epochs:
+                if target_dpt is not None and self.best_dps >= target_dpt:
+                    stop_reason = "target"
+                    break
+
+                # Every chunk is drawn around the best rotation we know about right now, even if it was only found by
+                # the chunk before it.
+                chunk = self.generator.perturb_population(self.current_rotation, chunk_size)
+                chunk_rewards, best = await asyncio.to_thread(self._evaluate_chunk, chunk)
+                rewards += chunk_rewards
+
+                # Adopt a new best as soon as we see one.
+                best_reward, best_rotation, best_quantiles, best_variance = best
+                if best_reward > self.best_dps:
+                    self.cfg["stdev"] *= 0.85
+                    self.best_dps = best_reward
+                    self.best_quantiles = best_quantiles
+                    self.best_variance = best_variance
+                    self.current_rotation = best_rotation
+                    self.best_rotation = self.evaluator.rotation_names(self.current_rotation)
+
+                if len(rewards) < num:
+                    continue
+
+                # Capture the state to record now, because this loop keeps changing it while the report waits to run
+                # and then waits on the disk.
+                self.evaluator.flush_store()
+                epoch_time = time.time()-t1
+                checkpoint = self.get_checkpoint()
+                checkpoint["epoch"] = epoch
+                stats = self.compute_arr_stats(rewards)
+                self._run_in_background(self.report_epoch_async(epoch, epoch_time, stats, checkpoint, verbose))
+                rewards = []
+                epoch += 1
+                t1 = time.time()
+
+                if profile_interval is not None and epoch % profile_interval == 0:
+                    self.profile_memory(epoch - 1, verbose)
+
+        except BudgetExhausted as e:
+            stop_reason = e.reason
+
+        finally:
+            # Let any metrics or checkpoints that are still being written finish.
+            if len(self.background_tasks) > 0:
+                await asyncio.gather(*self.background_tasks)
+
+            self.evaluator.budget = None
+            self.evaluator.flush_store()
+            self.stop_memory_profile()
+            if self.metrics is not None:
+                self.metrics.close()
+
+        return TrainingResult(self, epoch, time.time()-t_start, self.evaluator.total_ticks - start_ticks, stop_reason)
+
+    def _evaluate_chunk(self, chunk):
+        """
+        Function to evaluate one chunk of perturbations. This runs on a worker thread, but only one chunk is ever being
+        evaluated at a time, so it has the evaluator and the population state to itself.
+        :param chunk: An int16 matrix with one rotation per row, which may contain duplicates.
+        :return: A list containing the DPT of each rotation scored with full-length fights, and the best rotation of
+                 the chunk. See _best_of_population().
+        """
+        rewards = self.evaluate_population(self.generator.prune_population(chunk))
+        return self._full_length_rewards(rewards), self._best_of_population(chunk, rewards)
+
+    async def report_epoch_async(self, epoch, epoch_time, stats, checkpoint, verbose=True):
+        """
+        Function to report an epoch and write a checkpoint from a background task. Everything reported comes from the
+        state captured as the epoch ended, since the training loop has moved on by the time this runs.
+        :param epoch: Index of the epoch being reported.
+        :param epoch_time: Wall-clock time taken by the epoch, in seconds.
+        :param stats: Statistics of the DPT of every rotation the epoch scored, from compute_arr_stats().
+        :param checkpoint: Checkpoint captured as the epoch ended. See get_checkpoint().
+        :param verbose: Whether to print the report as well as writing it.
+        :return: None
+        """
+        if verbose:
+            print("\nEpoch: {}"
+                  "\nEpoch Time: {}"
+                  "\nRewards Mean: {}"
+                  "\nRewards Std : {}"
+                  "\nRewards Min: {}"
+                  "\nRewards Max: {}"
+                  "\nBest DPS: {}"
+                  "\nBest Rotation: {}"
+                  "\nBest Fight DPT p10/p50/p90: {}"
+                  "\nNoise Stdev: {}"
+                  "\n".
+                  format(epoch,
+                         epoch_time,
+                         stats[0],
+                         stats[1],
+                         stats[2],
+                         stats[3],
+                         checkpoint["best_dps"],
+                         checkpoint["best_rotation"],
+                         self._format_quantiles(checkpoint["best_quantiles"]),
+                         checkpoint["stdev"]))
+
+        # Reports can overlap if the disk is slow, so only let one of them write at a time.
+        async with self.write_lock:
+            await self._write_report(epoch, epoch_time, stats, checkpoint)
+
+    async def _write_report(self, epoch, epoch_time, stats, checkpoint):
+        if self.metrics is not None:
+            record = {"epoch": epoch,
+                      "epoch_time": epoch_time,
+                      "rewards_mean": float(stats[0]),
+                      "rewards_std": float(stats[1]),
+                      "rewards_min": float(stats[2]),
+                      "rewards_max": float(stats[3]),
+                      "best_dps": checkpoint["best_dps"],
+                      "best_rotation": checkpoint["best_rotation"],
+                      "stdev": checkpoint["stdev"]}
+            await asyncio.to_thread(self.metrics.log, "epoch", record)
+
+        checkpoint_path = self.cfg.get("checkpoint_path")
+        if checkpoint_path is not None:
+            await asyncio.to_thread(self.save_checkpoint, checkpoint_path, checkpoint)
+
+    def _run_in_background(self, coroutine):
+        # The event loop only keeps weak references to tasks, so we hold on to them until they finish.
+        task = asyncio.ensure_future(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
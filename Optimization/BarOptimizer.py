@@ -0,0 +1,212 @@
+"""
+File name: BarOptimizer.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements an optimizer for action bars with fewer slots than there are abilities. Picking the best k of
+    n abilities and the best order for them at once is a search over n!/(n-k)! rotations, so rather than searching that
+    space directly the work is split into stages which get more expensive as the candidates get fewer:
+
+        1. Bound: Every k-subset of abilities is scored with an optimistic estimate of the DPT it could deal, which
+           costs no simulation at all. Each ability can be cast at most once per cooldown, each cast keeps the player
+           busy for its cast time, and every cast deals its mean damage (boosted by its stun modifier). Filling a fight
+           with the highest damage-per-busy-tick casts first, and auto-attacks once the subset runs dry, gives the
+           estimate. It ignores adrenaline and buffs, so it is a screen rather than a strict bound.
+        2. Screen: The best subsets by that estimate are each simulated over the configured number of fights, which are
+           kept short, with the abilities in order of damage per busy tick.
+        3. Order: The best few subsets from the screen get a full local search (see RotationOptimizer.local_search()).
+           Its neighborhood includes replacing an ability with one off the bar, so the subset can still be corrected.
+
+    After that, training carries on with the usual genetic algorithm around the best bar found. Counts and timings for
+    every stage are kept in self.bar_stats, which makes it easy to see how the search scales as n and k grow. If the
+    training budget runs out partway through the search, they record how far it got instead.
+"""
+
+from Optimization import RotationOptimizer
+import numpy as np
+import itertools
+import heapq
+import math
+import time
+
+
+class BarOptimizer(RotationOptimizer):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. The bar size is cfg["rotation_length"], and the following optional entries are read:
+                        bar_screened: Number of subsets, by estimate, to simulate in the screening stage.
+                        bar_screen_ticks: Length of the screening fights.
+                        bar_finalists: Number of subsets, by screening DPT, to run the order search on.
+        """
+        super().__init__(cfg)
+        self.num_screened = cfg.get("bar_screened", 200)
+        self.screen_ticks = cfg.get("bar_screen_ticks", 200)
+        self.num_finalists = cfg.get("bar_finalists", 5)
+
+        self.bar_stats = None
+
+    def train(self, num_epochs=None, time_limit=None, max_ticks=None, target_dpt=None, verbose=True):
+        result = super().train(num_epochs, time_limit, max_ticks, target_dpt, verbose)
+
+        # report_epoch() never runs for a bar search the budget stopped, so report how far it got here.
+        if verbose and self.bar_stats is not None and not self.bar_stats["complete"]:
+            print(format_bar_stats(self.bar_stats))
+            print()
+
+        return result
+
+    def epoch(self):
+        # The first epoch is the staged bar search. After that we just refine the best bar it found.
+        if self.bar_stats is None or not self.bar_stats["complete"]:
+            return self.optimize_bar()
+
+        return super().epoch()
+
+    def ability_estimates(self):
+        """
+        Function to compute the numbers the optimistic estimate is built from.
+        :return: Arrays containing the mean damage of each ability, the number of ticks each cast keeps the player busy,
+                 and the maximum number of times each ability can be cast in one fight, along with the mean damage and
+                 busy ticks of the auto-attack.
+        """
+        player = self.evaluator.combat_sim.player
+        fight_length = self.evaluator.fight_length
+
+        def mean_damage(ability):
+            if type(ability.damage_range) in (float, int):
+                damage = ability.damage_range
+            else:
+                damage = sum(ability.damage_range) / 2
+            return damage * max(1, ability.stun_damage_modifier)
+
+        damage = np.array([mean_damage(ability) for ability in player.abilities])
+        busy = np.array([max(1, ability.cast_time_ticks) for ability in player.abilities])
+        max_casts = np.array([math.ceil(fight_length / (ability.cooldown_ticks + max(1, ability.cast_time_ticks)))
+                              for ability in player.abilities])
+
+        auto_attack = player.auto_attack
+        return damage, busy, max_casts, mean_damage(auto_attack), max(1, auto_attack.cast_time_ticks)
+
+    def estimate_subset(self, subset, estimates):
+        """
+        Function to compute the optimistic DPT estimate of a subset of abilities.
+        :param subset: Tuple of ability indices.
+        :param estimates: The return value of ability_estimates().
+        :return: The estimated DPT.
+        """
+        damage, busy, max_casts, auto_damage, auto_busy = estimates
+        fight_length = self.evaluator.fight_length
+        auto_rate = auto_damage / auto_busy
+
+        # Fill the fight with the casts that deal the most damage per busy tick, until we run out of ticks or casts that
+        # beat an auto-attack.
+        remaining = fight_length
+        total = 0
+        for arg in sorted(subset, key=lambda arg: -damage[arg] / busy[arg]):
+            if damage[arg] / busy[arg] <= auto_rate or remaining <= 0:
+                break
+
+            ticks = min(remaining, max_casts[arg] * busy[arg])
+            total += ticks * damage[arg] / busy[arg]
+            remaining -= ticks
+
+        total += remaining * auto_rate
+        return total / fight_length
+
+    def optimize_bar(self):
+        """
+        Function to run the staged search for the best bar described at the top of this file.
+        :return: A list containing the DPT of every rotation the order stage scored with full-length fights. The
+                 screening stage only uses short fights, so none of its DPT is included. The stats of the search are
+                 recorded in self.bar_stats, even if the budget runs out partway through it.
+        """
+        n = self.generator.num_abilities
+        k = self.generator.rotation_length
+        estimates = self.ability_estimates()
+        damage, busy = estimates[0], estimates[1]
+        stats = {"n": n, "k": k,
+                 "subsets": math.comb(n, k),
+                 "permutations": math.perm(n, k),
+                 "complete": False}
+
+        rewards = []
+        num_simulated = self.num_simulated
+        best_rotation = None
+        t1 = time.time()
+        try:
+            # Stage 1: Estimate every subset, keeping only the best.
+            scored = ((self.estimate_subset(subset, estimates), subset)
+                      for subset in itertools.combinations(range(n), k))
+            best_subsets = heapq.nlargest(self.num_screened, scored)
+            stats["bound_time"] = time.time()-t1
+
+            # Stage 2: Simulate each remaining subset with short fights, in order of damage per busy tick.
+            t1 = time.time()
+            screen_rotations = [sorted(subset, key=lambda arg: -damage[arg] / busy[arg])
+                                for estimate, subset in best_subsets]
+            screen_rewards = self.evaluator.evaluate_rotations(screen_rotations, self.screen_ticks)
+            stats["screened"] = len(screen_rotations)
+            stats["screen_time"] = time.time()-t1
+
+            # Stage 3: Search for the best order of the most promising subsets.
+            t1 = time.time()
+            finalists = np.argsort(screen_rewards)[::-1][:self.num_finalists]
+            stats["finalists"] = len(finalists)
+            stats["searched"] = 0
+            best_reward = -np.inf
+            for finalist in finalists:
+                self.current_rotation = screen_rotations[finalist]
+                finalist_rewards, reward = self.local_search()
+                rewards += finalist_rewards
+                stats["searched"] += 1
+
+                # Compare the optimum each search ended on, not the best ever seen, which an earlier finalist may hold.
+                if reward > best_reward:
+                    best_reward = reward
+                    best_rotation = self.current_rotation
+
+            stats["order_time"] = time.time()-t1
+            stats["complete"] = True
+
+        finally:
+            # If the budget ran out, the time spent in the stage it stopped in still counts.
+            for key in ("bound_time", "screen_time", "order_time"):
+                if key not in stats:
+                    stats[key] = time.time()-t1
+                    break
+
+            stats["simulated"] = stats.get("screened", 0) + self.num_simulated - num_simulated
+            if best_rotation is not None:
+                self.current_rotation = best_rotation
+            self.bar_stats = stats
+
+        return rewards
+
+    def report_epoch(self, epoch, epoch_time, rewards):
+        super().report_epoch(epoch, epoch_time, rewards)
+
+        if epoch == 0 and self.bar_stats is not None:
+            print(format_bar_stats(self.bar_stats))
+            print()
+
+
+def format_bar_stats(stats):
+    if stats["complete"]:
+        return ("Bar Search: {} of {} abilities. {} subsets ({} ordered bars). Estimated every subset in {:.3f}s, "
+                "screened {} in {:.3f}s, searched the order of {} in {:.3f}s. {} rotations simulated in total."
+                .format(stats["k"], stats["n"], stats["subsets"], stats["permutations"], stats["bound_time"],
+                        stats["screened"], stats["screen_time"], stats["finalists"], stats["order_time"],
+                        stats["simulated"]))
+
+    # The budget ran out partway through, so only report the stages that were reached.
+    text = "Bar Search (stopped early): {} of {} abilities. {} subsets ({} ordered bars). Estimated every subset in " \
+           "{:.3f}s".format(stats["k"], stats["n"], stats["subsets"], stats["permutations"], stats["bound_time"])
+    if "screened" in stats:
+        text += ", screened {} in {:.3f}s".format(stats["screened"], stats["screen_time"])
+    elif "screen_time" in stats:
+        text += ", stopped screening after {:.3f}s".format(stats["screen_time"])
+    if "order_time" in stats:
+        text += ", searched the order of {} of {} in {:.3f}s".format(stats["searched"], stats["finalists"],
+                                                                   stats["order_time"])
+    return "{}. {} rotations simulated in total.".format(text, stats["simulated"])
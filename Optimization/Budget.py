@@ -0,0 +1,71 @@
+"""
+File name: Budget.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements the budget that anytime training runs under. A budget can limit wall-clock time, the number of
+    ticks simulated, or both. Evaluators charge every fight they simulate to the budget they've been given and check it
+    as they go, raising BudgetExhausted the moment it runs out, so even a long epoch stops within about one fight of the
+    limit. The deadline is measured with time.monotonic(), which is shared by every process on the machine, so worker
+    processes can check it too.
+"""
+
+import time
+
+
+class BudgetExhausted(Exception):
+    def __init__(self, reason):
+        """
+        :param reason: Which limit ran out, either "time" or "ticks".
+        """
+        super().__init__("The {} budget ran out.".format(reason))
+        self.reason = reason
+
+
+class Budget(object):
+    def __init__(self, time_limit=None, max_ticks=None, deadline=None):
+        """
+        :param time_limit: Optional number of seconds from now until the budget runs out.
+        :param max_ticks: Optional number of ticks that can be simulated before the budget runs out.
+        :param deadline: Optional time.monotonic() value at which the budget runs out. This is how a budget is handed to
+                         another process, and it overrides the time limit.
+        """
+        self.start_time = time.monotonic()
+        self.deadline = deadline
+        if deadline is None and time_limit is not None:
+            self.deadline = self.start_time + time_limit
+
+        self.max_ticks = max_ticks
+        self.ticks = 0
+
+    def spend(self, ticks):
+        self.ticks += ticks
+
+    def remaining_ticks(self):
+        if self.max_ticks is None:
+            return None
+        return max(0, self.max_ticks - self.ticks)
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time
+
+    def exhausted(self):
+        """
+        Function to check whether either limit has run out.
+        :return: "time" or "ticks" if that limit has run out, otherwise None.
+        """
+        if self.max_ticks is not None and self.ticks >= self.max_ticks:
+            return "ticks"
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return "time"
+        return None
+
+    def check(self):
+        """
+        Function to raise BudgetExhausted if either limit has run out.
+        :return: None
+        """
+        reason = self.exhausted()
+        if reason is not None:
+            raise BudgetExhausted(reason)
@@ -0,0 +1,215 @@
+"""
+File name: EvaluationStore.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a persistent store of evaluation results, so rotations scored by one run don't have to be
+    simulated again by the next. It is a single SQLite database in write-ahead logging mode, which lets any number of
+    processes read it while one of them writes, and makes each bulk write one cheap append to the log.
+
+    Every result is keyed by three things:
+        ability_hash: One hash covering the stats of every ability in the folder. See AbilityBundle.get_data_hash().
+        scenario: Everything else about the fight that changes the score. See get_scenario().
+        rotation_key: The canonical key of the rotation. See RotationEvaluator.canonicalize().
+    and records the number of fights it was measured over, the mean score, the estimated variance of that mean, and the
+    per-fight quantiles (see RotationEvaluator.QUANTILES), along with the ability names of one rotation with that key.
+
+    Writing a result for a key that is already stored combines the two, weighting each by its number of fights, so a
+    later run with more fights per rotation refines what an earlier run found rather than replacing it. The quantiles of
+    a combined result are weighted averages too, which is only an approximation.
+
+    The store is indexed by score within each ability hash and scenario, so asking for the best K rotations never has to
+    scan the whole table.
+"""
+
+from Optimization.RotationEvaluator import QUANTILES
+import sqlite3
+import json
+import time
+
+# SQLite limits the number of parameters in one statement, so lookups are done in chunks of this many keys.
+_LOOKUP_CHUNK = 500
+
+_QUANTILE_COLUMNS = ["q{}".format(int(round(q*100))) for q in QUANTILES]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS evaluations (
+    ability_hash TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    rotation_key INTEGER NOT NULL,
+    rotation TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    variance REAL NOT NULL,
+    {quantiles},
+    updated REAL NOT NULL,
+    PRIMARY KEY (ability_hash, scenario, rotation_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS evaluations_by_mean ON evaluations (ability_hash, scenario, mean DESC);
+""".format(quantiles=", ".join("{} REAL".format(column) for column in _QUANTILE_COLUMNS))
+
+
+def get_scenario(evaluator):
+    """
+    Function to describe everything about the fights an evaluator simulates, other than the abilities, which changes
+    the score a rotation gets.
+    :param evaluator: A RotationEvaluator.
+    :return: A string which is equal for any two evaluators whose results can be shared.
+    """
+    scenario = {"attack_delay": evaluator.attack_delay,
+                "fight_length": evaluator.fight_length,
+                "stun_immune": evaluator.stun_immune,
+                "num_targets": evaluator.num_targets,
+                "objective": evaluator.objective,
+                "enemy_hp": evaluator.enemy_hp}
+    return json.dumps(scenario, sort_keys=True, separators=(",", ":"))
+
+
+def _to_signed(key):
+    # Canonical keys are unsigned 64-bit integers, and SQLite integers are signed.
+    return key - 2**64 if key >= 2**63 else key
+
+
+def _to_unsigned(key):
+    return key + 2**64 if key < 0 else key
+
+
+class EvaluationStore(object):
+    def __init__(self, path, timeout=30):
+        """
+        :param path: Path of the database file. It is created if it doesn't exist.
+        :param timeout: Seconds to wait for another process to finish writing before giving up.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+
+    def lookup(self, ability_hash, scenario, keys):
+        """
+        Function to fetch the stored results of a batch of rotations.
+        :param ability_hash: Hash of the ability data the results must have been measured with.
+        :param scenario: Scenario the results must have been measured in. See get_scenario().
+        :param keys: A list of canonical keys.
+        :return: A dict mapping each key that has a stored result to a dict describing it. Keys without one are left out.
+        """
+        keys = list(keys)
+        results = {}
+        columns = ["rotation_key", "rotation", "samples", "mean", "variance"] + _QUANTILE_COLUMNS
+        for start in range(0, len(keys), _LOOKUP_CHUNK):
+            chunk = [_to_signed(key) for key in keys[start:start + _LOOKUP_CHUNK]]
+            query = "SELECT {} FROM evaluations WHERE ability_hash = ? AND scenario = ? AND rotation_key IN ({})"\
+                .format(", ".join(columns), ", ".join("?"*len(chunk)))
+
+            for row in self.connection.execute(query, [ability_hash, scenario] + chunk):
+                results[_to_unsigned(row[0])] = self._row_to_result(row[1:])
+
+        return results
+
+    def write(self, ability_hash, scenario, results):
+        """
+        Function to write a batch of results in one transaction. Results for keys that are already stored are combined
+        with what is there. See the description at the top of this file.
+        :param ability_hash: Hash of the ability data the results were measured with.
+        :param scenario: Scenario the results were measured in. See get_scenario().
+        :param results: A list of (key, rotation, samples, mean, variance, quantiles) tuples, where rotation is a list of
+                        ability names.
+        :return: None
+        """
+        if len(results) == 0:
+            return
+
+        # Later results for the same key are combined with earlier ones, just like results already on disk.
+        combined = {}
+        for key, rotation, samples, mean, variance, quantiles in results:
+            result = {"rotation": rotation, "samples": samples, "mean": mean, "variance": variance,
+                      "quantiles": quantiles}
+            combined[key] = _combine(combined[key], result) if key in combined else result
+
+        now = time.time()
+        with self.connection:
+            stored = self.lookup(ability_hash, scenario, combined.keys())
+            rows = []
+            for key, result in combined.items():
+                if key in stored:
+                    result = _combine(stored[key], result)
+
+                quantiles = result["quantiles"]
+                if quantiles is None:
+                    quantiles = [None]*len(QUANTILES)
+
+                rows.append([ability_hash, scenario, _to_signed(key), json.dumps(result["rotation"]), result["samples"],
+                             result["mean"], result["variance"]] + list(quantiles) + [now])
+
+            placeholders = ", ".join("?"*(8 + len(QUANTILES)))
+            self.connection.executemany("INSERT OR REPLACE INTO evaluations VALUES ({})".format(placeholders), rows)
+
+    def top(self, k, ability_hash=None, scenario=None):
+        """
+        Function to fetch the best stored rotations.
+        :param k: Maximum number of rotations to return.
+        :param ability_hash: Optional ability data hash to restrict the results to.
+        :param scenario: Optional scenario to restrict the results to. See get_scenario().
+        :return: A list of result dicts, best first. Each also records the ability hash and scenario it belongs to.
+        """
+        conditions = []
+        arguments = []
+        if ability_hash is not None:
+            conditions.append("ability_hash = ?")
+            arguments.append(ability_hash)
+        if scenario is not None:
+            conditions.append("scenario = ?")
+            arguments.append(scenario)
+
+        where = "WHERE {}".format(" AND ".join(conditions)) if len(conditions) > 0 else ""
+        query = "SELECT ability_hash, scenario, rotation, samples, mean, variance, {} FROM evaluations {} " \
+                "ORDER BY mean DESC LIMIT ?".format(", ".join(_QUANTILE_COLUMNS), where)
+
+        results = []
+        for row in self.connection.execute(query, arguments + [k]):
+            result = self._row_to_result(row[2:])
+            result["ability_hash"] = row[0]
+            result["scenario"] = row[1]
+            results.append(result)
+
+        return results
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _row_to_result(self, row):
+        quantiles = list(row[4:])
+        return {"rotation": json.loads(row[0]),
+                "samples": row[1],
+                "mean": row[2],
+                "variance": row[3],
+                "quantiles": None if None in quantiles else quantiles}
+
+
+def _combine(a, b):
+    """
+    Function to combine two independent results for the same rotation into one, weighting each by its number of fights.
+    :param a: A result dict.
+    :param b: Another result dict.
+    :return: The combined result dict.
+    """
+    samples = a["samples"] + b["samples"]
+    wa = a["samples"] / samples
+    wb = b["samples"] / samples
+
+    quantiles = a["quantiles"] if b["quantiles"] is None else b["quantiles"]
+    if a["quantiles"] is not None and b["quantiles"] is not None:
+        quantiles = [wa*qa + wb*qb for qa, qb in zip(a["quantiles"], b["quantiles"])]
+
+    return {"rotation": a["rotation"],
+            "samples": samples,
+            "mean": wa*a["mean"] + wb*b["mean"],
+            "variance": wa*wa*a["variance"] + wb*wb*b["variance"],
+            "quantiles": quantiles}
@@ -0,0 +1,141 @@
+"""
+File name: MemoryProfiler.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements the memory profiling mode for long training runs. While it is running, every allocation made by
+    Python code is traced with tracemalloc, and every few epochs a snapshot is taken and compared with the previous
+    one. Each sample records:
+        traced: Bytes currently allocated by Python code, and the most that have been allocated at once.
+        peak_rss: The peak resident set size of this process, in bytes. Worker processes aren't included.
+        top: The allocation sites (file and line) holding the most memory, with how much each grew since the last
+             sample. Sites which churn through short-lived objects don't show up here, only ones that hold on to them.
+        growing: Whether traced memory has grown at every one of the last few samples, by more than a small tolerance.
+                 A run that holds steady memory plateaus once its caches fill, so steady growth points to a leak.
+
+    Tracing makes every allocation several times more expensive, so this should only be turned on to look for a
+    problem, not left on. Samples are meant for the structured metrics stream (see MetricsLogger.py).
+"""
+
+import tracemalloc
+import sys
+
+try:
+    import resource
+except ImportError:
+    # The resource module only exists on Unix.
+    resource = None
+
+# Allocations made by the import system and by tracemalloc itself aren't interesting.
+_IGNORED_FILES = ["<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>",
+                  tracemalloc.__file__]
+
+
+class MemoryProfiler(object):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. The following optional entries are read:
+                        memory_profile_top: Number of allocation sites to report in each sample.
+                        memory_profile_window: Number of consecutive samples traced memory must grow over to be flagged.
+                        memory_profile_tolerance: Growth in bytes between two samples which is still considered steady.
+        """
+        self.num_top = cfg.get("memory_profile_top", 10)
+        self.window = cfg.get("memory_profile_window", 5)
+        self.tolerance = cfg.get("memory_profile_tolerance", 64*1024)
+
+        self.previous_snapshot = None
+        self.history = []
+        self.started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        self.previous_snapshot = None
+
+    def sample(self):
+        """
+        Function to take a snapshot and describe how memory has changed since the last one.
+        :return: A JSON-serializable dict describing the sample. See the description at the top of this file.
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in _IGNORED_FILES])
+        current, peak = tracemalloc.get_traced_memory()
+
+        if self.previous_snapshot is None:
+            statistics = snapshot.statistics("lineno")
+            top = [self._site(stat, stat.size, stat.count) for stat in statistics[:self.num_top]]
+        else:
+            statistics = snapshot.compare_to(self.previous_snapshot, "lineno")
+            statistics.sort(key=lambda stat: stat.size, reverse=True)
+            top = [self._site(stat, stat.size_diff, stat.count_diff) for stat in statistics[:self.num_top]]
+
+        self.previous_snapshot = snapshot
+        self.history.append(current)
+
+        return {"traced_current": current,
+                "traced_peak": peak,
+                "peak_rss": get_peak_rss(),
+                "top": top,
+                "growing": self.is_growing()}
+
+    def is_growing(self):
+        """
+        Function to check whether traced memory has grown steadily over the last few samples.
+        :return: True if it grew by more than the tolerance at each of the last self.window samples.
+        """
+        if len(self.history) <= self.window:
+            return False
+
+        recent = self.history[-self.window - 1:]
+        return all(b - a > self.tolerance for a, b in zip(recent[:-1], recent[1:]))
+
+    def _site(self, stat, size_diff, count_diff):
+        frame = stat.traceback[0]
+        return {"site": "{}:{}".format(frame.filename, frame.lineno),
+                "size": stat.size,
+                "count": stat.count,
+                "size_diff": size_diff,
+                "count_diff": count_diff}
+
+
+def get_peak_rss():
+    """
+    Function to get the peak resident set size of this process.
+    :return: The peak RSS in bytes, or None if it can't be measured on this platform.
+    """
+    if resource is None:
+        return None
+
+    # Linux reports kilobytes, and macOS reports bytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def format_sample(epoch, sample, num_sites=3):
+    """
+    Function to summarize a sample in a few lines for the console.
+    :param epoch: Index of the epoch the sample was taken after.
+    :param sample: A dict returned by MemoryProfiler.sample().
+    :param num_sites: Number of allocation sites to include.
+    :return: The summary.
+    """
+    rss = "unknown" if sample["peak_rss"] is None else "{:.1f} MB".format(sample["peak_rss"] / 2**20)
+    lines = ["Memory after epoch {}: {:.1f} MB traced ({:.1f} MB peak), {} peak RSS{}".format(
+        epoch, sample["traced_current"] / 2**20, sample["traced_peak"] / 2**20, rss,
+        ". GROWING STEADILY" if sample["growing"] else "")]
+
+    for site in sample["top"][:num_sites]:
+        lines.append("    {:.1f} KB ({:+.1f} KB) in {} blocks at {}".format(site["size"] / 1024, site["size_diff"] / 1024,
+                                                                          site["count"], site["site"]))
+
+    return "\n".join(lines)
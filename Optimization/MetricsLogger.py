@@ -0,0 +1,41 @@
+"""
+File name: MetricsLogger.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a very small structured metrics stream. Every record is a flat dict written as one line of JSON,
+    so a run can be followed with tail -f and loaded afterwards with any JSON lines reader.
+"""
+
+import json
+import time
+
+
+class MetricsLogger(object):
+    def __init__(self, path):
+        """
+        :param path: Path of the JSON lines file to append records to.
+        """
+        self.path = path
+        self.file = None
+
+    def log(self, record_type, record):
+        """
+        Function to write one record to the metrics stream.
+        :param record_type: String naming what kind of record this is, e.g. "epoch" or "checkpoint".
+        :param record: Dict of values to write. Everything in it must be JSON-serializable.
+        :return: None
+        """
+        if self.file is None:
+            self.file = open(self.path, 'a')
+
+        line = {"type": record_type, "time": time.time()}
+        line.update(record)
+        self.file.write("{}\n".format(json.dumps(line)))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
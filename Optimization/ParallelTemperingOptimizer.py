@@ -0,0 +1,215 @@
+"""
+File name: ParallelTemperingOptimizer.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a parallel tempering front end for the optimizer in RotationOptimizer.py. Rather than annealing
+    one noise level that never comes back up, this keeps a number of replicas of the rotation, each at its own fixed
+    temperature. Cold replicas only accept changes that (nearly) improve their DPT and use small perturbations, so they
+    refine what they have. Hot replicas take bigger steps and happily accept worse rotations, so they keep exploring.
+
+    Every epoch (a sweep), each replica proposes a batch of perturbations of its current rotation, and the proposals of
+    every replica are evaluated together as one population, so a parallel evaluator can spread them over every core.
+    Each replica then considers its best proposal and accepts it with the Metropolis criterion. The best of a batch of
+    noisy estimates is biased upwards, so it isn't compared with the DPT the replica holds as is. Instead, the proposal
+    and the replica's rotation are re-scored together with common random numbers, and the acceptance test and the DPT
+    the replica goes on to hold both come from that. Finally, neighboring replicas on the temperature ladder try to
+    swap rotations. A swap is accepted with probability
+
+        min(1, exp((dpt_hot - dpt_cold) * (1/T_cold - 1/T_hot)))
+
+    so good rotations found by hot replicas drift down to the cold ones, and cold replicas stuck in a local optimum get
+    pushed back up to where they can escape it.
+"""
+
+from Optimization import RotationOptimizer, RotationEvaluator
+import numpy as np
+import random
+
+
+class ParallelTemperingOptimizer(RotationOptimizer):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. On top of everything RotationOptimizer uses, the following optional entries are read:
+                        pt_replicas: Number of replicas.
+                        pt_min_temperature, pt_max_temperature: Ends of the geometric temperature ladder, in DPT.
+                        pt_min_stdev: Noise stdev of the coldest replica. The hottest uses cfg["stdev"].
+        """
+        super().__init__(cfg)
+        self.num_replicas = cfg.get("pt_replicas", 8)
+
+        # Temperatures and noise levels, coldest first.
+        self.temperatures = np.geomspace(cfg.get("pt_min_temperature", 0.05), cfg.get("pt_max_temperature", 2.0),
+                                         self.num_replicas)
+        self.stdevs = np.geomspace(cfg.get("pt_min_stdev", 1.0), cfg["stdev"], self.num_replicas)
+
+        # The rotation and DPT each replica currently holds, and the best each one has ever held.
+        self.replica_rotations = []
+        self.replica_rewards = []
+        self.replica_best_rewards = []
+        self.replica_best_rotations = []
+
+        # Swap attempts and acceptances between each replica and the next hotter one.
+        self.swap_attempts = np.zeros(self.num_replicas - 1, dtype=np.int64)
+        self.swap_accepts = np.zeros(self.num_replicas - 1, dtype=np.int64)
+        self.num_sweeps = 0
+
+    def initialize(self):
+        super().initialize()
+
+        # Every replica starts from its own random rotation, except the coldest, which gets the optimizer's current
+        # rotation (possibly a warm start). Proposals are compared against the DPT each replica holds, and only
+        # full-length DPT can be compared, so these skip the fidelity ladder.
+        rotations = [self.complete_rotation(self.current_rotation)]
+        rotations += [self.generator.generate_rotation() for i in range(self.num_replicas - 1)]
+        rewards = self.evaluate_population(rotations, full_length=True)
+
+        self.replica_rotations = rotations
+        self.replica_rewards = list(rewards)
+        self.replica_best_rewards = list(rewards)
+        self.replica_best_rotations = list(rotations)
+        for i in range(self.num_replicas):
+            self._update_best(rotations[i], rewards[i], self.population_quantiles[i], self.population_variances[i])
+
+    def epoch(self):
+        """
+        Function to perform one sweep of parallel tempering.
+        :return: A list containing the DPT of every proposal tried this sweep and scored with full-length fights.
+        """
+        rng = self.cfg["rng"]
+        num_proposals = max(1, self.cfg["returns_per_update"] // self.num_replicas)
+
+        # Every replica proposes a batch of perturbations at its own noise level, and they're all evaluated together.
+        rotations = []
+        for replica in range(self.num_replicas):
+            for i in range(num_proposals):
+                rotation, noise = self.generator.perturb_rotation(self.replica_rotations[replica],
+                                                                  self.stdevs[replica])
+                rotations.append(rotation)
+
+        rewards = self.evaluate_population(rotations)
+
+        # Pick each replica's best proposal.
+        chosen = {}
+        for replica in range(self.num_replicas):
+            start = replica*num_proposals
+            best = None
+            for i in range(start, start + num_proposals):
+                if self.full_fidelity[i] and (best is None or rewards[i] > rewards[best]):
+                    best = i
+
+            if best is not None:
+                chosen[replica] = best
+                self._update_best(rotations[best], rewards[best], self.population_quantiles[best],
+                                  self.population_variances[best])
+
+        # Re-score each chosen proposal against its replica's rotation, and run the Metropolis acceptance on those
+        # scores. Improvements are always accepted.
+        pairs = []
+        for replica, best in chosen.items():
+            pairs += [self.replica_rotations[replica], rotations[best]]
+        scores = self.rescore(pairs)
+
+        for n, (replica, best) in enumerate(chosen.items()):
+            incumbent, proposal = scores[2*n], scores[2*n + 1]
+            delta = proposal - incumbent
+            if delta >= 0 or rng.uniform() < np.exp(delta / self.temperatures[replica]):
+                self.replica_rotations[replica] = rotations[best]
+                self.replica_rewards[replica] = proposal
+            else:
+                self.replica_rewards[replica] = incumbent
+
+        self.swap_replicas()
+        self.num_sweeps += 1
+
+        for replica in range(self.num_replicas):
+            if self.replica_rewards[replica] > self.replica_best_rewards[replica]:
+                self.replica_best_rewards[replica] = self.replica_rewards[replica]
+                self.replica_best_rotations[replica] = self.replica_rotations[replica]
+
+        self.current_rotation = self.replica_rotations[0]
+        return self._full_length_rewards(rewards)
+
+    def rescore(self, rotations):
+        """
+        Function to score rotations with full-length fights and common random numbers (see RotationEvaluator.crn_seed),
+        so the noise they share cancels out of the differences between them. Every sweep uses a different set of
+        fights. Whatever the evaluator, these run in this process, because the crn_seed of worker processes can't be
+        changed after they start. The simulator's random state is restored afterwards, so it doesn't replay the same
+        fights in the next sweep.
+        :param rotations: A list of rotations.
+        :return: A list containing the DPT of each rotation, in the same order as the input.
+        """
+        if not rotations:
+            return []
+
+        evaluator = self.evaluator
+        crn_seed = evaluator.crn_seed
+        state = random.getstate()
+        evaluator.crn_seed = self.cfg.get("seed", 0)*7919 + self.num_sweeps
+        try:
+            return RotationEvaluator.evaluate_rotations(evaluator, rotations)
+        finally:
+            evaluator.crn_seed = crn_seed
+            random.setstate(state)
+
+    def swap_replicas(self):
+        """
+        Function to attempt swaps between neighboring replicas on the temperature ladder. Sweeps alternate between
+        pairing each even replica with the one above it, and each odd replica with the one above it, so no replica is
+        part of two swaps at once.
+        :return: None
+        """
+        rng = self.cfg["rng"]
+
+        for cold in range(self.num_sweeps % 2, self.num_replicas - 1, 2):
+            hot = cold + 1
+            exponent = (self.replica_rewards[hot] - self.replica_rewards[cold]) * \
+                       (1/self.temperatures[cold] - 1/self.temperatures[hot])
+
+            self.swap_attempts[cold] += 1
+            if exponent >= 0 or rng.uniform() < np.exp(exponent):
+                self.swap_accepts[cold] += 1
+                self.replica_rotations[cold], self.replica_rotations[hot] = \
+                    self.replica_rotations[hot], self.replica_rotations[cold]
+                self.replica_rewards[cold], self.replica_rewards[hot] = \
+                    self.replica_rewards[hot], self.replica_rewards[cold]
+
+    def swap_acceptance_rates(self):
+        """
+        Function to get the fraction of attempted swaps that were accepted between each replica and the next hotter one.
+        :return: An array of acceptance rates, coldest pair first. Pairs that haven't been tried yet are NaN.
+        """
+        rates = np.full(self.num_replicas - 1, np.nan)
+        tried = self.swap_attempts > 0
+        rates[tried] = self.swap_accepts[tried] / self.swap_attempts[tried]
+        return rates
+
+    def report_epoch(self, epoch, epoch_time, rewards):
+        super().report_epoch(epoch, epoch_time, rewards)
+
+        rates = ", ".join("{:.2f}".format(rate) for rate in self.swap_acceptance_rates())
+        print("Swap Acceptance Rates: {}".format(rates))
+        print("{:>8} {:>8} {:>10} {:>10}".format("Temp", "Stdev", "Current", "Best"))
+        for replica in range(self.num_replicas):
+            print("{:>8.3f} {:>8.3f} {:>10.3f} {:>10.3f}".format(self.temperatures[replica], self.stdevs[replica],
+                                                                self.replica_rewards[replica],
+                                                                self.replica_best_rewards[replica]))
+        print()
+
+    def get_checkpoint(self):
+        checkpoint = super().get_checkpoint()
+        checkpoint["replica_rotations"] = [[int(arg) for arg in rotation] for rotation in self.replica_rotations]
+        checkpoint["replica_rewards"] = [float(reward) for reward in self.replica_rewards]
+        checkpoint["replica_best_rewards"] = [float(reward) for reward in self.replica_best_rewards]
+        checkpoint["swap_acceptance_rates"] = [None if np.isnan(rate) else float(rate)
+                                               for rate in self.swap_acceptance_rates()]
+        return checkpoint
+
+    def _update_best(self, rotation, reward, quantiles, variance):
+        if reward > self.best_dps:
+            self.best_dps = reward
+            self.best_quantiles = quantiles
+            self.best_variance = variance
+            self.best_rotation = self.evaluator.rotation_names(rotation)
@@ -0,0 +1,157 @@
+"""
+File name: QuantileSketch.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a KLL quantile sketch, which summarizes a stream of numbers in a small, bounded amount of memory
+    and answers approximate quantile queries about it. Values are stored in a stack of compactors. Whenever a compactor
+    fills up its values are sorted and every other one is promoted to the compactor above, where each value stands in for
+    twice as many original values. Lower compactors get smaller capacities than higher ones, which keeps the rank error
+    at about 1/k of the stream no matter how long it gets.
+
+    Sketches are mergeable, so every worker process can build its own and the parent can combine them afterwards with
+    the same accuracy guarantee as a single sketch built over everything. They are also plain picklable objects, so they
+    can be sent back through a process pool as they are.
+
+    The usual KLL sketch flips a coin to decide whether the odd or even values get promoted. We alternate instead, which
+    keeps the sketch deterministic and, more importantly, means it never touches the random module the damage rolls use.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+    def __init__(self, k=200):
+        """
+        :param k: Accuracy parameter. The rank error of a query is roughly 1/k, and memory use grows linearly with k.
+        """
+        self.k = k
+        self.compactors = [[]]
+        self.offsets = [0]
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def update(self, value):
+        """
+        Function to add a value to the sketch.
+        :param value: Number to add.
+        :return: None
+        """
+        self.compactors[0].append(value)
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other):
+        """
+        Function to merge another sketch into this one. The other sketch is left unchanged.
+        :param other: QuantileSketch to merge.
+        :return: This sketch.
+        """
+        if other.count == 0:
+            return self
+
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+            self.offsets.append(0)
+
+        for level, compactor in enumerate(other.compactors):
+            self.compactors[level].extend(compactor)
+
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Function to estimate a quantile of every value added so far.
+        :param q: Quantile to estimate, between 0 and 1.
+        :return: The estimated value, or None if the sketch is empty.
+        """
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        """
+        Function to estimate several quantiles at once, which only needs to sort the sketch once.
+        :param qs: List of quantiles to estimate, each between 0 and 1.
+        :return: A list containing the estimate of each quantile, or Nones if the sketch is empty.
+        """
+        if self.count == 0:
+            return [None for q in qs]
+
+        weighted = []
+        for level, compactor in enumerate(self.compactors):
+            weight = 2**level
+            weighted.extend((value, weight) for value in compactor)
+        weighted.sort()
+
+        total = sum(weight for value, weight in weighted)
+        estimates = []
+        for q in qs:
+            # The extremes are tracked exactly, so there's no need to estimate them.
+            if q <= 0:
+                estimates.append(self.min)
+                continue
+            if q >= 1:
+                estimates.append(self.max)
+                continue
+
+            target = q*total
+            cumulative = 0
+            estimate = self.max
+            for value, weight in weighted:
+                cumulative += weight
+                if cumulative >= target:
+                    estimate = value
+                    break
+            estimates.append(estimate)
+
+        return estimates
+
+    def _capacity(self, level):
+        # Compactors shrink geometrically below the top one, but never below two values.
+        height = len(self.compactors)
+        return max(2, int(math.ceil(self.k * (2/3)**(height - level - 1))))
+
+    def _compress(self):
+        """
+        Function to compact every compactor that is over capacity, promoting half of its values to the level above.
+        :return: None
+        """
+        level = 0
+        while level < len(self.compactors):
+            compactor = self.compactors[level]
+            if len(compactor) >= self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                    self.offsets.append(0)
+
+                compactor.sort()
+
+                # With an odd number of values, one is left behind so the total weight stays exact.
+                leftover = []
+                if len(compactor) % 2 == 1:
+                    leftover.append(compactor.pop())
+
+                offset = self.offsets[level]
+                self.offsets[level] = 1 - offset
+                self.compactors[level + 1].extend(compactor[offset::2])
+                self.compactors[level] = leftover
+
+            level += 1
+
+    def __len__(self):
+        return self.count
+
+    def __str__(self):
+        p10, p50, p90 = self.quantiles((0.1, 0.5, 0.9))
+        return "QuantileSketch(count={}, p10={}, p50={}, p90={})".format(self.count, p10, p50, p90)
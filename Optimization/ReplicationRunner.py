@@ -0,0 +1,339 @@
+"""
+File name: ReplicationRunner.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a runner for comparing optimizer configurations on evidence rather than on single runs. A
+    single training run is very noisy, so every configuration is trained several times (replications), each seeded
+    differently, and the configurations are compared by the spread of their results.
+
+    The configurations are described by a grid in the same format as a sweep (see SweepRunner.py), e.g.
+        {"stdev": [3.0, 6.0], "returns_per_update": [100, 300], "update_rule": ["ga", "es"]}
+    and every cell of the grid is one configuration. Replication k of every configuration uses the same seed, so every
+    configuration starts from the same rotations.
+
+    Budgets are measured in simulated ticks rather than time, so results don't depend on the machine or on how busy it
+    is. Configurations are narrowed down by successive halving:
+        1. Every surviving configuration is trained with every replication seed, up to the budget of this round.
+        2. The best rotation of every run is scored again with fresh fights (the same fresh fights for every run, see
+           RotationEvaluator.crn_seed), since the DPT the optimizer reports for its best rotation is biased upwards by
+           having been picked as the best.
+        3. Only the best 1/eta configurations by mean rescored DPT survive, and the budget is multiplied by eta.
+    This stops once one configuration is left or the maximum budget has been run. Every run records its best DPT after
+    every epoch, which gives the DPT-vs-budget curve of each configuration: the mean across replications of the best DPT
+    found within each budget, with a confidence band.
+
+    Runs are deterministic given their seed, so a run with a bigger budget just carries on past where the same run with
+    a smaller budget stopped. Rather than keeping optimizers alive between rounds, later rounds simply train again from
+    the start. With eta of 2 or more that costs at most as much again as the last round. Each finished run is appended to
+    an optional JSON lines checkpoint, and runs already in it are skipped, so an interrupted comparison can be resumed.
+"""
+
+from Optimization.RotationOptimizer import RotationOptimizer
+from Optimization.RotationEvaluator import RotationEvaluator
+from Optimization.SweepRunner import build_cells
+from Environment.Abilities import AbilityBundle
+import multiprocessing as mp
+import numpy as np
+import random
+import json
+import math
+import time
+import zlib
+import csv
+import os
+
+
+def _run_replication(task):
+    """
+    Function to train one replication of one configuration inside a worker process.
+    :param task: A (config id, replication, budget, config) tuple. The config is complete except for the RNG.
+    :return: A dict describing the run.
+    """
+    config_id, replication, budget, cfg = task
+
+    # Every configuration gets the same seed for the same replication.
+    seed = zlib.crc32("{}|{}".format(cfg.get("seed", 0), replication).encode("utf-8"))
+    random.seed(seed)
+    np.random.seed(seed)
+    cfg["rng"] = np.random.RandomState(seed)
+
+    num_abilities = len(AbilityBundle.load_bundle(cfg.get("ability_folder", "ranged"))["abilities"])
+    cfg.setdefault("num_abilities", num_abilities)
+    cfg.setdefault("rotation_length", num_abilities)
+
+    t1 = time.time()
+    optimizer = RotationOptimizer(cfg)
+    optimizer.initialize()
+
+    # Train one epoch at a time, so the best DPT can be recorded against the ticks spent to find it. The curve starts
+    # from the score of the starting rotation.
+    try:
+        optimizer.evaluate_start()
+        ticks = optimizer.evaluator.total_ticks
+        curve = [[ticks, float(optimizer.best_dps)]]
+        while ticks < budget:
+            result = optimizer.train(num_epochs=1, max_ticks=budget - ticks, verbose=False)
+            ticks = optimizer.evaluator.total_ticks
+            curve.append([ticks, float(optimizer.best_dps)])
+            if result.stop_reason != "epochs":
+                break
+    finally:
+        optimizer.close()
+
+    # Rescore the best rotation with fresh fights. Every run is rescored with the same ones.
+    eval_cfg = dict(cfg)
+    eval_cfg["num_fights"] = cfg.get("replication_eval_fights", 100)
+    eval_cfg["crn_seed"] = cfg.get("seed", 0) + 1000003
+    eval_cfg["evaluation_store"] = None
+    evaluator = RotationEvaluator(eval_cfg)
+    evaluator.initialize()
+    final_dpt = evaluator.evaluate_rotation(evaluator.combat_sim.player.get_rotation_indices(optimizer.best_rotation))
+
+    return {"config": config_id,
+            "replication": replication,
+            "budget": budget,
+            "ticks": ticks,
+            "best_dps": float(optimizer.best_dps),
+            "final_dpt": final_dpt,
+            "final_variance": evaluator.last_evaluation["variance"],
+            "best_rotation": optimizer.best_rotation,
+            "curve": curve,
+            "time": time.time()-t1}
+
+
+class ReplicationRunner(object):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. Everything in it is the base config of every configuration, and the following entries
+                    control the comparison itself:
+                        replication_grid: The grid of configurations. See the description at the top of this file.
+                        replication_count: Number of replications of each configuration.
+                        replication_min_ticks: Budget of every run in the first round, in simulated ticks.
+                        replication_max_ticks: Largest budget any run is given.
+                        replication_eta: Factor the number of configurations is divided by, and the budget multiplied
+                                         by, after every round.
+                        replication_eval_fights: Number of fresh fights the best rotation of every run is rescored with.
+                        replication_checkpoint: Optional path of the JSON lines file finished runs are recorded in.
+                        replication_output: Optional path of the CSV file to write the DPT-vs-budget curves to.
+                        num_workers: Number of worker processes. Every run is trained on a single process.
+        """
+        self.cfg = cfg
+        self.grid = cfg["replication_grid"]
+        self.num_replications = cfg.get("replication_count", 5)
+        self.min_ticks = cfg.get("replication_min_ticks", 2000000)
+        self.max_ticks = cfg.get("replication_max_ticks", 18000000)
+        self.eta = cfg.get("replication_eta", 3)
+        self.num_workers = cfg.get("num_workers") or os.cpu_count()
+        self.checkpoint_path = cfg.get("replication_checkpoint")
+        self.output_path = cfg.get("replication_output")
+
+        if self.eta < 2:
+            raise ValueError("Successive halving needs an eta of at least 2.")
+
+        # The runs of the last round each configuration took part in, keyed by configuration, and a summary of each round.
+        self.results = {}
+        self.rounds = []
+
+        # The position of each configuration in the grid, which breaks ties between configurations with the same mean.
+        self.cell_order = {}
+
+    def run(self):
+        """
+        Function to run successive halving over every configuration in the grid.
+        :return: A list containing the summary of every configuration, best first. See summarize().
+        """
+        cells = build_cells(self.grid)
+        configs = {cell_id: overrides for cell_id, labels, overrides in cells}
+        self.cell_order = {cell_id: i for i, (cell_id, labels, overrides) in enumerate(cells)}
+        completed = self.load_checkpoint()
+
+        base_cfg = {key: value for key, value in self.cfg.items() if key not in ("rng", "replication_grid")}
+        base_cfg["num_workers"] = 1
+
+        for folder in sorted(set(dict(base_cfg, **overrides).get("ability_folder", "ranged")
+                                 for overrides in configs.values())):
+            AbilityBundle.load_bundle(folder)
+
+        survivors = [cell_id for cell_id, labels, overrides in cells]
+        budget = min(self.min_ticks, self.max_ticks)
+        while True:
+            tasks = []
+            for config_id in survivors:
+                for replication in range(self.num_replications):
+                    if (config_id, replication, budget) in completed:
+                        continue
+
+                    cfg = dict(base_cfg)
+                    cfg.update(configs[config_id])
+                    tasks.append((config_id, replication, budget, cfg))
+
+            print("Round {}: {} configurations x {} replications at {} ticks ({} runs already completed)".format(
+                len(self.rounds), len(survivors), self.num_replications, budget,
+                len(survivors)*self.num_replications - len(tasks)))
+
+            if len(tasks) > 0:
+                with mp.Pool(min(self.num_workers, len(tasks))) as pool:
+                    for result in pool.imap_unordered(_run_replication, tasks):
+                        completed[(result["config"], result["replication"], result["budget"])] = result
+                        self.write_checkpoint(result)
+                        print("Finished {} replication {} in {:.2f}s. Rescored DPT: {:.3f}".format(
+                            result["config"], result["replication"], result["time"], result["final_dpt"]))
+
+            for config_id in survivors:
+                self.results[config_id] = [completed[(config_id, replication, budget)]
+                                           for replication in range(self.num_replications)]
+
+            ranked = sorted(survivors, key=lambda config_id: (-self._mean_final(config_id), self.cell_order[config_id]))
+            self.rounds.append({"budget": budget, "ranking": ranked})
+            if len(ranked) <= 1 or budget >= self.max_ticks:
+                break
+
+            survivors = ranked[:max(1, len(ranked) // self.eta)]
+            budget = min(budget*self.eta, self.max_ticks)
+
+        summaries = self.summarize()
+        if self.output_path is not None:
+            self.write_curves(self.output_path)
+
+        return summaries
+
+    def summarize(self, z=1.96):
+        """
+        Function to summarize the last round every configuration took part in, and compare it with the best one.
+        :param z: Number of standard errors on either side of the confidence intervals. The default gives 95%.
+        :return: A list of dicts, best configuration first. Each holds the configuration, the budget of its last round,
+                 the mean rescored DPT of its runs with a confidence interval, and the difference from the best
+                 configuration with a confidence interval. Replication k of every configuration starts from the same
+                 seed, so the interval is computed from the differences between each pair of replications, which
+                 cancels the luck they share. The best configuration's difference from itself is exactly 0.
+        """
+        summaries = []
+        for config_id, runs in self.results.items():
+            final = np.array([run["final_dpt"] for run in runs])
+            summaries.append({"config": config_id,
+                              "budget": runs[0]["budget"],
+                              "runs": len(runs),
+                              "mean": float(final.mean()),
+                              "stderr": _standard_error(final),
+                              "best_dps_mean": float(np.mean([run["best_dps"] for run in runs]))})
+
+        # Configurations that went further come first, since they beat everything dropped before them. Ties go to the
+        # configuration that comes first in the grid, just like the ranking of each round.
+        summaries.sort(key=lambda summary: (-summary["budget"], -summary["mean"],
+                                            self.cell_order.get(summary["config"], 0)))
+        best_final = self._finals(summaries[0]["config"])
+        for summary in summaries:
+            summary["interval"] = [summary["mean"] - z*summary["stderr"], summary["mean"] + z*summary["stderr"]]
+            differences = self._finals(summary["config"]) - best_final
+            difference = float(differences.mean())
+            stderr = _standard_error(differences)
+            summary["difference"] = difference
+            summary["difference_interval"] = [difference - z*stderr, difference + z*stderr]
+
+        return summaries
+
+    def get_curves(self, num_points=20, z=1.96):
+        """
+        Function to compute the DPT-vs-budget curve of every configuration from the runs of its last round.
+        :param num_points: Number of evenly spaced budgets to evaluate each curve at.
+        :param z: Number of standard errors on either side of the confidence band. The default gives 95%.
+        :return: A list of dicts, each holding a configuration, a budget, and the mean, lower and upper bound of the best
+                 DPT its runs had found within that budget. Budgets before every run had scored a rotation are skipped.
+        """
+        rows = []
+        for config_id, runs in self.results.items():
+            budget = runs[0]["budget"]
+            for point in range(1, num_points + 1):
+                ticks = budget*point / num_points
+                values = []
+                for run in runs:
+                    found = [dpt for run_ticks, dpt in run["curve"] if run_ticks <= ticks]
+                    if len(found) > 0:
+                        values.append(found[-1])
+
+                if len(values) < len(runs):
+                    continue
+
+                values = np.array(values)
+                mean = float(values.mean())
+                stderr = _standard_error(values)
+                rows.append({"config": config_id, "ticks": int(ticks), "mean": mean,
+                             "lower": mean - z*stderr, "upper": mean + z*stderr, "runs": len(runs)})
+
+        return rows
+
+    def write_curves(self, path):
+        columns = ["config", "ticks", "mean", "lower", "upper", "runs"]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in self.get_curves():
+                writer.writerow([row[column] for column in columns])
+
+    def load_checkpoint(self):
+        """
+        Function to read every finished run from the checkpoint file, if there is one.
+        :return: A dict mapping (config id, replication, budget) to results.
+        """
+        completed = {}
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return completed
+
+        with open(self.checkpoint_path, 'r') as f:
+            for text in f:
+                # A line cut short by an interrupted write is just a run we'll have to do again.
+                try:
+                    result = json.loads(text.strip())
+                except ValueError:
+                    continue
+
+                completed[(result["config"], result["replication"], result["budget"])] = result
+
+        return completed
+
+    def write_checkpoint(self, result):
+        if self.checkpoint_path is None:
+            return
+
+        with open(self.checkpoint_path, 'a') as f:
+            f.write("{}\n".format(json.dumps(result)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def format_report(self):
+        """
+        Function to format the comparison as a plain text report: one line per round, then one line per configuration,
+        best first.
+        :return: The report as a string.
+        """
+        lines = []
+        for i, round_summary in enumerate(self.rounds):
+            lines.append("Round {} at {} ticks: {}".format(i, round_summary["budget"],
+                                                           " > ".join(round_summary["ranking"])))
+
+        lines.append("")
+        for summary in self.summarize():
+            lines.append("{:.3f} DPT (95% CI {:.3f} to {:.3f}), {:+.3f} from the best (95% CI {:+.3f} to {:+.3f}) over "
+                         "{} runs of {} ticks: {}".format(summary["mean"], summary["interval"][0],
+                                                          summary["interval"][1], summary["difference"],
+                                                          summary["difference_interval"][0],
+                                                          summary["difference_interval"][1], summary["runs"],
+                                                          summary["budget"], summary["config"]))
+
+        return "\n".join(lines)
+
+    def _mean_final(self, config_id):
+        return float(np.mean([run["final_dpt"] for run in self.results[config_id]]))
+
+    def _finals(self, config_id):
+        # The rescored DPT of every run, in order of replication.
+        runs = sorted(self.results[config_id], key=lambda run: run["replication"])
+        return np.array([run["final_dpt"] for run in runs])
+
+
+def _standard_error(values):
+    if len(values) < 2:
+        return 0.0
+    return float(np.std(values, ddof=1) / math.sqrt(len(values)))
@@ -10,45 +10,540 @@ Description:
 
 from Environment import CombatSimulator
 from Environment.Game import Enemy, Player
+from Environment.Game.RotationPolicy import decode_name
+from Environment.Abilities import RollSource
+from Optimization.QuantileSketch import QuantileSketch
+import multiprocessing as mp
+import hashlib
+import random
+import math
+import sys
+
+# Quantiles of the per-fight DPT reported for every rotation.
+QUANTILES = (0.1, 0.5, 0.9)
+
+
+def make_worker_counter():
+    """
+    Function to make the counter build_worker_evaluator() numbers the workers of a pool with. It must be handed to
+    every worker through the pool's initializer.
+    :return: A shared integer, starting at 0.
+    """
+    return mp.Value("i", 0)
+
+
+def build_worker_evaluator(cfg, worker_counter):
+    """
+    Function to build an evaluator inside a worker process. Forked workers inherit the RNG state of their parent, so
+    every worker would roll exactly the same damage unless we reseed them here. Each worker takes the next index from
+    the pool's counter and is seeded from that and cfg["seed"], so the same seed always gives a pool the same workers.
+    :param cfg: Config dict to build the evaluator with.
+    :param worker_counter: The pool's counter, from make_worker_counter().
+    :return: An initialized RotationEvaluator.
+    """
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+
+    seed = (cfg.get("seed", 0) * 7919 + worker_index) % (2**32)
+    random.seed(seed)
+
+    # Only reseed numpy if something has already imported it. There's no reason to import it just to seed it.
+    if "numpy" in sys.modules:
+        sys.modules["numpy"].random.seed(seed)
+
+    # Only the parent process reads and writes the evaluation store.
+    cfg = dict(cfg)
+    cfg["evaluation_store"] = None
+
+    evaluator = RotationEvaluator(cfg)
+    evaluator.initialize()
+    return evaluator
 
 
 class RotationEvaluator(object):
-    def __init__(self):
+    def __init__(self, cfg=None):
+        if cfg is None:
+            cfg = {}
+
+        self.cfg = cfg
         self.ability_list = None
         self.combat_sim = None
 
+        # Number of fights to average over, and the length (in ticks) of each fight.
+        self.num_fights = cfg.get("num_fights", 10)
+        self.fight_length = cfg.get("fight_length", 1000//2)
+        _check_fight_length(self.fight_length)
+
+        # The weapon speed and ability folder of the player being simulated, and the enemy they are fighting.
+        self.attack_delay = cfg.get("attack_delay", 3)
+        self.ability_folder = cfg.get("ability_folder", "ranged")
+        self.stun_immune = cfg.get("stun_immune", False)
+        self.num_targets = cfg.get("num_targets", 1)
+
+        # What we are trying to maximize. This is either "dpt", or "ttk" to minimize the time it takes to kill an enemy
+        # with enemy_hp health. See evaluate_kill_time().
+        self.objective = cfg.get("objective", "dpt")
+        self.enemy_hp = cfg.get("enemy_hp", None)
+        if self.objective == "ttk" and self.enemy_hp is None:
+            raise ValueError("The time-to-kill objective needs an enemy_hp.")
+
+        # The best mean kill time seen so far, and whether to abort fights that can no longer beat it. Each evaluator
+        # keeps its own, so SharedMemoryEvaluator sends its workers the best kill time of the whole pool with every
+        # range and takes back the best each of them has seen.
+        self.best_kill_ticks = None
+        self.ttk_cutoff = cfg.get("ttk_cutoff", True)
+
+        # Variance reduction mode. This is either None, "antithetic" or "control_variate".
+        self.variance_reduction = cfg.get("variance_reduction", None)
+        self.roll_source = None
+
+        # If this is set, fight i of every rotation is seeded from it, so every rotation is scored with the same random
+        # rolls (common random numbers). The difference between two rotations is then far less noisy than either score.
+        self.crn_seed = cfg.get("crn_seed", None)
+
+        # Total number of ticks this evaluator has simulated, and the budget (if any) they are charged to. See Budget.py.
+        self.total_ticks = 0
+        self.budget = None
+
+        # Details about the most recent call to evaluate_rotation(), beyond the DPT it returned.
+        self.last_evaluation = None
+
+        # Details about the most recent call to evaluate_rotations(). These are the per-fight DPT quantiles of each
+        # rotation, the estimated variance of each returned DPT, and a sketch of the DPT of every fight in the batch.
+        # The number of times each ability was cast by each rotation is recorded too, unless it is None, and so is
+        # whether each score is censored (see evaluate_kill_time()).
+        self.batch_quantiles = []
+        self.batch_variances = []
+        self.batch_casts = []
+        self.batch_censored = []
+        self.batch_sketch = None
+
+        # Path of the persistent evaluation store, the store itself, and the results waiting to be written to it. See
+        # EvaluationStore.py. Kill times cut short by the cutoff are only bounds, so they can't be stored.
+        self.store_path = cfg.get("evaluation_store", None)
+        if self.store_path is not None and self.objective == "ttk" and self.ttk_cutoff:
+            raise ValueError("The evaluation store can't be used with the time-to-kill cutoff.")
+
+        self.store = None
+        self.store_ability_hash = None
+        self.store_scenario = None
+        self.pending_store = []
+
     def initialize(self):
-        player = Player(3)
-        enemy = Enemy()
+        player = Player(self.attack_delay)
+        enemy = Enemy(self.enemy_hp, self.stun_immune, self.num_targets)
 
-        player.load_all_abilities("ranged")
+        player.load_all_abilities(self.ability_folder)
+
+        # Antithetic sampling needs to control every damage roll, so all our abilities share one roll source.
+        if self.variance_reduction == "antithetic":
+            self.roll_source = RollSource()
+            for ability in player.abilities + [player.auto_attack]:
+                ability.roll_source = self.roll_source
 
         sim = CombatSimulator(player, enemy)
         self.combat_sim = sim
 
-    def evaluate_rotation(self, rotation):
+        if self.store_path is not None:
+            from Optimization.EvaluationStore import EvaluationStore, get_scenario
+            from Environment.Abilities import AbilityBundle
+            self.store = EvaluationStore(self.store_path)
+            self.store_ability_hash = AbilityBundle.get_data_hash(self.ability_folder)
+            self.store_scenario = get_scenario(self)
+
+    def lookup_stored(self, keys):
+        """
+        Function to fetch the results of previous runs from the evaluation store. Results measured over fewer fights
+        than this evaluator uses are ignored, so they get simulated again and refined.
+        :param keys: A list of canonical keys. See canonicalize().
+        :return: A dict mapping each key with a usable stored result to its (DPT, quantiles, variance) tuple. This is empty
+                 if there is no store.
+        """
+        if self.store is None or len(keys) == 0:
+            return {}
+
+        stored = self.store.lookup(self.store_ability_hash, self.store_scenario, keys)
+        return {key: (result["mean"], result["quantiles"], result["variance"]) for key, result in stored.items()
+                if result["samples"] >= self.num_fights}
+
+    def queue_stored(self, keys, rotations, dpts, variances, quantiles):
+        """
+        Function to queue full-length results to be written to the evaluation store by the next flush_store().
+        :param keys: Canonical key of each rotation.
+        :param rotations: Each rotation, as a list of ability indices.
+        :param dpts: DPT of each rotation.
+        :param variances: Estimated variance of each DPT.
+        :param quantiles: Per-fight DPT quantiles of each rotation.
+        :return: None
+        """
+        if self.store is None:
+            return
+
+        for key, rotation, dpt, variance, rotation_quantiles in zip(keys, rotations, dpts, variances, quantiles):
+            names = self.rotation_names(self._prune(rotation))
+            self.pending_store.append((key, names, self.num_fights, float(dpt), float(variance), rotation_quantiles))
+
+    def flush_store(self):
+        """
+        Function to write every queued result to the evaluation store in one transaction.
+        :return: The number of results written.
+        """
+        if self.store is None or len(self.pending_store) == 0:
+            return 0
+
+        num = len(self.pending_store)
+        self.store.write(self.store_ability_hash, self.store_scenario, self.pending_store)
+        self.pending_store = []
+        return num
+
+    def canonicalize_rotations(self, rotations):
+        """
+        Function to compute the canonical key of a whole batch of rotations. See canonicalize().
+        :param rotations: A list of rotations, or a 2D integer array with one rotation per row padded with -1.
+        :return: A list containing the key of each rotation, in the same order as the input.
+        """
+        return [self.canonicalize(rotation) for rotation in _as_lists(rotations)]
+
+    def canonicalize(self, rotation):
+        """
+        Function to compute a key which is equal for any two rotations that produce exactly the same fight. Lots of
+        different priority orders do, because abilities at the end of the bar may never get a chance to fire, and the
+        order of abilities whose cooldowns never line up doesn't matter. The key is a hash of the sequence of casts made
+        during one fight in which every ability deals exactly its mean damage, so it costs no random rolls and is only
+        a fraction of the price of a real evaluation. That fight always runs for the whole fight length, even against
+        an enemy with a health pool, because real rolls can make a fight last longer than one with mean rolls does.
+        :param rotation: A list of ability indices.
+        :return: A 64-bit integer key.
+        """
+        player = self.combat_sim.player
+        player.set_rotation(self._prune(rotation))
+
+        # Swap every ability over to a roll source which always rolls the mean, and put things back afterwards.
+        abilities = player.abilities + [player.auto_attack]
+        roll_sources = [ability.roll_source for ability in abilities]
+        mean_source = RollSource()
+        mean_source.use_mean()
+        for ability in abilities:
+            ability.roll_source = mean_source
+
+        # Two rotations which only differ after the enemy would have died with mean rolls still make different fights,
+        # so the enemy's health pool is taken away for this fight too.
+        target = self.combat_sim.target
+        hp = target.hp
+        target.hp = None
+
+        cast_log = []
+        self.combat_sim.cast_log = cast_log
+        try:
+            self.combat_sim.simulate(self.fight_length)
+        finally:
+            self.combat_sim.cast_log = None
+            target.hp = hp
+            for ability, roll_source in zip(abilities, roll_sources):
+                ability.roll_source = roll_source
+
+        self._spend(self.combat_sim.ticks_simulated)
+        digest = hashlib.blake2b("|".join(cast_log).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def evaluate_rotations(self, rotations, fight_length=None):
+        """
+        Function to evaluate a whole batch of rotations. This just evaluates each one in turn, but it gives the optimizer
+        a single entry point that parallel evaluators can override.
+        :param rotations: A list of rotations, or a 2D integer array with one rotation per row padded with -1.
+        :param fight_length: Optional length of each fight in ticks. Defaults to the length from the config object.
+        :return: A list containing the DPT of each rotation, in the same order as the input. The quantiles, variance,
+                 cast counts and censoring of each rotation and a sketch of every fight are recorded in
+                 self.batch_quantiles, self.batch_variances, self.batch_casts, self.batch_censored and
+                 self.batch_sketch.
+        """
+        results = []
+        self.batch_quantiles = []
+        self.batch_variances = []
+        self.batch_casts = []
+        self.batch_censored = []
+        self.batch_sketch = QuantileSketch()
+        for rotation in _as_lists(rotations):
+            results.append(self.evaluate_rotation(rotation, fight_length))
+            self.batch_quantiles.append(self.last_evaluation["quantiles"])
+            self.batch_variances.append(self.last_evaluation["variance"])
+            self.batch_casts.append(self.last_evaluation["casts"])
+            self.batch_censored.append(self.last_evaluation["censored"])
+            self.batch_sketch.merge(self.last_evaluation["sketch"])
+
+        return results
+
+    def evaluate_rotation(self, rotation, fight_length=None):
+        """
+        Function to evaluate a rotation in the simulation. The number and length of the fights used are taken from the
+        config object.
+        :param rotation: A list of ability indices representing the rotation to be tested.
+        :param fight_length: Optional length of each fight in ticks, overriding the one from the config object. Shorter
+                             fights are used to cheaply screen out weak rotations.
+        :return: The average damage-per-tick (DPT) that this rotation produced. The number of times each ability was
+                 cast over every fight, the DPT of each fight, a sketch and the QUANTILES of the per-fight DPT, the
+                 estimated variance of the returned DPT, and the fraction of variance removed by the variance reduction
+                 mode are recorded in self.last_evaluation.
+        """
+        if fight_length is not None:
+            _check_fight_length(fight_length)
+
+        if self.objective == "ttk":
+            return self.evaluate_kill_time(rotation, fight_length)
+
+        # Set the player's rotation and run the simulation.
+        player = self.combat_sim.player
+        target = self.combat_sim.target
+        player.set_rotation(self._prune(rotation))
+        iters = self.num_fights
+        iter_length = self.fight_length if fight_length is None else fight_length
+        fight_dpts = []
+        control_variates = []
+        casts = {}
+
+        # Antithetic fights come in pairs, so we need an even number of them.
+        antithetic = self.variance_reduction == "antithetic"
+        if antithetic:
+            iters += iters % 2
+
+        for i in range(iters):
+            self._seed_fight(i)
+            if antithetic:
+                if i % 2 == 0:
+                    self.roll_source.record()
+                else:
+                    self.roll_source.replay_antithetic()
+
+            # Fights against an enemy with a health pool can end early, so we divide by the ticks actually simulated.
+            damage = self.combat_sim.simulate(iter_length)
+            ticks = self.combat_sim.ticks_simulated
+            self._spend(ticks)
+            fight_dpts.append(damage / ticks)
+
+            # The difference between the damage we did and the damage we would have done had every cast rolled its mean
+            # has a known expected value of zero, which makes it a good control variate.
+            control_variates.append((damage - target.expected_damage_taken) / ticks)
+            self._count_casts(casts)
+
+        dpt, variance, plain_variance = self.combine_fights(fight_dpts, control_variates)
+
+        variance_reduction = 0
+        if plain_variance > 0:
+            variance_reduction = 1 - variance / plain_variance
+
+        sketch = self._sketch_fights(fight_dpts)
+        self.last_evaluation = {"dpt": dpt,
+                                "casts": casts,
+                                "fights": fight_dpts,
+                                "sketch": sketch,
+                                "quantiles": sketch.quantiles(QUANTILES),
+                                "variance": variance,
+                                "variance_reduction": variance_reduction,
+                                "censored": False}
+        return dpt
+
+    def evaluate_kill_time(self, rotation, fight_length=None):
         """
-        Function to evaluate a rotation in the simulation. These hyper-parameters will eventually be handled by the config
-        object.
+        Function to evaluate how quickly a rotation kills an enemy with enemy_hp health. A fight that hasn't killed the
+        enemy by the end of its fight length is counted as taking one tick longer than that.
+
+        Once we have seen the best mean kill time of any rotation, every evaluation gets a budget of that many ticks per
+        fight, shared across all of its fights. As soon as the budget runs out the rotation can no longer be strictly
+        better than the best one, so the fight is aborted and the remaining fights are skipped. This makes bad rotations
+        much cheaper to evaluate than good ones.
+
         :param rotation: A list of ability indices representing the rotation to be tested.
-        :return: The average damage-per-tick (DPT) that this rotation produced.
+        :param fight_length: Optional maximum length of each fight in ticks, overriding the one from the config object.
+        :return: The enemy's health divided by the mean kill time, so that faster kills give higher scores and the score
+                 is measured in the same units as DPT. The mean kill time and its variance, whether the evaluation was
+                 aborted, whether it was censored (some fight ended without a kill, so the score is only an upper
+                 bound), the number of ticks actually simulated, the estimated variance of the score, and a sketch and
+                 the QUANTILES of the per-fight score are recorded in self.last_evaluation.
         """
+        player = self.combat_sim.player
+        player.set_rotation(self._prune(rotation))
+        iters = self.num_fights
+        iter_length = self.fight_length if fight_length is None else fight_length
+        kill_ticks = []
+        casts = {}
+        censored = False
+
+        antithetic = self.variance_reduction == "antithetic"
+        if antithetic:
+            iters += iters % 2
 
-        # Duplicates can occur in these randomly generated rotations, so we will first prune all duplicates, keeping only
-        # the earliest occurrence of each ability index.
+        # To be strictly better than the best rotation, the total kill time over every fight must stay below this.
+        budget = None
+        if self.ttk_cutoff and self.best_kill_ticks is not None:
+            budget = self.best_kill_ticks * iters
+
+        total_ticks = 0
+        aborted = False
+        for i in range(iters):
+            self._seed_fight(i)
+            if antithetic:
+                if i % 2 == 0:
+                    self.roll_source.record()
+                else:
+                    self.roll_source.replay_antithetic()
+
+            max_ticks = iter_length
+            if budget is not None:
+                max_ticks = min(max_ticks, math.ceil(budget - total_ticks))
+
+            self.combat_sim.simulate(max_ticks)
+            ticks = self.combat_sim.ticks_simulated
+            self._spend(ticks)
+            self._count_casts(casts)
+
+            if self.combat_sim.target.is_dead():
+                kill_ticks.append(ticks)
+                total_ticks += ticks
+                continue
+
+            # The enemy survived every tick we gave it, so the real kill time is at least one tick longer.
+            kill_ticks.append(ticks + 1)
+            total_ticks += ticks + 1
+            censored = True
+            if max_ticks < iter_length:
+                aborted = True
+                break
+
+        mean_kill_ticks = total_ticks / len(kill_ticks)
+
+        # A rotation that ran every fight to the end is the new benchmark if it killed faster than anything before it.
+        if not aborted and not censored and (self.best_kill_ticks is None or mean_kill_ticks < self.best_kill_ticks):
+            self.best_kill_ticks = mean_kill_ticks
+
+        # The score is enemy_hp / mean kill time, so its variance follows from the variance of the mean kill time by the
+        # delta method.
+        kill_ticks_variance = _sample_variance(kill_ticks) / len(kill_ticks)
+        variance = kill_ticks_variance * (self.enemy_hp / mean_kill_ticks**2)**2
+
+        sketch = self._sketch_fights([self.enemy_hp / ticks for ticks in kill_ticks])
+        self.last_evaluation = {"dpt": self.enemy_hp / mean_kill_ticks,
+                                "casts": casts,
+                                "sketch": sketch,
+                                "quantiles": sketch.quantiles(QUANTILES),
+                                "kill_ticks": kill_ticks,
+                                "mean_kill_ticks": mean_kill_ticks,
+                                "aborted": aborted,
+                                "censored": censored,
+                                "ticks_simulated": total_ticks,
+                                "kill_ticks_variance": kill_ticks_variance,
+                                "variance": variance,
+                                "variance_reduction": 0}
+        return self.enemy_hp / mean_kill_ticks
+
+    def combine_fights(self, fight_dpts, control_variates):
+        """
+        Function to combine the results of every fight into one estimate of the DPT of a rotation, using whichever
+        variance reduction mode this evaluator was configured with.
+        :param fight_dpts: The DPT of each fight.
+        :param control_variates: The control variate measured during each fight.
+        :return: The DPT estimate, the estimated variance of that estimate, and the estimated variance the plain average
+                 of the same number of independent fights would have had.
+        """
+        num = len(fight_dpts)
+        mean = sum(fight_dpts) / num
+        plain_variance = _sample_variance(fight_dpts) / num
+
+        if self.variance_reduction == "antithetic":
+            # Each pair of mirrored fights is one independent sample.
+            pair_means = [(fight_dpts[i] + fight_dpts[i+1]) / 2 for i in range(0, num - 1, 2)]
+            return mean, _sample_variance(pair_means) / len(pair_means), plain_variance
+
+        if self.variance_reduction == "control_variate":
+            # Regress the DPT of each fight on its control variate and remove the part the control variate explains.
+            mean_cv = sum(control_variates) / num
+            cv_variance = _sample_variance(control_variates)
+            beta = 0
+            if cv_variance > 0:
+                covariance = sum((y - mean)*(c - mean_cv) for y, c in zip(fight_dpts, control_variates)) / (num - 1)
+                beta = covariance / cv_variance
+
+            adjusted = [y - beta*c for y, c in zip(fight_dpts, control_variates)]
+            return mean - beta*mean_cv, _sample_variance(adjusted) / num, plain_variance
+
+        return mean, plain_variance, plain_variance
+
+
+    def _spend(self, ticks):
+        """
+        Function to charge simulated ticks to this evaluator's budget, if it has one, and stop as soon as it runs out.
+        :param ticks: Number of ticks just simulated.
+        :return: None
+        """
+        self.total_ticks += ticks
+        if self.budget is not None:
+            self.budget.spend(ticks)
+            self.budget.check()
+
+    def _seed_fight(self, fight):
+        if self.crn_seed is not None:
+            random.seed(self.crn_seed*7919 + fight)
+
+    def _sketch_fights(self, values):
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.update(value)
+        return sketch
+
+    def _count_casts(self, casts):
+        """
+        Function to add the number of times each ability was cast during the last fight to a running total. Every
+        ability counts its own casts until it is next reset, which happens at the start of each fight.
+        :param casts: Dict mapping ability names to cast counts, which is updated in place.
+        :return: None
+        """
+        player = self.combat_sim.player
+        for ability in player.abilities + [player.auto_attack]:
+            if ability.num_casts > 0:
+                casts[ability.name] = casts.get(ability.name, 0) + ability.num_casts
+
+    def rotation_names(self, rotation):
+        """
+        Function to translate a rotation into ability names, including any conditions its entries carry.
+        :param rotation: A list of ability indices, possibly encoded with conditions. See RotationPolicy.py.
+        :return: A list of names, which Player.get_rotation_indices() translates back.
+        """
+        ability_names = [ability.name for ability in self.combat_sim.player.abilities]
+        return [decode_name(arg, ability_names) for arg in rotation]
+
+    def _prune(self, rotation):
+        """
+        Function to prune duplicates from a rotation. Duplicates can occur in randomly generated rotations, so we keep
+        only the earliest occurrence of each ability index. Padding (-1) is dropped too.
+        :param rotation: A list of ability indices.
+        :return: The pruned rotation.
+        """
         pruned_rotation = []
         for arg in rotation:
-            if arg not in pruned_rotation:
+            if arg >= 0 and arg not in pruned_rotation:
                 pruned_rotation.append(arg)
 
-        # Set the player's rotation and run the simulation.
-        self.combat_sim.player.rotation = pruned_rotation
-        iters = 10
-        iter_length = 1000//2
-        dpt = 0
+        return pruned_rotation
 
-        for i in range(iters):
-            dpt += self.combat_sim.simulate(iter_length)
 
-        dpt /= (iters*iter_length)
-        return dpt
\ No newline at end of file
+def _as_lists(rotations):
+    # Converting a whole population matrix to Python ints at once is much faster than pulling numpy scalars out one at
+    # a time, and it avoids importing numpy just to check the type.
+    if hasattr(rotations, "tolist"):
+        return rotations.tolist()
+    return rotations
+
+
+def _check_fight_length(fight_length):
+    # DPT is divided by the number of ticks simulated, so a fight has to last at least one.
+    if fight_length <= 0:
+        raise ValueError("Fights must be at least one tick long, not {}".format(fight_length))
+
+
+def _sample_variance(values):
+    num = len(values)
+    if num < 2:
+        return 0
+
+    mean = sum(values) / num
+    return sum((value - mean)**2 for value in values) / (num - 1)
@@ -6,8 +6,14 @@ Date: 7/12/20
 Description:
     This file implements a rotation generating object which will be used to generate rotations that we want to test during
     the optimization process.
+
+    Whole populations are generated as a single int16 matrix with one rotation per row, which can be handed straight to
+    the evaluators (see SharedMemoryEvaluator.py) without building a Python list per rotation. Duplicates are pruned
+    by replacing every repeated entry with -1, the same padding the evaluators already strip, so every row keeps the
+    same width.
 """
 
+from Environment.Game.RotationPolicy import CONDITIONS
 import numpy as np
 
 class RotationGenerator(object):
@@ -16,6 +22,11 @@ class RotationGenerator(object):
         self.num_abilities = cfg["num_abilities"]
         self.rotation_length = min(self.num_abilities, cfg["rotation_length"])
 
+        # Whether rotations carry conditions (see RotationPolicy.py), and how often perturbing a rotation changes the
+        # condition of each entry.
+        self.conditional = cfg.get("conditional", False)
+        self.condition_mutation_rate = cfg.get("condition_mutation_rate", 0.1)
+
     def generate_rotation(self):
         """
         Function to generate a rotation from scratch. This will produce one random valid rotation containing no duplicates.
@@ -23,31 +34,132 @@ class RotationGenerator(object):
         """
 
         rng = self.cfg["rng"]
-        available_numbers = [i for i in range(self.num_abilities)]
-        rotation = []
-
-        while len(rotation) < self.rotation_length:
-            idx = rng.randint(0, len(available_numbers))
-            rotation.append(available_numbers.pop(idx))
-
-        return rotation
+        return rng.permutation(self.num_abilities)[:self.rotation_length].tolist()
 
-    def perturb_rotation(self, rotation):
+    def perturb_rotation(self, rotation, stdev=None):
         """
         Function to randomly perturb an existing rotation. This is not guaranteed to produce a rotation containing no
         duplicates.
         :param rotation: Rotation to perturb.
+        :param stdev: Optional standard deviation of the noise. Defaults to the one in the config object.
         :return: The perturbed rotation, and the vector of Gaussian noise used to perturb it.
         """
         rng = self.cfg["rng"]
-        std = self.cfg["stdev"]
+        std = self.cfg["stdev"] if stdev is None else stdev
         noise = rng.randn(self.rotation_length) * std
 
-        perturbed = np.add(rotation, noise)
+        # The noise only moves abilities around. Each entry keeps the condition of the slot it lands in, unless that
+        # gets mutated too.
+        abilities = [arg % self.num_abilities for arg in rotation]
+        perturbed = np.add(abilities, noise)
         perturbation = self.force_valid_rotation(perturbed)
 
+        if self.conditional:
+            conditions = [arg // self.num_abilities for arg in rotation]
+            mutated = rng.uniform(size=len(conditions)) < self.condition_mutation_rate
+            for i in np.flatnonzero(mutated):
+                conditions[i] = rng.randint(len(CONDITIONS))
+
+            perturbation = [arg + self.num_abilities*condition for arg, condition in zip(perturbation, conditions)]
+
         return perturbation, noise
 
+    def perturb_population(self, rotation, num, stdev=None):
+        """
+        Function to perturb an existing rotation many times at once. This is the same as calling perturb_rotation() num
+        times, but all of the noise is drawn, rounded and clipped as one matrix.
+        :param rotation: Rotation to perturb.
+        :param num: Number of perturbations to make.
+        :param stdev: Optional standard deviation of the noise. Defaults to the one in the config object.
+        :return: An int16 matrix with one perturbed rotation per row. Rows may contain duplicates. See prune_population().
+        """
+        rng = self.cfg["rng"]
+        std = self.cfg["stdev"] if stdev is None else stdev
+        rotation = np.asarray(rotation, dtype=np.int16)
+        noise = rng.randn(num, len(rotation)) * std
+
+        population = self.force_valid_rotations(rotation % self.num_abilities + noise)
+        if self.conditional:
+            mutated = rng.uniform(size=population.shape) < self.condition_mutation_rate
+            conditions = np.where(mutated, rng.randint(len(CONDITIONS), size=population.shape),
+                                  rotation // self.num_abilities)
+            population += (self.num_abilities*conditions).astype(np.int16)
+
+        return population
+
+    def prune_population(self, population):
+        """
+        Function to prune duplicates from every row of a population matrix at once. Like RotationEvaluator._prune(), only
+        the earliest occurrence of each entry is kept, and the rest are replaced with -1.
+        :param population: 2D integer array with one rotation per row.
+        :return: A pruned int16 copy of the population.
+        """
+        # A stable sort keeps equal entries in their original order, so every entry equal to the one before it in
+        # sorted order is a later duplicate.
+        order = np.argsort(population, axis=1, kind="stable")
+        ordered = np.take_along_axis(population, order, axis=1)
+        duplicate = np.zeros(population.shape, dtype=np.bool_)
+        duplicate[:, 1:] = ordered[:, 1:] == ordered[:, :-1]
+
+        pruned = np.array(population, dtype=np.int16)
+        np.put_along_axis(pruned, order, np.where(duplicate, -1, ordered), axis=1)
+        return pruned
+
+    def neighborhood(self, rotation):
+        """
+        Function to enumerate every rotation one small move away from a rotation. The moves are swapping any two
+        abilities, taking any ability out and inserting it at any other position, and (if the rotation doesn't use every
+        ability) replacing any ability with one that isn't used. Conditional rotations can also change the condition of
+        any entry.
+        :param rotation: Rotation to start from. This should not contain duplicates.
+        :return: A list of neighboring rotations, without duplicates and not including the rotation itself.
+        """
+        rotation = list(rotation)
+        length = len(rotation)
+        used = set(arg % self.num_abilities for arg in rotation)
+        unused = [arg for arg in range(self.num_abilities) if arg not in used]
+        seen = {tuple(rotation)}
+        neighbors = []
+
+        def add(neighbor):
+            key = tuple(neighbor)
+            if key not in seen:
+                seen.add(key)
+                neighbors.append(neighbor)
+
+        for i in range(length):
+            for j in range(i + 1, length):
+                swapped = list(rotation)
+                swapped[i], swapped[j] = swapped[j], swapped[i]
+                add(swapped)
+
+        # Moving to an adjacent position is the same as a swap, which is caught by the duplicate check.
+        for i in range(length):
+            removed = rotation[:i] + rotation[i + 1:]
+            for j in range(length):
+                if j != i:
+                    add(removed[:j] + [rotation[i]] + removed[j:])
+
+        for i in range(length):
+            for arg in unused:
+                add(rotation[:i] + [arg] + rotation[i + 1:])
+
+        if self.conditional:
+            for i in range(length):
+                for condition in range(len(CONDITIONS)):
+                    add(rotation[:i] + [rotation[i] % self.num_abilities + self.num_abilities*condition] +
+                        rotation[i + 1:])
+
+        return neighbors
+
+    def force_valid_rotations(self, rotations):
+        """
+        Function to force every row of a matrix of rotations to be valid at once. See force_valid_rotation().
+        :param rotations: 2D array with one rotation per row.
+        :return: An int16 matrix of valid rotations.
+        """
+        return np.clip(np.round(rotations), 0, self.num_abilities-1).astype(np.int16)
+
     def force_valid_rotation(self, rotation):
         """
         Function to force a rotation to be valid. This is basically just used to round floats into ints and clamp every
@@ -57,6 +169,5 @@ class RotationGenerator(object):
         """
         rounded = np.round(rotation)  # 0 decimal places by default
         clamped = np.clip(rounded, a_min=0, a_max=self.num_abilities-1)
-        int_rotation = [int(arg) for arg in clamped]
 
-        return int_rotation
\ No newline at end of file
+        return clamped.astype(np.int64).tolist()
\ No newline at end of file
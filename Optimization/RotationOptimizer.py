@@ -5,19 +5,32 @@ Date: 7/12/20
 
 Description:
     This file implements the optimizer to be used when optimizing a rotation. There are two optimization algorithms
-    currently implemented. One of them approximates the gradient of DPT as a function of the rotation parameters, then
-    follows that naively using SGD. The other optimizer is a simple genetic algorithm which randomly perturbs the
-    highest-scoring rotation at every update, gradually decreasing the size of the perturbations as it improves.
+    currently implemented, selected by cfg["update_rule"]. The default ("ga") is a simple genetic algorithm which
+    randomly perturbs the highest-scoring rotation at every update, gradually decreasing the size of the perturbations
+    as it improves. The other ("es") is an evolution strategy, which approximates the gradient of DPT as a function of
+    continuous rotation parameters and follows it. See es_epoch().
 """
 
-from Optimization import RotationGenerator, RotationEvaluator
+from Optimization import RotationGenerator, RotationEvaluator, SharedMemoryEvaluator, MetricsLogger
+from Optimization.StreamingEvaluator import read_best_results
+from Optimization.RotationEvaluator import QUANTILES
+from Optimization.Budget import Budget, BudgetExhausted
+from Optimization.MemoryProfiler import MemoryProfiler, format_sample
 
 import numpy as np
+import collections
+import json
 import time
+import os
 
 
 class RotationOptimizer(object):
     def __init__(self, cfg):
+        # The evolution strategy relaxes every entry of a rotation into one continuous ability index, and an encoded
+        # condition isn't anywhere near the abilities it is close to in that space.
+        if cfg.get("update_rule", "ga") == "es" and cfg.get("conditional", False):
+            raise ValueError("The evolution strategy can't search conditional rotations.")
+
         self.cfg = cfg
         self.evaluator = None
         self.generator = None
@@ -25,127 +38,771 @@ class RotationOptimizer(object):
         self.best_rotation = None
         self.best_dps = -np.inf
 
+        # Per-fight DPT quantiles of the best rotation, and the estimated variance of its DPT, if we know them. See
+        # RotationEvaluator.QUANTILES.
+        self.best_quantiles = None
+        self.best_variance = None
+
         self.current_rotation = None
 
+        # Scores of rotations we've already simulated, keyed by their canonical key. See
+        # RotationEvaluator.canonicalize(). This is bounded, and the oldest entries are dropped first.
+        self.cache = {}
+        self.cache_size = cfg.get("cache_size", 1000000)
+
+        # Counts describing how the most recent population was evaluated, and whether each of its rotations was scored
+        # with full-length fights along with its per-fight DPT quantiles and variance. See evaluate_population().
+        self.population_stats = {}
+        self.full_fidelity = []
+        self.population_quantiles = []
+        self.population_variances = []
+        self.population_keys = []
+
+        # Total number of rotations actually simulated by evaluate_population(), after deduplication and caching.
+        self.num_simulated = 0
+
+        # The last local optimum local_search() climbed to, so we don't search from the same place twice.
+        self.local_optimum = None
+
+        # The continuous parameters the evolution strategy follows the gradient of, and the state of its step rule. See
+        # es_epoch().
+        self.es_params = None
+        self.es_velocity = None
+        self.es_second_moment = None
+        self.es_steps = 0
+
+        # The structured metrics stream, if cfg["metrics_path"] is set, and the memory profiler while one is running.
+        # See MemoryProfiler.py.
+        self.metrics = None
+        self.memory_profiler = None
+
     def initialize(self):
-        self.evaluator = RotationEvaluator()
+        # Spread evaluation over a pool of worker processes if more than one worker has been requested.
+        if self.cfg.get("num_workers", 1) > 1:
+            self.evaluator = SharedMemoryEvaluator(self.cfg)
+        else:
+            self.evaluator = RotationEvaluator(self.cfg)
+
         self.generator = RotationGenerator(self.cfg)
         self.evaluator.initialize()
 
         self.current_rotation = self.generator.generate_rotation()
 
-    def train(self):
+        if self.cfg.get("metrics_path") is not None:
+            self.metrics = MetricsLogger(self.cfg["metrics_path"])
+
+        # Pick up from the best rotations of a previous run if we've been given any.
+        if self.cfg.get("warm_start") is not None:
+            self.warm_start(read_best_results(self.cfg["warm_start"], self.cfg.get("warm_start_count", 10)))
+
+    def close(self):
+        """
+        Function to shut down the evaluator's worker processes and release its shared memory, if it has any. The
+        optimizer can't evaluate anything afterwards.
+        :return: None
+        """
+        if hasattr(self.evaluator, "close"):
+            self.evaluator.close()
+
+    def warm_start(self, rotations):
+        """
+        Function to start training from the best of some previously found rotations instead of a random one. The
+        rotations are re-evaluated first, because the ability data may have changed since they were scored.
+        :param rotations: A list of rotations, each of which is a list of ability names.
+        :return: None
+        """
+        player = self.evaluator.combat_sim.player
+        candidates = []
+        names = []
+
+        for rotation in rotations:
+            # Skip any rotation that uses an ability which no longer exists.
+            try:
+                indices = player.get_rotation_indices(rotation)
+            except ValueError:
+                continue
+
+            candidates.append(self.complete_rotation(indices))
+            names.append(rotation)
+
+        if len(candidates) == 0:
+            return
+
+        rewards = self.evaluator.evaluate_rotations(candidates)
+        best = int(np.argmax(rewards))
+
+        self.current_rotation = candidates[best]
+        self.best_dps = rewards[best]
+        self.best_rotation = self.evaluator.rotation_names(self.current_rotation)
+        self.best_quantiles = self.evaluator.batch_quantiles[best]
+        self.best_variance = self.evaluator.batch_variances[best]
+
+    def complete_rotation(self, rotation):
+        """
+        Function to turn a rotation into one the generator could have made. Duplicates are pruned, and the end of the
+        bar is filled with every unused ability.
+        :param rotation: A list of ability indices.
+        :return: A full-length rotation without duplicates.
+        """
+        pruned = []
+        for arg in rotation:
+            if arg not in pruned:
+                pruned.append(int(arg))
+
+        # Entries may carry conditions (see RotationPolicy.py), so unused abilities are found by ability index.
+        num_abilities = self.generator.num_abilities
+        used = set(arg % num_abilities for arg in pruned)
+        unused = [arg for arg in range(num_abilities) if arg not in used]
+
+        return (pruned + unused)[:self.generator.rotation_length]
+
+    def train(self, num_epochs=None, time_limit=None, max_ticks=None, target_dpt=None, verbose=True):
         """
         The main training loop. This will take one training step and report data about what happened during that step.
-        :return:
+        Training stops after the given number of epochs, or as soon as any of the optional limits is reached. The time
+        and tick limits are checked after every fight, so they can stop training partway through an epoch (see
+        Budget.py). Whatever that epoch had found so far is thrown away, but the best rotation from every epoch before
+        it is kept, so training always returns the best rotation found in time. The starting rotation is scored before
+        the limits apply, so even a budget too small for a single fight returns it.
+
+        If cfg["memory_profile_interval"] is set, memory is profiled every that many epochs. See profile_memory().
+        :param num_epochs: Number of epochs to train for. Defaults to basically infinity.
+        :param time_limit: Optional number of seconds to train for.
+        :param max_ticks: Optional number of ticks to simulate, across every fight of every rotation.
+        :param target_dpt: Optional DPT to stop at as soon as a rotation reaches it.
+        :param verbose: Whether to report every epoch.
+        :return: A TrainingResult describing the best rotation found and the budget spent finding it.
         """
 
-        # Basically infinity.
-        num_epochs = 100000000
+        if num_epochs is None:
+            num_epochs = 100000000
 
-        for epoch in range(num_epochs):
+        budget = None
+        if time_limit is not None or max_ticks is not None:
+            budget = Budget(time_limit, max_ticks)
 
-            t1 = time.time()
-            rewards = self.epoch()
-            epoch_time = time.time()-t1
-
-            stats = self.compute_arr_stats(rewards)
-            print("\nEpoch: {}"
-                  "\nEpoch Time: {}"
-                  "\nRewards Mean: {}"
-                  "\nRewards Std : {}"
-                  "\nRewards Min: {}"
-                  "\nRewards Max: {}"
-                  "\nBest DPS: {}"
-                  "\nBest Rotation: {}"
-                  "\nNoise Stdev: {}"
-                  "\n".
-                  format(epoch,
-                         epoch_time,
-                         stats[0],
-                         stats[1],
-                         stats[2],
-                         stats[3],
-                         self.best_dps,
-                         self.best_rotation,
-                         self.cfg["stdev"]))
+        t_start = time.time()
+        start_ticks = self.evaluator.total_ticks
+
+        # Score the starting rotation before the budget is attached, so there is something to return however soon we
+        # have to stop. This one evaluation can overrun the budget, but its ticks are still counted in the result.
+        if self.best_rotation is None:
+            self.evaluate_start()
+
+        self.evaluator.budget = budget
+        stop_reason = "epochs"
+        epoch = 0
+        profile_interval = self.start_memory_profile()
+        try:
+            while epoch < num_epochs:
+                if target_dpt is not None and self.best_dps >= target_dpt:
+                    stop_reason = "target"
+                    break
+
+                t1 = time.time()
+                rewards = self.epoch()
+                epoch_time = time.time()-t1
+
+                # Everything simulated this epoch goes into the evaluation store (if there is one) in a single write.
+                self.evaluator.flush_store()
+
+                if verbose:
+                    self.report_epoch(epoch, epoch_time, rewards)
+                epoch += 1
+
+                if profile_interval is not None and epoch % profile_interval == 0:
+                    self.profile_memory(epoch - 1, verbose)
+
+        except BudgetExhausted as e:
+            stop_reason = e.reason
+
+        finally:
+            self.evaluator.budget = None
+            self.evaluator.flush_store()
+            self.stop_memory_profile()
+            if self.metrics is not None:
+                self.metrics.close()
+
+        return TrainingResult(self, epoch, time.time()-t_start, self.evaluator.total_ticks - start_ticks, stop_reason)
+
+    def start_memory_profile(self):
+        """
+        Function to start tracing allocations, if memory profiling has been asked for.
+        :return: The number of epochs between samples, or None if memory isn't being profiled.
+        """
+        interval = self.cfg.get("memory_profile_interval")
+        if not interval:
+            return None
+
+        self.memory_profiler = MemoryProfiler(self.cfg)
+        self.memory_profiler.start()
+        return interval
+
+    def stop_memory_profile(self):
+        if self.memory_profiler is not None:
+            self.memory_profiler.stop()
+            self.memory_profiler = None
+
+    def profile_memory(self, epoch, verbose=True):
+        """
+        Function to take a memory sample and write it to the metrics stream as a "memory" record.
+        :param epoch: Index of the epoch that just finished.
+        :param verbose: Whether to print a summary of the sample as well.
+        :return: The sample. See MemoryProfiler.sample().
+        """
+        sample = self.memory_profiler.sample()
+        if self.metrics is not None:
+            record = {"epoch": epoch, "cache_size": len(self.cache)}
+            record.update(sample)
+            self.metrics.log("memory", record)
+
+        if verbose:
+            print(format_sample(epoch, sample))
+
+        return sample
+
+    def evaluate_start(self):
+        """
+        Function to score the current rotation and make it the best one.
+        :return: None
+        """
+        rotation = self.complete_rotation(self.current_rotation)
+        reward = self.evaluate_population([rotation])[0]
+        if reward > self.best_dps:
+            self.best_dps = reward
+            self.best_quantiles = self.population_quantiles[0]
+            self.best_variance = self.population_variances[0]
+            self.best_rotation = self.evaluator.rotation_names(rotation)
+
+    def report_epoch(self, epoch, epoch_time, rewards):
+        """
+        Function to print a summary of one epoch of training.
+        :param epoch: Index of the epoch being reported.
+        :param epoch_time: Wall-clock time taken by the epoch, in seconds.
+        :param rewards: DPT of each rotation scored with full-length fights during the epoch. What the shorter levels
+                        of the fidelity ladder found is reported from self.population_stats instead.
+        :return: None
+        """
+
+        stats = self.compute_arr_stats(rewards)
+        levels = ", ".join("{} ticks x{} (mean DPT {:.3f}) in {:.3f}s".format(level["ticks"], level["evaluated"],
+                                                                              level["mean_dpt"], level["time"])
+                           for level in self.population_stats.get("levels", []))
+        fight_quantiles = self._format_quantiles(self.population_stats.get("fight_quantiles"))
+        best_quantiles = self._format_quantiles(self.best_quantiles)
+        print("\nEpoch: {}"
+              "\nEpoch Time: {}"
+              "\nRewards Mean: {}"
+              "\nRewards Std : {}"
+              "\nRewards Min: {}"
+              "\nRewards Max: {}"
+              "\nBest DPS: {}"
+              "\nBest Rotation: {}"
+              "\nBest Fight DPT p10/p50/p90: {}"
+              "\nNoise Stdev: {}"
+              "\nCollapsed Candidates: {}"
+              "\nFidelity Levels: {}"
+              "\nPopulation Fight DPT p10/p50/p90: {}"
+              "\n".
+              format(epoch,
+                     epoch_time,
+                     stats[0],
+                     stats[1],
+                     stats[2],
+                     stats[3],
+                     self.best_dps,
+                     self.best_rotation,
+                     best_quantiles,
+                     self.cfg["stdev"],
+                     self.population_stats.get("collapsed", 0),
+                     levels,
+                     fight_quantiles))
+
+    def _format_quantiles(self, quantiles):
+        if quantiles is None or None in quantiles:
+            return "unknown"
+
+        return "/".join("{:.3f}".format(value) for value in quantiles)
+
+    def get_checkpoint(self):
+        """
+        Function to capture everything needed to pick training back up where it left off.
+        :return: A JSON-serializable dict describing the current state of the optimizer.
+        """
+        current_rotation = None
+        if self.current_rotation is not None:
+            current_rotation = [int(arg) for arg in self.current_rotation]
+
+        checkpoint = {"best_dps": float(self.best_dps),
+                      "best_rotation": self.best_rotation,
+                      "best_quantiles": self.best_quantiles,
+                      "current_rotation": current_rotation,
+                      "stdev": self.cfg["stdev"]}
+
+        if self.es_params is not None:
+            checkpoint["es_params"] = [float(value) for value in self.es_params]
+
+        return checkpoint
+
+    def save_checkpoint(self, path, checkpoint=None):
+        """
+        Function to write a checkpoint to disk. The checkpoint is written to a temporary file first and then moved into
+        place, so an interrupted write never leaves a half-written checkpoint behind.
+        :param path: Path to write the checkpoint to.
+        :param checkpoint: Checkpoint dict to write. If this is not provided, the current state is captured.
+        :return: None
+        """
+        if checkpoint is None:
+            checkpoint = self.get_checkpoint()
+
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp_path, path)
 
     def epoch(self):
         """
-        Function to perform one epoch of training. This is currently set up to use the genetic algorithm outlined above,
-        but by commenting out some of the existing code and uncommenting other code this can be turned into the gradient
-        approximator outlined above.
+        Function to perform one epoch of training, with whichever algorithm cfg["update_rule"] selects.
 
-        :return: A list containing the DPT of each random perturbation that was tried this epoch.
+        :return: A list containing the DPT of each random perturbation that was tried this epoch and scored with
+                 full-length fights.
         """
 
+        # Once the noise has shrunk enough, climb to a local optimum around the current rotation instead. We only do this
+        # once per rotation, so if the search can't improve on it we go back to sampling noise.
+        threshold = self.cfg.get("local_search_stdev")
+        if threshold is not None and self.cfg["stdev"] <= threshold \
+                and tuple(self.current_rotation) != self.local_optimum:
+            return self.local_search()[0]
+
+        if self.cfg.get("update_rule", "ga") == "es":
+            return self.es_epoch()
 
         generator = self.generator
-        evaluator = self.evaluator
         num = self.cfg["returns_per_update"]
-        current_rotation = self.current_rotation
-        rewards = []
-        epsilons = []
-
-        best_this_epoch = -np.inf
-        best_rot_this_epoch = None
 
-        # Perturb the current rotation, evaluate it, keep track of the best one so far, and keep going.
-        for i in range(num):
-            rotation, noise = generator.perturb_rotation(current_rotation)
-            reward = evaluator.evaluate_rotation(rotation)
-            if reward >= best_this_epoch:
-                best_this_epoch = reward
-                best_rot_this_epoch = rotation
-            rewards.append(reward)
-            #epsilons.append(noise)
+        # Perturb the current rotation as many times as we need, then evaluate every perturbation as one batch so a
+        # parallel evaluator can spread them across its workers. The whole population is one matrix, and the evaluators
+        # are handed a copy with duplicates pruned. The rotation we keep carries on with its duplicates though, since
+        # they're just as likely to be moved somewhere useful by the next perturbation as any other entry.
+        rotations = generator.perturb_population(self.current_rotation, num)
+        rewards = self.evaluate_population(generator.prune_population(rotations))
+        best_this_epoch, best_rot_this_epoch, best_quantiles_this_epoch, best_variance_this_epoch = \
+            self._best_of_population(rotations, rewards)
 
         # If the best rotation this epoch is better than the best rotation we've ever seen, record that and anneal the
         # size of our noise.
         if best_this_epoch > self.best_dps:
             self.cfg["stdev"] *= 0.85
             self.best_dps = best_this_epoch
+            self.best_quantiles = best_quantiles_this_epoch
+            self.best_variance = best_variance_this_epoch
             self.current_rotation = best_rot_this_epoch
 
             # This translates the rotation vector into a list of strings containing the ability names of the
             # current best rotation.
-            abilities = self.evaluator.combat_sim.player.abilities
-            self.best_rotation = [abilities[arg].name for arg in self.current_rotation]
+            self.best_rotation = self.evaluator.rotation_names(self.current_rotation)
 
-        # Uncomment this stuff (and epsilons.append(noise) above) to swap to the gradient approximation method.
-        # You'll also need to comment out line 107 above.
-        # self.current_rotation = self.compute_update(rewards, epsilons)
-        #
-        # current_reward = evaluator.evaluate_rotation(self.current_rotation)
-        # if current_reward > self.best_dps:
-        #     self.best_dps = current_reward
-        #     abilities = self.evaluator.combat_sim.player.abilities
-        #     self.best_rotation = [abilities[arg].name for arg in self.current_rotation]
+        return self._full_length_rewards(rewards)
 
-        return rewards
+    def es_epoch(self):
+        """
+        Function to perform one epoch of the evolution strategy. The rotation is relaxed into a vector of continuous
+        parameters, which are rounded and clamped into a rotation whenever one is needed. Every epoch:
+            1. One (returns_per_update / 2, rotation_length) matrix of Gaussian noise is drawn, and every row is used
+               twice, once added to the parameters and once subtracted (mirrored sampling). Mirrored pairs cancel the
+               part of the estimate that comes from the noise itself, so the gradient is much less noisy.
+            2. Every perturbed rotation is evaluated as one population.
+            3. The rewards are replaced by their centered ranks (fitness shaping), which makes the update ignore the
+               scale of DPT and the occasional outlier. Rotations dropped by the fidelity ladder are ranked below every
+               rotation that made it to full-length fights, which is consistent with why they were dropped.
+            4. The gradient estimate is followed with Adam or momentum. See compute_update().
+        The noise stdev is annealed whenever a new best rotation is found, just like the genetic algorithm. The
+        following optional config entries control the update:
+            es_optimizer: "adam" or "momentum".
+            es_learning_rate: Size of each step, in ability indices.
+            es_momentum: Decay of the momentum, or of Adam's first moment.
+        :return: A list containing the DPT of each rotation that was tried this epoch and scored with full-length fights.
+        """
+        rng = self.cfg["rng"]
+        stdev = self.cfg["stdev"]
+        num_pairs = max(1, self.cfg["returns_per_update"] // 2)
+
+        if self.es_params is None:
+            self.es_params = np.asarray(self.complete_rotation(self.current_rotation), dtype=np.float64)
+
+        epsilons = rng.randn(num_pairs, len(self.es_params))
+        noise = np.concatenate((epsilons, -epsilons)) * stdev
+        rotations = self.generator.force_valid_rotations(self.es_params + noise)
+
+        rewards = self.evaluate_population(self.generator.prune_population(rotations))
+        best_this_epoch, best_rotation, best_quantiles, best_variance = self._best_of_population(rotations, rewards)
+        if best_this_epoch > self.best_dps:
+            self.cfg["stdev"] *= 0.85
+            self.best_dps = best_this_epoch
+            self.best_quantiles = best_quantiles
+            self.best_variance = best_variance
+            self.best_rotation = self.evaluator.rotation_names(best_rotation)
+
+        self.es_params = self.es_params + self.compute_update(rewards, self.full_fidelity, epsilons)
+        self.current_rotation = self.generator.force_valid_rotation(self.es_params)
+        return self._full_length_rewards(rewards)
+
+    def _full_length_rewards(self, rewards):
+        # DPT from short fights can't be compared with DPT from full-length ones, so only the latter is reported.
+        return [reward for reward, full in zip(rewards, self.full_fidelity) if full]
+
+    def _best_of_population(self, rotations, rewards):
+        """
+        Function to find the best rotation of the population evaluate_population() just evaluated. Only rotations scored
+        with full-length fights count.
+        :param rotations: The rotations of the population, as a list or a matrix with one rotation per row.
+        :param rewards: The DPT of each rotation.
+        :return: The DPT, rotation (as a list), per-fight DPT quantiles and DPT variance of the best rotation. The DPT is
+                 -inf and the rest are None if no rotation made it to full-length fights.
+        """
+        best = (-np.inf, None, None, None)
+        for rotation, reward, full, quantiles, variance in zip(rotations, rewards, self.full_fidelity,
+                                                               self.population_quantiles, self.population_variances):
+            if full and reward >= best[0]:
+                best = (reward, rotation, quantiles, variance)
+
+        if isinstance(best[1], np.ndarray):
+            best = (best[0], best[1].tolist(), best[2], best[3])
+
+        return best
+
+    def local_search(self):
+        """
+        Function to run a steepest-ascent local search from the current rotation. At every step the whole neighborhood
+        of the current rotation (see RotationGenerator.neighborhood()) is evaluated as one batch, through
+        evaluate_population() so it shares the cache with everything else, and we move to the best neighbor. Moves to a
+        neighbor as good as the current rotation are allowed, so the search can cross plateaus of equivalent rotations,
+        and a tabu list of recently visited canonical keys stops it from cycling on them. The search stops at a local
+        optimum, or after a maximum number of steps. These are set by the following optional config entries:
+            local_search_steps: Maximum number of steps to take.
+            tabu_tenure: Number of recently visited rotations that can't be moved back to.
+        :return: A list containing the DPT of every neighbor that was tried and scored with full-length fights, and the
+                 DPT of the rotation the search ended on.
+        """
+        max_steps = self.cfg.get("local_search_steps", 20)
+        tabu = collections.deque(maxlen=self.cfg.get("tabu_tenure", 20))
+        rewards = []
+
+        current = self.complete_rotation(self.current_rotation)
+        current_reward = self.evaluate_population([current])[0]
+        tabu.append(self.population_keys[0])
+
+        # The start may already be a local optimum, and better than anything we've recorded.
+        if current_reward > self.best_dps:
+            self.best_dps = current_reward
+            self.best_quantiles = self.population_quantiles[0]
+            self.best_variance = self.population_variances[0]
+            self.best_rotation = self.evaluator.rotation_names(current)
+
+        steps = 0
+        while steps < max_steps:
+            neighbors = self.generator.neighborhood(current)
+            neighbor_rewards = self.evaluate_population(neighbors)
+            rewards += self._full_length_rewards(neighbor_rewards)
+
+            best = None
+            for i, (reward, full, key) in enumerate(zip(neighbor_rewards, self.full_fidelity, self.population_keys)):
+                if not full:
+                    continue
+
+                # A tabu neighbor is only allowed if it beats the best rotation we've ever seen.
+                if key in tabu and reward <= self.best_dps:
+                    continue
+
+                if best is None or reward > neighbor_rewards[best]:
+                    best = i
+
+            if best is None or neighbor_rewards[best] < current_reward:
+                break
+
+            current = neighbors[best]
+            current_reward = neighbor_rewards[best]
+            tabu.append(self.population_keys[best])
+            steps += 1
 
-    def compute_update(self, rewards, epsilons):
+            if current_reward > self.best_dps:
+                self.best_dps = current_reward
+                self.best_quantiles = self.population_quantiles[best]
+                self.best_variance = self.population_variances[best]
+                self.best_rotation = self.evaluator.rotation_names(current)
+
+        self.current_rotation = current
+        self.local_optimum = tuple(current)
+        self.population_stats["local_search_steps"] = steps
+        return rewards, current_reward
+
+    def evaluate_population(self, rotations, full_length=False):
         """
-        Function to approximate a gradient and follow it.
-        :param rewards: DPT of each rotation tried this epoch.
-        :param epsilons: Noise vectors used to generate each rotation from this epoch.
-        :return: The updated rotation.
+        Function to evaluate a population of rotations, given as a list or as a matrix with one rotation per row padded
+        with -1. Unless canonicalization has been turned off in the config, each rotation is first reduced to its
+        canonical key, and only one rotation per key that we haven't already scored is actually simulated. Every other
+        rotation just shares that score. Keys we haven't scored during this run are looked up in the evaluation store
+        before anything is simulated (see RotationEvaluator.lookup_stored()), and the full-length results of the
+        rotations that do get simulated are queued to be written back to it. The rotations that do get simulated go
+        through evaluate_ladder().
+        :param rotations: A list of rotations, or a matrix with one rotation per row padded with -1.
+        :param full_length: Whether to skip the fidelity ladder and simulate every rotation with full-length fights.
+        :return: A list containing the DPT of each rotation, in the same order as the input. Whether each of those came
+                 from full-length fights is recorded in self.full_fidelity, and the per-fight DPT quantiles and DPT
+                 variance of each rotation simulated at full length this time (or found in the store) are recorded in
+                 self.population_quantiles and self.population_variances. Rotations we got from the cache or dropped
+                 before the last level have None there instead. The key each rotation was
+                 deduplicated by is recorded in self.population_keys.
         """
-        rews = self.standardize(rewards)
+        evaluator = self.evaluator
+        canonicalize = self.cfg.get("canonicalize", True)
+
+        # Without canonical keys every rotation is treated as unique, and nothing gets cached.
+        if canonicalize:
+            keys = evaluator.canonicalize_rotations(rotations)
+            self.population_keys = keys
+        else:
+            keys = list(range(len(rotations)))
+            self.population_keys = [tuple(rotation) for rotation in rotations]
+
+        # Pick out the first rotation with each key we haven't seen before.
+        to_simulate = {}
+        cache_hits = 0
+        for i, key in enumerate(keys):
+            if canonicalize and key in self.cache:
+                cache_hits += 1
+            elif key not in to_simulate:
+                to_simulate[key] = i
+
+        # Some of what's left may have been scored by a previous run.
+        scores = {}
+        store_hits = 0
+        if canonicalize:
+            stored = evaluator.lookup_stored(list(to_simulate.keys()))
+            for key, (reward, rotation_quantiles, variance) in stored.items():
+                scores[key] = (reward, True, rotation_quantiles, variance)
+                self.cache[key] = reward
+                del to_simulate[key]
+            store_hits = sum(1 for key in keys if key in stored)
+
+        indices = list(to_simulate.values())
+        self.num_simulated += len(indices)
+        rewards, full_fidelity, quantiles, variances, censored, level_stats = \
+            self.evaluate_ladder(_take_rows(rotations, indices), full_length)
+
+        # Only scores from full-length fights are good enough to keep. A censored kill time is only a bound, and one cut
+        # short by the time-to-kill cutoff depends on the best rotation seen so far, so neither of those are kept.
+        queued = []
+        for j, key in enumerate(to_simulate.keys()):
+            scores[key] = (rewards[j], full_fidelity[j], quantiles[j], variances[j])
+            if canonicalize and full_fidelity[j] and not censored[j]:
+                self.cache[key] = rewards[j]
+                queued.append(j)
+
+        if len(queued) > 0:
+            evaluator.queue_stored([keys[indices[j]] for j in queued], [rotations[indices[j]] for j in queued],
+                                   [rewards[j] for j in queued], [variances[j] for j in queued],
+                                   [quantiles[j] for j in queued])
 
-        gradient = np.dot(rews, epsilons) / len(rews)
+        population_rewards = []
+        self.full_fidelity = []
+        self.population_quantiles = []
+        self.population_variances = []
+        for key in keys:
+            if key in scores:
+                reward, full, rotation_quantiles, variance = scores[key]
+            else:
+                reward, full, rotation_quantiles, variance = self.cache[key], True, None, None
 
-        # Gradient ascent.
-        new_rotation = np.add(self.current_rotation, self.cfg["step_size"]*gradient)
-        validated_rotation = self.generator.force_valid_rotation(new_rotation)
+            population_rewards.append(reward)
+            self.full_fidelity.append(full)
+            self.population_quantiles.append(rotation_quantiles)
+            self.population_variances.append(variance)
 
-        return validated_rotation
+        self.population_stats = {"candidates": len(rotations),
+                                 "simulated": len(indices),
+                                 "collapsed": len(rotations) - len(indices),
+                                 "cache_hits": cache_hits,
+                                 "store_hits": store_hits,
+                                 "levels": level_stats,
+                                 "fight_quantiles": None}
 
-    def standardize(self, arr):
-        if np.std(arr) == 0:
-            return arr
+        # The quantiles of every fight at the full-length level, merged across every rotation (and worker) that got there.
+        # At least one rotation is always promoted, so if the ladder ran at all its last level is the full-length one.
+        if len(level_stats) > 0:
+            self.population_stats["fight_quantiles"] = level_stats[-1]["quantiles"]
 
-        return np.divide(np.subtract(arr, np.mean(arr)), np.std(arr))
+        # Drop the oldest entries once the cache is full. Dicts remember insertion order, so these come first.
+        while len(self.cache) > self.cache_size:
+            del self.cache[next(iter(self.cache))]
+
+        return population_rewards
+
+    def evaluate_ladder(self, rotations, full_length=False):
+        """
+        Function to evaluate rotations on a multi-fidelity ladder. Every rotation is first scored with short fights, and
+        only the best fraction of them is promoted to the next, longer level. Only the rotations that make it through
+        every level are scored with full-length fights. The ladder is described by two lists in the config object:
+            fidelity_levels: Fight lengths (in ticks) of every level below the full-length one, shortest first.
+            promotion_ratios: The fraction of rotations promoted out of each of those levels.
+        With no fidelity levels configured, every rotation is just scored at full length.
+        :param rotations: A list of rotations, or a matrix with one rotation per row padded with -1.
+        :param full_length: Whether to skip the ladder and score every rotation with full-length fights.
+        :return: A list containing the DPT of each rotation at the highest level it reached, a list of flags telling
+                 whether each rotation reached the full-length level, lists containing the per-fight DPT quantiles,
+                 the variance of the DPT and whether the DPT is censored (see RotationEvaluator.evaluate_kill_time())
+                 of each rotation that did (None for the rest), and a list describing each level that was run.
+        """
+        levels = list(self.cfg.get("fidelity_levels", []))
+        ratios = list(self.cfg.get("promotion_ratios", []))
+        if len(levels) != len(ratios):
+            raise ValueError("Every fidelity level needs a promotion ratio.")
+
+        if full_length:
+            levels = []
+            ratios = []
+
+        num = len(rotations)
+        rewards = [0]*num
+        full_fidelity = [False]*num
+        quantiles = [None]*num
+        variances = [None]*num
+        censored = [None]*num
+        level_stats = []
+        survivors = list(range(num))
+
+        # The full-length level is always last, and nothing is promoted out of it.
+        for fight_length, ratio in zip(levels + [None], ratios + [None]):
+            if len(survivors) == 0:
+                break
+
+            t1 = time.time()
+            level_rewards = self.evaluator.evaluate_rotations(_take_rows(rotations, survivors), fight_length)
+            level_stats.append({"ticks": self.evaluator.fight_length if fight_length is None else fight_length,
+                                "evaluated": len(survivors),
+                                "time": time.time()-t1,
+                                "mean_dpt": float(np.mean(level_rewards)),
+                                "quantiles": self.evaluator.batch_sketch.quantiles(QUANTILES)})
+
+            for i, reward in zip(survivors, level_rewards):
+                rewards[i] = reward
+
+            if ratio is None:
+                for i, rotation_quantiles, variance, rotation_censored in zip(survivors, self.evaluator.batch_quantiles,
+                                                                              self.evaluator.batch_variances,
+                                                                              self.evaluator.batch_censored):
+                    full_fidelity[i] = True
+                    quantiles[i] = rotation_quantiles
+                    variances[i] = variance
+                    censored[i] = rotation_censored
+                break
+
+            num_promoted = max(1, int(np.ceil(len(survivors)*ratio)))
+            promoted = np.argsort(level_rewards)[::-1][:num_promoted]
+            survivors = [survivors[j] for j in promoted]
+
+        return rewards, full_fidelity, quantiles, variances, censored, level_stats
+
+    def compute_update(self, rewards, full_fidelity, epsilons):
+        """
+        Function to approximate a gradient from mirrored samples and compute the step that follows it.
+        :param rewards: DPT of each rotation tried this epoch. The first half were made by adding each row of epsilons to
+                        the parameters, and the second half by subtracting it.
+        :param full_fidelity: Whether each of those rewards came from full-length fights.
+        :param epsilons: The noise matrix, with one row per mirrored pair.
+        :return: The step to add to the parameters.
+        """
+        num_pairs = len(epsilons)
+
+        # Rank first by whether the rotation made it through the ladder, then by its reward.
+        shaped = self.centered_ranks(np.lexsort((rewards, full_fidelity)))
+        gradient = np.dot(shaped[:num_pairs] - shaped[num_pairs:], epsilons) / (2*num_pairs)
+
+        learning_rate = self.cfg.get("es_learning_rate", 0.3)
+        beta1 = self.cfg.get("es_momentum", 0.9)
+        if self.es_velocity is None:
+            self.es_velocity = np.zeros_like(gradient)
+            self.es_second_moment = np.zeros_like(gradient)
+
+        if self.cfg.get("es_optimizer", "adam") == "momentum":
+            self.es_velocity = beta1*self.es_velocity + gradient
+            return learning_rate*self.es_velocity
+
+        # Adam, with the usual bias corrections.
+        beta2 = 0.999
+        self.es_steps += 1
+        self.es_velocity = beta1*self.es_velocity + (1 - beta1)*gradient
+        self.es_second_moment = beta2*self.es_second_moment + (1 - beta2)*gradient**2
+        first_moment = self.es_velocity / (1 - beta1**self.es_steps)
+        second_moment = self.es_second_moment / (1 - beta2**self.es_steps)
+        return learning_rate*first_moment / (np.sqrt(second_moment) + 1e-8)
+
+    def centered_ranks(self, order):
+        """
+        Function to turn a sort order into centered ranks.
+        :param order: Indices which sort the population from worst to best, e.g. from np.argsort().
+        :return: An array containing the rank of each member of the population scaled into [-0.5, 0.5].
+        """
+        num = len(order)
+        ranks = np.empty(num, dtype=np.float64)
+        ranks[order] = np.arange(num)
+        if num > 1:
+            ranks /= num - 1
+        return ranks - 0.5
 
     def compute_arr_stats(self, arr):
-        return np.mean(arr), np.std(arr), np.min(arr), np.max(arr)
\ No newline at end of file
+        # An epoch can end without scoring anything at full length, e.g. a local search that starts at an optimum.
+        if len(arr) == 0:
+            return np.nan, np.nan, np.nan, np.nan
+
+        return np.mean(arr), np.std(arr), np.min(arr), np.max(arr)
+
+
+def _take_rows(rotations, indices):
+    # Rows of a population matrix can be taken with one fancy index.
+    if isinstance(rotations, np.ndarray):
+        return rotations[indices]
+    return [rotations[i] for i in indices]
+
+
+class TrainingResult(object):
+    def __init__(self, optimizer, epochs, time_taken, ticks, stop_reason):
+        """
+        :param optimizer: The optimizer that was trained.
+        :param epochs: Number of epochs completed.
+        :param time_taken: Wall-clock time spent training, in seconds.
+        :param ticks: Number of ticks simulated while training.
+        :param stop_reason: Why training stopped. This is "epochs", "target", "time" or "ticks".
+        """
+        self.best_rotation = optimizer.best_rotation
+        self.best_dps = float(optimizer.best_dps)
+        self.best_quantiles = optimizer.best_quantiles
+        self.best_variance = optimizer.best_variance
+        self.epochs = epochs
+        self.time = time_taken
+        self.ticks = ticks
+        self.stop_reason = stop_reason
+
+    def confidence_interval(self, z=1.96):
+        """
+        Function to compute a normal confidence interval around the DPT of the best rotation.
+        :param z: Number of standard errors on either side. The default gives a 95% interval.
+        :return: A (low, high) pair, or None if the variance of the best rotation isn't known.
+        """
+        if self.best_variance is None:
+            return None
+
+        half_width = z * self.best_variance**0.5
+        return self.best_dps - half_width, self.best_dps + half_width
+
+    def to_dict(self):
+        interval = self.confidence_interval()
+        return {"best_rotation": self.best_rotation,
+                "best_dps": self.best_dps,
+                "confidence_interval": None if interval is None else [float(value) for value in interval],
+                "best_quantiles": self.best_quantiles,
+                "epochs": self.epochs,
+                "time": self.time,
+                "ticks": self.ticks,
+                "stop_reason": self.stop_reason}
@@ -0,0 +1,400 @@
+"""
+File name: ScoringService.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a long-lived local service for scoring rotations, so tools can ask for the DPT of a bar without
+    paying to load abilities and build a simulator every time. It speaks plain HTTP with JSON bodies, over either a TCP
+    port on localhost or a Unix socket.
+
+        POST /score      {"rotation": ["Snap Shot", ...]} or {"rotations": [[...], [...]]}
+        GET  /abilities  The names of every ability that can be used in a rotation.
+        GET  /metrics    Request counts, batch sizes, queue depth and p50/p99 latency.
+        GET  /health     Always {"ok": true} while the service is up.
+
+    Requests are handled on their own threads, but they never touch the evaluator. Each rotation is put on a queue and
+    a single batching thread takes everything waiting (up to a maximum batch size, waiting a few milliseconds after the
+    first rotation for more to arrive), and scores it all with one call to evaluate_rotations(). With more than one
+    worker that call is spread over a SharedMemoryEvaluator's pool, so concurrent requests are scored in parallel.
+
+    ScoringClient is a small client for the service, which is all that's needed to use it from Python or a shell.
+"""
+
+from Optimization.RotationEvaluator import RotationEvaluator
+from Optimization.QuantileSketch import QuantileSketch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import http.client
+import threading
+import socket
+import queue
+import json
+import time
+import os
+
+
+class _PendingScore(object):
+    def __init__(self, rotation):
+        self.rotation = rotation
+        self.enqueue_time = time.perf_counter()
+        self.done = threading.Event()
+        self.dpt = None
+        self.quantiles = None
+        self.batch_size = 0
+        self.error = None
+
+
+class _ScoringHandler(BaseHTTPRequestHandler):
+    # Set on a subclass by ScoringService.start().
+    service = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._reply(200, self.service.get_metrics())
+        elif self.path == "/abilities":
+            self._reply(200, {"abilities": self.service.ability_names})
+        elif self.path == "/health":
+            self._reply(200, {"ok": True})
+        else:
+            self._reply(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._reply(404, {"error": "Unknown path {}".format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            if "rotations" in request:
+                results = self.service.score(request["rotations"])
+                self._reply(200, {"results": results})
+            else:
+                self._reply(200, self.service.score([request["rotation"]])[0])
+
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {"error": "{}: {}".format(type(e).__name__, e)})
+
+        except (RuntimeError, TimeoutError) as e:
+            self._reply(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients don't have an address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        if self.service.verbose:
+            super().log_message(format, *args)
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    # The default backlog of 5 is far too short for a burst of concurrent clients. Unix sockets refuse the overflow
+    # outright rather than making them wait.
+    request_queue_size = 128
+
+    def server_bind(self):
+        # HTTPServer.server_bind() assumes a (host, port) address, so we skip it and only do the socket part.
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+class _TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class ScoringService(object):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. The evaluator settings in it are used to build the evaluator, and the following
+                    optional entries control the service itself:
+                        service_address: "unix:<path>" for a Unix socket, or "<host>:<port>" for TCP.
+                        service_batch_size: Maximum number of rotations scored in one batch.
+                        service_batch_wait: Seconds to wait after the first rotation of a batch for more to arrive.
+                        service_verbose: Whether to log every request.
+                        service_timeout: Seconds a request waits for its rotations to be scored before giving up.
+                        num_workers: Number of worker processes to score batches with.
+        """
+        self.cfg = cfg
+        self.address = cfg.get("service_address") or "127.0.0.1:8765"
+        self.max_batch_size = cfg.get("service_batch_size") or 64
+        self.batch_wait = cfg.get("service_batch_wait", 0.005)
+        self.verbose = cfg.get("service_verbose", False)
+        self.timeout = cfg.get("service_timeout", 30)
+
+        self.evaluator = None
+        self.ability_indices = None
+        self.ability_names = None
+        self.server = None
+        self.queue = queue.Queue()
+        self.threads = []
+        self.stopping = threading.Event()
+
+        # Metrics. These are updated by the batching thread and read by request threads, so they share a lock.
+        self.metrics_lock = threading.Lock()
+        self.latency_sketch = QuantileSketch()
+        self.num_requests = 0
+        self.num_rotations = 0
+        self.num_batches = 0
+        self.max_queue_depth = 0
+        self.start_time = None
+
+    def initialize(self):
+        """
+        Function to build the evaluator, which loads every ability up front, and start its workers if it has any.
+        :return: None
+        """
+        num_workers = self.cfg.get("num_workers") or 1
+        if num_workers > 1:
+            from Optimization.SharedMemoryEvaluator import SharedMemoryEvaluator
+            cfg = dict(self.cfg)
+            cfg["num_workers"] = num_workers
+            cfg.setdefault("returns_per_update", self.max_batch_size)
+            cfg.setdefault("rotation_length", 1)
+            self.evaluator = SharedMemoryEvaluator(cfg)
+        else:
+            self.evaluator = RotationEvaluator(self.cfg)
+
+        self.evaluator.initialize()
+        abilities = self.evaluator.combat_sim.player.abilities
+        self.ability_names = [ability.name for ability in abilities]
+        self.ability_indices = {name: i for i, name in enumerate(self.ability_names)}
+
+    def start(self):
+        """
+        Function to start listening and batching on background threads.
+        :return: None
+        """
+        handler = type("ScoringHandler", (_ScoringHandler,), {"service": self})
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+            self.server = _UnixHTTPServer(path, handler)
+        else:
+            host, port = self.address.rsplit(":", 1)
+            self.server = _TCPHTTPServer((host, int(port)), handler)
+
+            # Port 0 asks the OS for any free port, so record the one we actually got.
+            self.address = "{}:{}".format(host, self.server.server_address[1])
+
+        self.start_time = time.time()
+        self.threads = [threading.Thread(target=self._batch_loop, daemon=True),
+                        threading.Thread(target=self.server.serve_forever, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def serve_forever(self):
+        """
+        Function to start the service and block until it is interrupted.
+        :return: None
+        """
+        self.start()
+        print("Scoring service listening on {}".format(self.address))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Function to stop listening, stop batching, and shut down the evaluator.
+        :return: None
+        """
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if self.address.startswith("unix:") and os.path.exists(self.address[len("unix:"):]):
+                os.remove(self.address[len("unix:"):])
+
+        for thread in self.threads:
+            thread.join()
+
+        if hasattr(self.evaluator, "close"):
+            self.evaluator.close()
+
+    def score(self, rotations):
+        """
+        Function to score some rotations through the batching thread, blocking until they are done. This is safe to call
+        from any number of threads at once.
+        :param rotations: A list of rotations, each of which is a list of ability names.
+        :return: A list containing a result dict for each rotation. RuntimeError is raised if any of them couldn't be
+                 scored, and TimeoutError if they weren't all scored in time.
+        """
+        # Check every name before queueing anything, so a bad request can't waste a batch slot.
+        pending = []
+        for rotation in rotations:
+            indices = []
+            for name in rotation:
+                if name not in self.ability_indices:
+                    raise ValueError("Unknown ability {}".format(name))
+                indices.append(self.ability_indices[name])
+            pending.append(_PendingScore(indices))
+
+        with self.metrics_lock:
+            self.num_requests += 1
+
+        for item in pending:
+            self.queue.put(item)
+
+        # Every rotation shares the same deadline, so a request never waits much longer than the timeout in total.
+        deadline = time.perf_counter() + self.timeout
+        results = []
+        for rotation, item in zip(rotations, pending):
+            if not item.done.wait(max(0, deadline - time.perf_counter())):
+                raise TimeoutError("Rotations weren't scored within {} seconds".format(self.timeout))
+            if item.error is not None:
+                raise RuntimeError("Scoring failed with {}: {}".format(type(item.error).__name__, item.error))
+
+            results.append({"rotation": rotation,
+                            "dpt": item.dpt,
+                            "quantiles": item.quantiles,
+                            "batch_size": item.batch_size})
+
+        return results
+
+    def get_metrics(self):
+        with self.metrics_lock:
+            p50, p99 = self.latency_sketch.quantiles((0.5, 0.99))
+            mean_batch_size = self.num_rotations / self.num_batches if self.num_batches > 0 else 0
+            return {"requests": self.num_requests,
+                    "rotations": self.num_rotations,
+                    "batches": self.num_batches,
+                    "mean_batch_size": mean_batch_size,
+                    "queue_depth": self.queue.qsize(),
+                    "max_queue_depth": self.max_queue_depth,
+                    "latency_ms": {"p50": None if p50 is None else 1000*p50,
+                                   "p99": None if p99 is None else 1000*p99},
+                    "uptime": time.time() - self.start_time}
+
+    def _batch_loop(self):
+        """
+        The batching loop. This waits for the first rotation of a batch, gives the rest of the batch a moment to arrive,
+        then scores the whole thing at once.
+        :return: None
+        """
+        while not self.stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            with self.metrics_lock:
+                self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize() + 1)
+
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Whatever goes wrong, every request waiting on this batch has to be woken up, and the loop has to keep
+            # going for the ones after it.
+            try:
+                self._score_batch(batch)
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            finally:
+                for item in batch:
+                    item.done.set()
+
+    def _score_batch(self, batch):
+        dpts = self.evaluator.evaluate_rotations([item.rotation for item in batch])
+        quantiles = self.evaluator.batch_quantiles
+
+        now = time.perf_counter()
+        with self.metrics_lock:
+            self.num_batches += 1
+            self.num_rotations += len(batch)
+            for item in batch:
+                self.latency_sketch.update(now - item.enqueue_time)
+
+        for i, item in enumerate(batch):
+            item.dpt = float(dpts[i])
+            item.quantiles = quantiles[i]
+            item.batch_size = len(batch)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ScoringClient(object):
+    def __init__(self, address, timeout=60):
+        """
+        :param address: Address of the service, "unix:<path>" or "<host>:<port>".
+        :param timeout: Seconds to wait for a response.
+        """
+        self.address = address
+        self.timeout = timeout
+
+    def score(self, rotation):
+        """
+        Function to score one rotation.
+        :param rotation: List of ability names.
+        :return: A result dict containing the DPT under "dpt".
+        """
+        return self._request("POST", "/score", {"rotation": rotation})
+
+    def score_many(self, rotations):
+        return self._request("POST", "/score", {"rotations": rotations})["results"]
+
+    def metrics(self):
+        return self._request("GET", "/metrics")
+
+    def abilities(self):
+        return self._request("GET", "/abilities")["abilities"]
+
+    def _request(self, method, path, body=None):
+        if self.address.startswith("unix:"):
+            connection = _UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+        else:
+            host, port = self.address.rsplit(":", 1)
+            connection = http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+        try:
+            data = None if body is None else json.dumps(body)
+            connection.request(method, path, body=data, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+
+        if response.status >= 500:
+            raise RuntimeError(result.get("error", "HTTP {}".format(response.status)))
+        if response.status != 200:
+            raise ValueError(result.get("error", "HTTP {}".format(response.status)))
+
+        return result
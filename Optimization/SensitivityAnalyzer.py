@@ -0,0 +1,187 @@
+"""
+File name: SensitivityAnalyzer.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a sensitivity analysis of a rotation, which shows which of its ordering decisions actually
+    matter. Every variant one small edit away from the rotation is scored: every pair of abilities swapped, and every
+    ability removed. The results form a matrix M where, relative to the DPT of the rotation itself,
+        M[i][j] (i != j): The change in DPT from swapping the abilities in positions i and j. This is symmetric.
+        M[i][i]:          The change in DPT from removing the ability in position i.
+    A swap which barely moves the DPT is an ordering decision that doesn't matter.
+
+    Every variant is scored in a single batch with common random numbers, meaning fight k of every variant rolls
+    exactly the same random numbers (see RotationEvaluator.crn_seed). The noise shared by every variant cancels out of
+    the differences, so far fewer fights are needed to tell real effects from noise.
+
+    Scores are cached in a JSON file along with the cast counts and ability hashes they depend on, like the results of
+    the stream command (see StreamingEvaluator.py). Analyzing again after a change to the ability data only rescores the
+    variants the change could have affected, and analyzing a rotation close to one analyzed before reuses every variant
+    they share.
+"""
+
+from Optimization.RotationEvaluator import RotationEvaluator
+from Optimization.EvaluationStore import get_scenario
+from Environment.Abilities import AbilityBundle
+import numpy as np
+import json
+import os
+
+
+class SensitivityAnalyzer(object):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. The evaluator settings in it are used to build the evaluator, cfg["seed"] seeds the
+                    common random numbers, and the following optional entries are read:
+                        sensitivity_cache: Path of the JSON file to cache scores in. Nothing is cached without one.
+                        num_workers: Number of worker processes to score variants with.
+        """
+        self.cfg = dict(cfg)
+        self.cfg["crn_seed"] = cfg.get("seed", 0)
+        self.cache_path = cfg.get("sensitivity_cache", None)
+
+        self.evaluator = None
+        self.ability_hashes = None
+        self.cache = {}
+
+    def initialize(self):
+        if (self.cfg.get("num_workers") or 1) > 1:
+            from Optimization.SharedMemoryEvaluator import SharedMemoryEvaluator
+            cfg = dict(self.cfg)
+            cfg.setdefault("returns_per_update", 128)
+            cfg.setdefault("rotation_length", 1)
+            self.evaluator = SharedMemoryEvaluator(cfg)
+        else:
+            self.evaluator = RotationEvaluator(self.cfg)
+
+        self.evaluator.initialize()
+        self.ability_hashes = AbilityBundle.get_ability_hashes(self.evaluator.ability_folder)
+
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r') as f:
+                self.cache = json.load(f)
+
+    def close(self):
+        if hasattr(self.evaluator, "close"):
+            self.evaluator.close()
+
+    def get_variants(self, rotation):
+        """
+        Function to list every variant of a rotation that the analysis scores.
+        :param rotation: A list of ability indices without duplicates.
+        :return: A list of (i, j, variant) tuples. The rotation itself comes first, as (-1, -1, rotation). Swaps have
+                 i < j, and removals have i == j.
+        """
+        variants = [(-1, -1, list(rotation))]
+        length = len(rotation)
+        for i in range(length):
+            for j in range(i + 1, length):
+                swapped = list(rotation)
+                swapped[i], swapped[j] = swapped[j], swapped[i]
+                variants.append((i, j, swapped))
+
+        for i in range(length):
+            variants.append((i, i, rotation[:i] + rotation[i + 1:]))
+
+        return variants
+
+    def analyze(self, names):
+        """
+        Function to run the sensitivity analysis of a rotation.
+        :param names: The rotation, as a list of ability names. Duplicates are dropped.
+        :return: A dict holding the rotation's names, its DPT, the sensitivity matrix described at the top of this file
+                 as a nested list, and the number of variants that were scored and taken from the cache.
+        """
+        evaluator = self.evaluator
+        rotation = evaluator._prune(evaluator.combat_sim.player.get_rotation_indices(names))
+        variants = self.get_variants(rotation)
+
+        dpts = [None]*len(variants)
+        keys = []
+        to_score = []
+        for k, (i, j, variant) in enumerate(variants):
+            key = self._cache_key(variant)
+            keys.append(key)
+            entry = self.cache.get(key)
+            if entry is not None and len(AbilityBundle.find_stale_abilities(entry["hashes"], self.ability_hashes,
+                                                                             entry["casts"])) == 0:
+                dpts[k] = entry["dpt"]
+            else:
+                to_score.append(k)
+
+        # Everything that isn't cached is scored in one batch.
+        if len(to_score) > 0:
+            scored = evaluator.evaluate_rotations([variants[k][2] for k in to_score])
+            batch_casts = evaluator.batch_casts
+            for n, k in enumerate(to_score):
+                dpts[k] = float(scored[n])
+                self.cache[keys[k]] = self._cache_entry(variants[k][2], dpts[k],
+                                                        None if batch_casts is None else batch_casts[n])
+
+            self.save_cache()
+
+        base_dpt = dpts[0]
+        matrix = np.zeros((len(rotation), len(rotation)))
+        for (i, j, variant), dpt in zip(variants[1:], dpts[1:]):
+            matrix[i, j] = matrix[j, i] = dpt - base_dpt
+
+        return {"rotation": evaluator.rotation_names(rotation),
+                "dpt": base_dpt,
+                "matrix": matrix.tolist(),
+                "scored": len(to_score),
+                "cached": len(variants) - len(to_score)}
+
+    def save_cache(self):
+        """
+        Function to write the cache to disk. Like checkpoints, it is written to a temporary file first and then moved
+        into place.
+        :return: None
+        """
+        if self.cache_path is None:
+            return
+
+        temp_path = "{}.tmp".format(self.cache_path)
+        with open(temp_path, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(temp_path, self.cache_path)
+
+    def _cache_key(self, rotation):
+        # Scores are only shared between analyses of the same kind of fight, made with the same random numbers.
+        evaluator = self.evaluator
+        return json.dumps([get_scenario(evaluator), evaluator.num_fights, evaluator.variance_reduction,
+                           evaluator.crn_seed, evaluator.rotation_names(rotation)])
+
+    def _cache_entry(self, rotation, dpt, casts):
+        """
+        Function to build the cache entry of a variant.
+        :param rotation: The variant.
+        :param dpt: Its DPT.
+        :param casts: Dict mapping ability names to the number of times the variant cast them, or None if the evaluator
+                      didn't record them. In that case every ability in the variant is treated as cast.
+        :return: The entry.
+        """
+        player = self.evaluator.combat_sim.player
+        dependencies = set(player.abilities[arg % len(player.abilities)].name for arg in rotation)
+        dependencies.add(player.auto_attack.name)
+        if casts is None:
+            casts = {name: 1 for name in dependencies}
+
+        return {"dpt": dpt,
+                "casts": casts,
+                "hashes": {name: self.ability_hashes[name] for name in sorted(dependencies)}}
+
+
+def format_matrix(result):
+    """
+    Function to lay a sensitivity matrix out as a table, with the abilities numbered down the side and across the top.
+    :param result: A dict returned by SensitivityAnalyzer.analyze().
+    :return: The table.
+    """
+    names = result["rotation"]
+    width = max(len(name) for name in names)
+    lines = ["{:>{}}  {}".format("", width + 4, " ".join("{:>7}".format(i + 1) for i in range(len(names))))]
+    for i, (name, row) in enumerate(zip(names, result["matrix"])):
+        lines.append("{:>2}. {:<{}}  {}".format(i + 1, name, width, " ".join("{:>+7.3f}".format(value) for value in row)))
+
+    return "\n".join(lines)
@@ -0,0 +1,321 @@
+"""
+File name: SharedMemoryEvaluator.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements an evaluator which scores whole batches of rotations across a pool of worker processes. Rather
+    than pickling every rotation and every result through the pool, the batch is written into a preallocated int16
+    matrix in shared memory that every worker maps when it starts. Each worker writes the DPT it measures, followed by
+    its per-fight DPT quantiles, the variance of the DPT and whether it is censored, straight into a shared float64
+    result matrix, so the only things that travel through the pool are a (start, stop) index range and a fight length
+    on the way in, and a small quantile sketch of every fight in the range on the way out. The parent merges those into
+    one sketch of the whole batch.
+
+    Under the time-to-kill objective, each range also carries the best mean kill time the parent knows of, and comes
+    back with the best one its worker knows of. Every worker then aborts evaluations against the best of the whole
+    pool as of the start of the batch, rather than only the best it has seen itself.
+
+    If the evaluator has a budget (see Budget.py), every range is also sent the deadline and an equal share of the ticks
+    left in the budget, and a worker abandons its range as soon as either runs out. Workers report the ticks they spent
+    either way, and the parent charges them to its budget once the whole batch is back.
+
+    Rotations shorter than the width of the matrix are padded with -1, which the workers strip before evaluating.
+
+    The same machinery is used to compute canonical keys (see RotationEvaluator.canonicalize()). Keys are written into
+    the result block too, which is viewed as a uint64 vector for the purpose.
+"""
+
+from Optimization.RotationEvaluator import RotationEvaluator, build_worker_evaluator, make_worker_counter, QUANTILES
+from Optimization.RotationEvaluator import _check_fight_length
+from Optimization.QuantileSketch import QuantileSketch
+from Optimization.Budget import Budget, BudgetExhausted
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import math
+import os
+
+# Number of columns in the result matrix. Each row holds a DPT, its quantiles, its variance, and whether it is censored.
+_RESULT_COLUMNS = 3 + len(QUANTILES)
+
+# Per-process worker state. These are assigned once by _init_worker() when each worker starts and reused for every task.
+_worker_evaluator = None
+_worker_blocks = None
+_worker_rotations = None
+_worker_results = None
+_worker_keys = None
+
+
+def _init_worker(cfg, worker_counter, rotations_name, results_name, shape):
+    """
+    Function to set up a worker process. This attaches to both shared memory blocks and builds the evaluator this worker
+    will use for every task it receives.
+    :param cfg: Config dict to build the evaluator with.
+    :param worker_counter: Counter the workers of the pool are numbered with. See make_worker_counter().
+    :param rotations_name: Name of the shared memory block holding the rotation matrix.
+    :param results_name: Name of the shared memory block holding the result matrix.
+    :param shape: Shape of the rotation matrix.
+    :return: None
+    """
+    global _worker_evaluator, _worker_blocks, _worker_rotations, _worker_results, _worker_keys
+
+    rotations_block = shared_memory.SharedMemory(name=rotations_name)
+    results_block = shared_memory.SharedMemory(name=results_name)
+    _worker_blocks = (rotations_block, results_block)
+    _worker_rotations = np.ndarray(shape, dtype=np.int16, buffer=rotations_block.buf)
+    _worker_results = np.ndarray((shape[0], _RESULT_COLUMNS), dtype=np.float64, buffer=results_block.buf)
+    _worker_keys = np.ndarray((shape[0],), dtype=np.uint64, buffer=results_block.buf)
+
+    _worker_evaluator = build_worker_evaluator(cfg, worker_counter)
+
+
+def _evaluate_range(task):
+    """
+    Function to evaluate every rotation in a range of rows of the shared rotation matrix, writing each result in place.
+    :param task: A (start, stop, deadline, max ticks, fight length, best kill ticks) tuple. The fight length may be
+                 None to use the configured one, and the best kill ticks are the best mean kill time the parent knows
+                 of, or None. See _run_budgeted() for the rest.
+    :return: A QuantileSketch of the DPT of every fight in the range and the best mean kill time this worker knows of,
+             or None if the budget ran out, along with the number of ticks simulated.
+    """
+    start, stop, deadline, max_ticks, fight_length, best_kill_ticks = task
+
+    # Every worker aborts kill time evaluations against the best of the whole pool, not just the best it has seen.
+    if best_kill_ticks is not None and (_worker_evaluator.best_kill_ticks is None
+                                        or best_kill_ticks < _worker_evaluator.best_kill_ticks):
+        _worker_evaluator.best_kill_ticks = best_kill_ticks
+
+    def evaluate():
+        # Converting the whole block to Python ints at once is much faster than pulling numpy scalars out one at a time.
+        rows = _worker_rotations[start:stop].tolist()
+        dpts = _worker_evaluator.evaluate_rotations([[arg for arg in row if arg >= 0] for row in rows], fight_length)
+        _worker_results[start:stop] = [[dpt] + quantiles + [variance, censored] for dpt, quantiles, variance, censored
+                                       in zip(dpts, _worker_evaluator.batch_quantiles,
+                                              _worker_evaluator.batch_variances, _worker_evaluator.batch_censored)]
+        return _worker_evaluator.batch_sketch, _worker_evaluator.best_kill_ticks
+
+    return _run_budgeted(evaluate, deadline, max_ticks)
+
+
+def _canonicalize_range(task):
+    """
+    Function to compute the canonical key of every rotation in a range of rows of the shared rotation matrix, writing
+    each key in place.
+    :param task: A (start, stop, deadline, max ticks) tuple. See _run_budgeted().
+    :return: The number of rotations canonicalized, or None if the budget ran out, along with the number of ticks
+             simulated.
+    """
+    start, stop, deadline, max_ticks = task
+
+    def canonicalize():
+        rows = _worker_rotations[start:stop].tolist()
+        for i, row in enumerate(rows):
+            rotation = [arg for arg in row if arg >= 0]
+            _worker_keys[start + i] = _worker_evaluator.canonicalize(rotation)
+        return stop - start
+
+    return _run_budgeted(canonicalize, deadline, max_ticks)
+
+
+def _run_budgeted(function, deadline, max_ticks):
+    """
+    Function to run some work with this worker's evaluator under a budget.
+    :param function: Function doing the work.
+    :param deadline: The time.monotonic() value to stop at, or None.
+    :param max_ticks: Maximum number of ticks to simulate, or None.
+    :return: The return value of the function, or None if the budget ran out, along with the number of ticks simulated.
+    """
+    if deadline is not None or max_ticks is not None:
+        _worker_evaluator.budget = Budget(max_ticks=max_ticks, deadline=deadline)
+
+    ticks = _worker_evaluator.total_ticks
+    try:
+        result = function()
+    except BudgetExhausted:
+        result = None
+    finally:
+        _worker_evaluator.budget = None
+
+    return result, _worker_evaluator.total_ticks - ticks
+
+
+class SharedMemoryEvaluator(RotationEvaluator):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. This is handed to every worker to build its own evaluator, so it must be picklable.
+        """
+        super().__init__(cfg)
+        self.num_workers = cfg.get("num_workers", os.cpu_count())
+        self.capacity = cfg["returns_per_update"]
+        self.width = cfg["rotation_length"]
+
+        self.pool = None
+        self.rotations_block = None
+        self.results_block = None
+        self.rotations = None
+        self.results = None
+        self.keys = None
+
+    def initialize(self):
+        """
+        Function to build the local simulator (used for ability names and one-off evaluations), allocate the shared
+        buffers, and start the worker pool.
+        :return: None
+        """
+        super().initialize()
+        self._start_pool()
+
+    def evaluate_rotations(self, rotations, fight_length=None):
+        """
+        Function to evaluate a batch of rotations across the worker pool.
+        :param rotations: A list of rotations, or a 2D integer array with one rotation per row padded with -1.
+        :param fight_length: Optional length of each fight in ticks. Defaults to the length from the config object.
+        :return: A float64 array containing the DPT of each rotation, in the same order as the input. The quantiles of
+                 each rotation, their variances, whether each is censored, and a sketch of every fight are recorded in
+                 self.batch_quantiles, self.batch_variances, self.batch_censored and self.batch_sketch. Cast counts
+                 aren't sent back from the workers, so self.batch_casts is None.
+        """
+        self.batch_quantiles = []
+        self.batch_variances = []
+        self.batch_casts = None
+        self.batch_censored = []
+        self.batch_sketch = QuantileSketch()
+        num = self._write_rotations(rotations)
+        if num == 0:
+            return np.zeros(0, dtype=np.float64)
+
+        if fight_length is not None:
+            _check_fight_length(fight_length)
+
+        for sketch, best_kill_ticks in self._map_ranges(_evaluate_range, num, fight_length, self.best_kill_ticks):
+            self.batch_sketch.merge(sketch)
+            if best_kill_ticks is not None and (self.best_kill_ticks is None or best_kill_ticks < self.best_kill_ticks):
+                self.best_kill_ticks = best_kill_ticks
+
+        self.batch_quantiles = self.results[:num, 1:-2].tolist()
+        self.batch_variances = self.results[:num, -2].tolist()
+        self.batch_censored = (self.results[:num, -1] != 0).tolist()
+        return self.results[:num, 0].copy()
+
+    def canonicalize_rotations(self, rotations):
+        """
+        Function to compute the canonical key of a batch of rotations across the worker pool.
+        :param rotations: A list of rotations, or a 2D integer array with one rotation per row padded with -1.
+        :return: A list containing the key of each rotation, in the same order as the input.
+        """
+        num = self._write_rotations(rotations)
+        if num == 0:
+            return []
+
+        self._map_ranges(_canonicalize_range, num)
+        return self.keys[:num].tolist()
+
+    def _write_rotations(self, rotations):
+        """
+        Function to write a batch of rotations into shared memory, growing the shared buffers first if they are too
+        small to hold it.
+        :param rotations: A list of rotations, or a 2D integer array with one rotation per row padded with -1.
+        :return: The number of rotations written.
+        """
+        num = len(rotations)
+        if num == 0:
+            return 0
+
+        width = max(len(rotation) for rotation in rotations)
+        if num > self.capacity or width > self.width:
+            self.capacity = max(num, self.capacity)
+            self.width = max(width, self.width)
+            self.close()
+            self._start_pool()
+
+        # Write the batch into shared memory. Everything past the end of a rotation is padding. When every rotation has
+        # the same length the whole batch can be copied in one go.
+        self.rotations[:num] = -1
+        if isinstance(rotations, np.ndarray):
+            self.rotations[:num, :rotations.shape[1]] = rotations
+        elif all(len(rotation) == width for rotation in rotations):
+            self.rotations[:num, :width] = np.asarray(rotations, dtype=np.int16)
+        else:
+            for i, rotation in enumerate(rotations):
+                self.rotations[i, :len(rotation)] = rotation
+
+        return num
+
+    def _map_ranges(self, function, num, *arguments):
+        """
+        Function to split the first num rows of the shared rotation matrix into ranges and run a worker function on each.
+        Each range carries the deadline and an equal share of the remaining ticks of this evaluator's budget, and the
+        ticks spent by every range are charged to it once they are all done.
+        :param function: Worker function taking a (start, stop, deadline, max ticks, *arguments) tuple and returning a
+                         (value, ticks) pair, where the value is None if the budget ran out.
+        :param num: Number of rows to process.
+        :param arguments: Extra arguments passed along with every range.
+        :return: A list containing the value returned by the worker function for each range.
+        """
+        # Hand each worker a handful of row ranges. A few ranges per worker keeps the load balanced when some rotations
+        # are slower to simulate than others.
+        chunk_size = max(1, num // (self.num_workers*4))
+        starts = list(range(0, num, chunk_size))
+
+        deadline = None
+        max_ticks = None
+        if self.budget is not None:
+            self.budget.check()
+            deadline = self.budget.deadline
+            if self.budget.max_ticks is not None:
+                max_ticks = math.ceil(self.budget.remaining_ticks() / len(starts))
+
+        ranges = [(start, min(start + chunk_size, num), deadline, max_ticks) + arguments for start in starts]
+        results = self.pool.map(function, ranges, chunksize=1)
+
+        ticks = sum(range_ticks for value, range_ticks in results)
+        self.total_ticks += ticks
+        if self.budget is not None:
+            self.budget.spend(ticks)
+
+        values = [value for value, range_ticks in results]
+        if None in values:
+            raise BudgetExhausted(self.budget.exhausted() or "ticks")
+
+        return values
+
+    def close(self):
+        """
+        Function to shut down the worker pool and release the shared memory blocks.
+        :return: None
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        # The numpy views must be dropped before the blocks can be closed.
+        self.rotations = None
+        self.results = None
+        self.keys = None
+        for block in (self.rotations_block, self.results_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+
+        self.rotations_block = None
+        self.results_block = None
+
+    def _start_pool(self):
+        """
+        Function to allocate shared buffers large enough for the current capacity and start a pool of workers attached
+        to them.
+        :return: None
+        """
+        shape = (self.capacity, self.width)
+        rotations_size = shape[0]*shape[1]*np.dtype(np.int16).itemsize
+        results_size = shape[0]*_RESULT_COLUMNS*np.dtype(np.float64).itemsize
+        self.rotations_block = shared_memory.SharedMemory(create=True, size=rotations_size)
+        self.results_block = shared_memory.SharedMemory(create=True, size=results_size)
+        self.rotations = np.ndarray(shape, dtype=np.int16, buffer=self.rotations_block.buf)
+        self.results = np.ndarray((shape[0], _RESULT_COLUMNS), dtype=np.float64, buffer=self.results_block.buf)
+        self.keys = np.ndarray((shape[0],), dtype=np.uint64, buffer=self.results_block.buf)
+
+        init_args = (self.cfg, make_worker_counter(), self.rotations_block.name, self.results_block.name, shape)
+        self.pool = mp.Pool(self.num_workers, initializer=_init_worker, initargs=init_args)
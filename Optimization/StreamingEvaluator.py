@@ -0,0 +1,251 @@
+"""
+File name: StreamingEvaluator.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a pipeline for scoring very large batches of rotations that were produced somewhere else. The
+    rotations are read one per line from a JSON lines file (or stdin), either as a bare list of ability names or as an
+    object with the list stored under "rotation". Lines are grouped into chunks and evaluated by a pool of worker
+    processes, and results are written out as soon as they are ready, so memory use depends only on the chunk size and
+    the number of chunks allowed in flight, never on the size of the input.
+
+    Backpressure is applied by refusing to read any more input while too many chunks are in flight (or, when input
+    order is being preserved, waiting in the buffer behind a slow chunk).
+
+    Every result records how many times each ability was cast and the content hash of each ability that could have
+    affected it (see AbilityBundle.py). In incremental mode the input is a previous results file, and only the results
+    made stale by a change in the ability data are rescored. Everything else is passed straight through.
+"""
+
+from Optimization.RotationEvaluator import build_worker_evaluator, make_worker_counter
+from Environment.Abilities import AbilityBundle
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import heapq
+import json
+import csv
+import os
+
+_worker_evaluator = None
+_worker_hashes = None
+_worker_incremental = False
+
+
+def _init_worker(cfg, worker_counter):
+    global _worker_evaluator, _worker_hashes, _worker_incremental
+    _worker_evaluator = build_worker_evaluator(cfg, worker_counter)
+    _worker_hashes = AbilityBundle.get_ability_hashes(_worker_evaluator.ability_folder)
+    _worker_incremental = cfg.get("stream_incremental", False)
+
+
+def _is_stale(data):
+    """
+    Function to check whether a previously recorded result needs to be rescored.
+    :param data: The recorded result.
+    :return: True if the result is missing anything we need, or any ability it depends on has changed in a way that
+             matters.
+    """
+    if not isinstance(data, dict) or "dpt" not in data or "hashes" not in data or "casts" not in data:
+        return True
+
+    return len(AbilityBundle.find_stale_abilities(data["hashes"], _worker_hashes, data["casts"])) > 0
+
+
+def _evaluate_chunk(chunk):
+    """
+    Function to parse and evaluate one chunk of input lines inside a worker.
+    :param chunk: A list of (line number, line text) pairs.
+    :return: A list containing one result dict per line.
+    """
+    results = []
+    for line_number, text in chunk:
+        result = {"line": line_number}
+        try:
+            data = json.loads(text)
+            if _worker_incremental and not _is_stale(data):
+                data["rescored"] = False
+                results.append(data)
+                continue
+
+            # Results that are being rescored keep the line number they were originally recorded with.
+            if isinstance(data, dict):
+                names = data["rotation"]
+                result["line"] = data.get("line", line_number)
+            else:
+                names = data
+
+            result["rotation"] = names
+            player = _worker_evaluator.combat_sim.player
+            rotation = player.get_rotation_indices(names)
+            result["dpt"] = _worker_evaluator.evaluate_rotation(rotation)
+            result["casts"] = _worker_evaluator.last_evaluation["casts"]
+            result["quantiles"] = _worker_evaluator.last_evaluation["quantiles"]
+
+            # Record the hash of every ability this result could depend on. The auto-attack is always one of them.
+            # Conditional entries depend on the ability they cast.
+            dependencies = set(player.abilities[arg % len(player.abilities)].name for arg in rotation)
+            dependencies.add(player.auto_attack.name)
+            result["hashes"] = {name: _worker_hashes[name] for name in sorted(dependencies)}
+
+            if _worker_incremental:
+                result["rescored"] = True
+
+        # A single bad line shouldn't take down a run over millions of rotations, so errors are reported per line.
+        except (ValueError, KeyError, TypeError) as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+
+        results.append(result)
+
+    return results
+
+
+def read_best_results(path, num):
+    """
+    Function to find the best rotations in a JSON lines results file without loading the whole file.
+    :param path: Path of the results file.
+    :param num: Number of rotations to return.
+    :return: A list of up to num rotations (lists of ability names), best first.
+    """
+    def scored_rotations():
+        with open(path, 'r') as f:
+            for text in f:
+                text = text.strip()
+                if len(text) == 0:
+                    continue
+
+                result = json.loads(text)
+                if result.get("dpt") is not None:
+                    yield result["dpt"], result["rotation"]
+
+    return [rotation for dpt, rotation in heapq.nlargest(num, scored_rotations(), key=lambda pair: pair[0])]
+
+
+class JsonLinesWriter(object):
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, result):
+        self.file.write("{}\n".format(json.dumps(result)))
+
+
+class CsvWriter(object):
+    COLUMNS = ("line", "dpt", "rotation", "error")
+
+    def __init__(self, file):
+        self.writer = csv.writer(file)
+        self.writer.writerow(CsvWriter.COLUMNS)
+
+    def write(self, result):
+        row = [result.get("line"), result.get("dpt", ""), json.dumps(result.get("rotation", [])), result.get("error", "")]
+        self.writer.writerow(row)
+
+
+class StreamingEvaluator(object):
+    WRITERS = {"jsonl": JsonLinesWriter, "csv": CsvWriter}
+
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. The evaluator settings in it are handed to every worker, and the following optional
+                    entries control the stream itself:
+                        num_workers: Number of worker processes.
+                        stream_chunk_size: Number of lines sent to a worker at once.
+                        stream_max_in_flight: Maximum number of chunks submitted but not yet written.
+                        stream_ordered: Whether to write results in input order.
+                        stream_incremental: Whether to only rescore results made stale by ability data changes.
+        """
+        self.cfg = cfg
+        self.num_workers = cfg.get("num_workers") or os.cpu_count()
+        self.chunk_size = cfg.get("stream_chunk_size") or 256
+        self.max_in_flight = cfg.get("stream_max_in_flight") or 2*self.num_workers
+        self.ordered = cfg.get("stream_ordered", True)
+
+        self.num_written = 0
+        self.num_errors = 0
+        self.num_rescored = 0
+
+    def run(self, input_file, output_file, output_format="jsonl"):
+        """
+        Function to evaluate every rotation in a file and write the results to another file.
+        :param input_file: Open text file to read JSON lines from.
+        :param output_file: Open text file to write results to.
+        :param output_format: Either "jsonl" or "csv".
+        :return: The number of results written.
+        """
+        writer = StreamingEvaluator.WRITERS[output_format](output_file)
+        chunks = self._read_chunks(input_file)
+
+        # Chunks that have been submitted, keyed by future, and the sequence number of each one.
+        pending = {}
+
+        # Finished chunks waiting for an earlier chunk before they can be written. Only used when preserving order.
+        finished = {}
+        next_to_write = 0
+        next_to_submit = 0
+        exhausted = False
+
+        with ProcessPoolExecutor(self.num_workers, initializer=_init_worker,
+                                 initargs=(self.cfg, make_worker_counter())) as executor:
+            while True:
+
+                # Read and submit more input until we hit the in-flight limit. Chunks sitting in the reorder buffer
+                # count against the limit, so one slow chunk can't cause the buffer to grow without bound.
+                while not exhausted and next_to_submit - next_to_write < self.max_in_flight:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+
+                    future = executor.submit(_evaluate_chunk, chunk)
+                    pending[future] = next_to_submit
+                    next_to_submit += 1
+
+                if len(pending) == 0:
+                    break
+
+                done, not_done = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    sequence = pending.pop(future)
+                    if self.ordered:
+                        finished[sequence] = future.result()
+                    else:
+                        self._write_chunk(writer, future.result())
+                        next_to_write += 1
+
+                # Write every chunk that is now at the front of the line.
+                while next_to_write in finished:
+                    self._write_chunk(writer, finished.pop(next_to_write))
+                    next_to_write += 1
+
+                output_file.flush()
+
+        return self.num_written
+
+    def _read_chunks(self, input_file):
+        """
+        Generator to lazily group the lines of a file into chunks. Blank lines are skipped but still counted, so line
+        numbers in the output always match the input.
+        :param input_file: Open text file to read from.
+        :return: Yields lists of (line number, line text) pairs.
+        """
+        chunk = []
+        for line_number, text in enumerate(input_file, start=1):
+            text = text.strip()
+            if len(text) == 0:
+                continue
+
+            chunk.append((line_number, text))
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+
+        if len(chunk) > 0:
+            yield chunk
+
+    def _write_chunk(self, writer, results):
+        for result in results:
+            writer.write(result)
+            self.num_written += 1
+            if "error" in result:
+                self.num_errors += 1
+            if result.get("rescored", False):
+                self.num_rescored += 1
@@ -0,0 +1,232 @@
+"""
+File name: SweepRunner.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    This file implements a runner which finds the best rotation for every scenario in a grid, e.g. every combination of
+    weapon speed, combat style and enemy setup. The grid is declarative. It maps config keys to lists of values, and a
+    scenario (cell) is one choice of value for every key. A value can be a plain value, which is just assigned to its
+    key, or a dict, which is merged into the config as a whole and labelled by its "name" entry. That lets one grid axis
+    set several keys at once, which is handy for enemy setups:
+
+        {"attack_delay": [3, 4],
+         "ability_folder": ["ranged"],
+         "enemy": [{"name": "dummy"},
+                   {"name": "stun immune", "stun_immune": true}]}
+
+    Cells are run one optimization each across a pool of worker processes. Every ability folder in the grid is compiled
+    once up front, so workers only ever load the finished bundle from disk, and a worker that runs several cells of the
+    same style only loads it once. Each completed cell is appended to a JSON lines checkpoint as soon as it finishes, and
+    cells already in the checkpoint are skipped, so an interrupted sweep picks up where it left off. The results of every
+    cell are written to one consolidated CSV table at the end.
+"""
+
+from Optimization.RotationOptimizer import RotationOptimizer
+from Environment.Abilities import AbilityBundle
+import multiprocessing as mp
+import numpy as np
+import itertools
+import random
+import json
+import time
+import zlib
+import csv
+import os
+
+
+def build_cells(grid):
+    """
+    Function to expand a grid into every cell it describes.
+    :param grid: Dict mapping config keys to lists of values. See the description at the top of this file.
+    :return: A list of (cell id, labels, config overrides) tuples. The labels map each grid key to the label of the value
+             chosen for it.
+    """
+    keys = sorted(grid.keys())
+    cells = []
+    for values in itertools.product(*[grid[key] for key in keys]):
+        labels = {}
+        overrides = {}
+        for key, value in zip(keys, values):
+            if isinstance(value, dict):
+                overrides.update({name: setting for name, setting in value.items() if name != "name"})
+                labels[key] = value.get("name", json.dumps(value, sort_keys=True))
+            else:
+                overrides[key] = value
+                labels[key] = value
+
+        cell_id = "|".join("{}={}".format(key, labels[key]) for key in keys)
+        cells.append((cell_id, labels, overrides))
+
+    return cells
+
+
+def _run_cell(task):
+    """
+    Function to run one optimization inside a worker process.
+    :param task: A (cell id, labels, config) tuple. The config is complete except for the RNG.
+    :return: A dict describing the result of the cell.
+    """
+    cell_id, labels, cfg = task
+
+    # Seed everything from the cell id, so a cell produces the same result no matter which worker runs it or when.
+    seed = zlib.crc32("{}|{}".format(cfg.get("seed", 0), cell_id).encode("utf-8"))
+    random.seed(seed)
+    np.random.seed(seed)
+    cfg["rng"] = np.random.RandomState(seed)
+
+    # The rotation length depends on the style, so it is filled in here unless the grid sets it.
+    num_abilities = len(AbilityBundle.load_bundle(cfg.get("ability_folder", "ranged"))["abilities"])
+    cfg.setdefault("num_abilities", num_abilities)
+    cfg.setdefault("rotation_length", num_abilities)
+
+    t1 = time.time()
+    optimizer = RotationOptimizer(cfg)
+    optimizer.initialize()
+    try:
+        for epoch in range(cfg["sweep_epochs"]):
+            optimizer.epoch()
+            optimizer.evaluator.flush_store()
+    finally:
+        optimizer.close()
+
+    quantiles = optimizer.best_quantiles
+    if quantiles is None:
+        quantiles = [None, None, None]
+
+    result = {"cell": cell_id}
+    result.update(labels)
+    result.update({"best_dps": float(optimizer.best_dps),
+                   "p10": quantiles[0],
+                   "p50": quantiles[1],
+                   "p90": quantiles[2],
+                   "best_rotation": optimizer.best_rotation,
+                   "epochs": cfg["sweep_epochs"],
+                   "time": time.time()-t1})
+    return result
+
+
+class SweepRunner(object):
+    def __init__(self, cfg):
+        """
+        :param cfg: Config dict. Everything in it is the base config of every cell, and the following entries control
+                    the sweep itself:
+                        sweep_grid: The grid to sweep over. See the description at the top of this file.
+                        sweep_epochs: Number of optimizer epochs to run for each cell.
+                        sweep_checkpoint: Optional path of the JSON lines file completed cells are recorded in.
+                        sweep_output: Optional path of the CSV file to write the consolidated results to.
+                        num_workers: Number of worker processes. Every cell is run on a single process.
+        """
+        self.cfg = cfg
+        self.grid = cfg["sweep_grid"]
+        self.num_workers = cfg.get("num_workers") or os.cpu_count()
+        self.checkpoint_path = cfg.get("sweep_checkpoint")
+        self.output_path = cfg.get("sweep_output")
+
+        self.results = []
+
+    def run(self):
+        """
+        Function to run every cell of the grid that hasn't already been completed.
+        :return: A list containing the result of every cell in the grid, in grid order.
+        """
+        cells = build_cells(self.grid)
+        completed = self.load_checkpoint()
+
+        # The base config for every cell. Each cell runs a single-process optimizer, and builds its own RNG.
+        base_cfg = {key: value for key, value in self.cfg.items() if key not in ("rng", "sweep_grid")}
+        base_cfg["num_workers"] = 1
+        base_cfg.setdefault("sweep_epochs", 10)
+
+        tasks = []
+        for cell_id, labels, overrides in cells:
+            if cell_id in completed:
+                continue
+
+            cfg = dict(base_cfg)
+            cfg.update(overrides)
+            tasks.append((cell_id, labels, cfg))
+
+        # Compile every style we need once, here, instead of letting every worker race to do it.
+        for folder in sorted(set(task[2].get("ability_folder", "ranged") for task in tasks)):
+            AbilityBundle.load_bundle(folder)
+
+        print("Running {} of {} cells ({} already completed)".format(len(tasks), len(cells), len(cells) - len(tasks)))
+
+        if len(tasks) > 0:
+            with mp.Pool(min(self.num_workers, len(tasks))) as pool:
+                for result in pool.imap_unordered(_run_cell, tasks):
+                    completed[result["cell"]] = result
+                    self.write_checkpoint(result)
+                    print("Finished {} in {:.2f}s. Best DPS: {}".format(result["cell"], result["time"],
+                                                                        result["best_dps"]))
+
+        self.results = [completed[cell_id] for cell_id, labels, overrides in cells]
+        if self.output_path is not None:
+            self.write_table(self.output_path)
+
+        return self.results
+
+    def load_checkpoint(self):
+        """
+        Function to read every completed cell from the checkpoint file, if there is one.
+        :return: A dict mapping cell ids to results.
+        """
+        completed = {}
+        if self.checkpoint_path is None or not os.path.exists(self.checkpoint_path):
+            return completed
+
+        with open(self.checkpoint_path, 'r') as f:
+            for text in f:
+                text = text.strip()
+
+                # A line cut short by an interrupted write is just a cell we'll have to run again.
+                try:
+                    result = json.loads(text)
+                except ValueError:
+                    continue
+
+                completed[result["cell"]] = result
+
+        return completed
+
+    def write_checkpoint(self, result):
+        if self.checkpoint_path is None:
+            return
+
+        with open(self.checkpoint_path, 'a') as f:
+            f.write("{}\n".format(json.dumps(result)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write_table(self, path):
+        """
+        Function to write the results of every cell as one CSV table.
+        :param path: Path of the CSV file to write.
+        :return: None
+        """
+        columns = sorted(self.grid.keys()) + ["best_dps", "p10", "p50", "p90", "epochs", "time", "best_rotation"]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for result in self.results:
+                row = [result.get(column) for column in columns]
+                row[-1] = json.dumps(result["best_rotation"])
+                writer.writerow(row)
+
+    def format_table(self):
+        """
+        Function to format the results of every cell as a plain text table, best cell first.
+        :return: The table as a string.
+        """
+        columns = sorted(self.grid.keys())
+        rows = [[str(result[column]) for column in columns] + ["{:.3f}".format(result["best_dps"])]
+                for result in sorted(self.results, key=lambda result: -result["best_dps"])]
+        header = columns + ["best_dps"]
+        widths = [max(len(row[i]) for row in rows + [header]) for i in range(len(header))]
+
+        lines = ["  ".join(value.ljust(width) for value, width in zip(header, widths))]
+        for row in rows:
+            lines.append("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+        return "\n".join(lines)
@@ -1,3 +1,52 @@
-from .RotationEvaluator import RotationEvaluator
-from .RotationGenerator import RotationGenerator
-from .RotationOptimizer import RotationOptimizer
+# Everything in this package is loaded lazily, so that importing one light piece (like the RotationEvaluator) doesn't
+# drag in numpy, multiprocessing and asyncio along with every other class in here.
+import importlib
+import types
+import sys
+
+_lazy_classes = {
+    "RotationEvaluator": ".RotationEvaluator",
+    "RotationGenerator": ".RotationGenerator",
+    "SharedMemoryEvaluator": ".SharedMemoryEvaluator",
+    "MetricsLogger": ".MetricsLogger",
+    "MemoryProfiler": ".MemoryProfiler",
+    "RotationOptimizer": ".RotationOptimizer",
+    "AsyncRotationOptimizer": ".AsyncRotationOptimizer",
+    "StreamingEvaluator": ".StreamingEvaluator",
+    "QuantileSketch": ".QuantileSketch",
+    "SweepRunner": ".SweepRunner",
+    "ParallelTemperingOptimizer": ".ParallelTemperingOptimizer",
+    "BarOptimizer": ".BarOptimizer",
+    "ScoringService": ".ScoringService",
+    "ScoringClient": ".ScoringService",
+    "EvaluationStore": ".EvaluationStore",
+    "TrainingResult": ".RotationOptimizer",
+    "Budget": ".Budget",
+    "BudgetExhausted": ".Budget",
+    "SensitivityAnalyzer": ".SensitivityAnalyzer",
+    "ReplicationRunner": ".ReplicationRunner",
+}
+
+
+class _LazyPackage(types.ModuleType):
+    def __getattr__(self, name):
+        if name in _lazy_classes:
+            module = importlib.import_module(_lazy_classes[name], __name__)
+            value = getattr(module, name)
+            super().__setattr__(name, value)
+            return value
+
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+    def __setattr__(self, name, value):
+        # Importing a submodule binds it to the package under its own name. Every class in here lives in a module with
+        # the same name, so without this the module would hide the class.
+        if name in _lazy_classes and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+    def __dir__(self):
+        return sorted(list(self.__dict__.keys()) + list(_lazy_classes.keys()))
+
+
+sys.modules[__name__].__class__ = _LazyPackage
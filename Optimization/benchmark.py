@@ -0,0 +1,154 @@
+"""
+File name: benchmark.py
+Author: Matthew Allen
+Date: 7/12/20
+
+Description:
+    Microbenchmarks for the evaluation machinery. These are meant to be run by hand when changing anything about how
+    rotations get to and from the worker processes, and report numbers rather than pass or fail.
+"""
+
+from Optimization import SharedMemoryEvaluator, BarOptimizer
+from Optimization.BarOptimizer import format_bar_stats
+from Optimization.RotationEvaluator import build_worker_evaluator, make_worker_counter
+from Environment.Abilities import AbilityBundle
+import multiprocessing as mp
+import numpy as np
+import time
+import os
+
+_map_evaluator = None
+
+
+def _init_map_worker(cfg, worker_counter):
+    global _map_evaluator
+    _map_evaluator = build_worker_evaluator(cfg, worker_counter)
+
+
+def _evaluate_one(rotation):
+    return _map_evaluator.evaluate_rotation(rotation)
+
+
+def _random_population(num_rotations, num_abilities, seed=0):
+    rng = np.random.RandomState(seed)
+    return [[int(arg) for arg in rng.permutation(num_abilities)] for _ in range(num_rotations)]
+
+
+def time_pool_map(cfg, rotations, repeats=5):
+    """
+    Function to time evaluating a population with a plain Pool.map, which pickles every rotation on the way in and every
+    result on the way out.
+    :param cfg: Config dict used to build each worker's evaluator.
+    :param rotations: Population to evaluate.
+    :param repeats: Number of times to evaluate the population. The fastest run is reported.
+    :return: The fastest wall-clock time, in seconds, taken to evaluate the population.
+    """
+    times = []
+    with mp.Pool(cfg["num_workers"], initializer=_init_map_worker,
+                 initargs=(cfg, make_worker_counter())) as pool:
+        for i in range(repeats):
+            t1 = time.perf_counter()
+            pool.map(_evaluate_one, rotations)
+            times.append(time.perf_counter() - t1)
+
+    return min(times)
+
+
+def time_shared_memory(cfg, rotations, repeats=5):
+    """
+    Function to time evaluating a population through the SharedMemoryEvaluator.
+    :param cfg: Config dict used to build the evaluator.
+    :param rotations: Population to evaluate.
+    :param repeats: Number of times to evaluate the population. The fastest run is reported.
+    :return: The fastest wall-clock time, in seconds, taken to evaluate the population.
+    """
+    evaluator = SharedMemoryEvaluator(cfg)
+    evaluator.initialize()
+
+    times = []
+    try:
+        for i in range(repeats):
+            t1 = time.perf_counter()
+            evaluator.evaluate_rotations(rotations)
+            times.append(time.perf_counter() - t1)
+    finally:
+        evaluator.close()
+
+    return min(times)
+
+
+def run_transport_benchmark(num_rotations=3000, num_workers=None):
+    """
+    Function to compare the per-task overhead of Pool.map against the shared memory transport. Each transport is timed
+    once with fights so short that almost all of the time is overhead, and once with the normal fight settings.
+    :param num_rotations: Number of rotations in the benchmark population.
+    :param num_workers: Number of worker processes to use. Defaults to one per core.
+    :return: None
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    num_abilities = len(AbilityBundle.load_bundle("ranged")["abilities"])
+    rotations = _random_population(num_rotations, num_abilities)
+
+    settings = (("overhead only", 1, 1), ("full evaluation", 10, 1000//2))
+    for label, num_fights, fight_length in settings:
+        cfg = {
+            "num_workers": num_workers,
+            "returns_per_update": num_rotations,
+            "rotation_length": num_abilities,
+            "num_fights": num_fights,
+            "fight_length": fight_length
+        }
+
+        # Full evaluations are far slower, so fewer rotations and repeats are plenty to see the difference.
+        population = rotations if num_fights == 1 else rotations[:num_rotations//10]
+        repeats = 5 if num_fights == 1 else 1
+
+        map_time = time_pool_map(cfg, population, repeats)
+        shm_time = time_shared_memory(cfg, population, repeats)
+        num = len(population)
+
+        print("{} ({} rotations, {} workers)"
+              "\n    Pool.map:      {:.4f}s total, {:.2f}us per task"
+              "\n    Shared memory: {:.4f}s total, {:.2f}us per task"
+              "\n    Speedup: {:.2f}x".
+              format(label, num, num_workers,
+                     map_time, 1e6*map_time/num,
+                     shm_time, 1e6*shm_time/num,
+                     map_time/shm_time))
+
+
+def run_bar_scaling(bar_sizes=(4, 6, 8, 10), num_workers=None):
+    """
+    Function to report how the staged bar search in BarOptimizer.py scales with the size of the bar.
+    :param bar_sizes: Bar sizes to run the search for.
+    :param num_workers: Number of worker processes to use. Defaults to a single process.
+    :return: None
+    """
+    num_abilities = len(AbilityBundle.load_bundle("ranged")["abilities"])
+    for bar_size in bar_sizes:
+        cfg = {
+            "rng": np.random.RandomState(0),
+            "stdev": 6.0,
+            "returns_per_update": 300,
+            "num_abilities": num_abilities,
+            "rotation_length": bar_size,
+            "num_workers": num_workers or 1
+        }
+
+        optimizer = BarOptimizer(cfg)
+        optimizer.initialize()
+        t1 = time.perf_counter()
+        try:
+            optimizer.optimize_bar()
+        finally:
+            optimizer.close()
+        total_time = time.perf_counter() - t1
+
+        print("{}\n    Best DPS: {:.3f} in {:.2f}s".format(format_bar_stats(optimizer.bar_stats), optimizer.best_dps,
+                                                           total_time))
+
+
+if __name__ == "__main__":
+    run_transport_benchmark()
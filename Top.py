@@ -4,49 +4,643 @@ Author: Matthew Allen
 Date: 7/12/20
 
 Description:
-    This is the entry point of the program. It will load and configure the environment and optimizer, then start training.
+    This is the entry point of the program. It provides a small command line interface with the following commands:
+        optimize           Load and configure the environment and optimizer, then start training. This is the default.
+        evaluate           Score a single rotation, given as a list of ability names.
+        sensitivity        Measure how much every swap and removal of an ability changes the DPT of a rotation.
+        stream             Score every rotation in a JSON lines file (or stdin), writing results as they finish.
+        reevaluate         Rescore only the results in a previous stream output made stale by ability data changes.
+        serve              Run a local service which scores rotations on request.
+        score              Ask a running service to score a rotation.
+        sweep              Find the best rotation for every scenario in a grid of weapon speeds, styles and enemies.
+        replicate          Compare optimizer configurations over many seeded runs, dropping the worst as it goes.
+        top                List the best rotations in an evaluation store.
+        golden             Check the simulator, or a faster backend, against the recorded golden traces.
+        bench              Run the evaluation microbenchmarks.
+        compile-abilities  Compile an ability folder into the bundle that players load from.
+
+    Nothing heavy is imported at module level. Each command imports only what it needs, so quick commands like evaluate
+    don't pay for numpy or the optimizer.
 """
 
-#Seed every RNG library that we might need immediately for reproducibility.
-GLOBAL_RNG_SEED = 0
+import argparse
 import random
-random.seed(GLOBAL_RNG_SEED)
-import numpy as np
-np.random.seed(GLOBAL_RNG_SEED)
+import time
+import sys
 
-from Optimization import RotationOptimizer
-from Environment import test
-import os
+GLOBAL_RNG_SEED = 0
 
-def main():
+
+def seed_everything(seed, use_numpy=True):
     """
-    Main function. This loads and starts the optimizer and environment.
-    :return:
+    Function to seed every RNG library that we might need for reproducibility.
+    :param seed: Seed to use.
+    :param use_numpy: Whether to seed numpy as well. Commands that never touch numpy skip this to avoid importing it.
+    :return: None
     """
+    random.seed(seed)
+    if use_numpy:
+        import numpy as np
+        np.random.seed(seed)
+
+
+def optimize(args):
+    """
+    Function to load and start the optimizer and environment.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed)
+
+    import numpy as np
+    from Environment.Abilities import AbilityBundle
+    from Optimization import RotationOptimizer, AsyncRotationOptimizer, ParallelTemperingOptimizer, BarOptimizer
 
     rng = np.random.RandomState(123)
     stdev = 6.0
     returns_per_update = 300
-    step_size = 0.01
+    num_workers = args.workers
 
-    # Off-by-one because the auto attack JSON file is in this folder.
-    num_abilities = len(list(os.listdir("resources/json_data/abilities/ranged")))-1
+    num_abilities = len(AbilityBundle.load_bundle(args.folder)["abilities"])
     rotation_length = num_abilities
-
+    if args.bar_size is not None:
+        rotation_length = min(args.bar_size, num_abilities)
 
     cfg = {
         "rng": rng,
+        "seed": args.seed,
         "stdev": stdev,
         "returns_per_update": returns_per_update,
-        "step_size": step_size,
         "rotation_length": rotation_length,
-        "num_abilities": num_abilities
+        "num_abilities": num_abilities,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "num_workers": num_workers,
+        "metrics_path": args.metrics,
+        "checkpoint_path": args.checkpoint,
+        "evaluation_store": args.store,
+        "conditional": args.conditional,
+        "update_rule": "es" if args.es else "ga",
+        "warm_start": args.warm_start,
+        "warm_start_count": args.warm_start_count,
+        "memory_profile_interval": args.memory_profile
     }
 
-    optimizer = RotationOptimizer(cfg)
+    try:
+        if args.use_async:
+            optimizer = AsyncRotationOptimizer(cfg)
+        elif args.tempering:
+            optimizer = ParallelTemperingOptimizer(cfg)
+        elif rotation_length < num_abilities:
+            optimizer = BarOptimizer(cfg)
+        else:
+            optimizer = RotationOptimizer(cfg)
+    except ValueError as e:
+        raise SystemExit(e)
+
     optimizer.initialize()
-    optimizer.train()
+    try:
+        result = optimizer.train(time_limit=args.time_limit, max_ticks=args.max_ticks, target_dpt=args.target_dpt)
+    finally:
+        optimizer.close()
+
+    interval = result.confidence_interval()
+    print("Stopped after {} epochs, {:.2f}s and {} ticks ({})".format(result.epochs, result.time, result.ticks,
+                                                                     result.stop_reason))
+    print("Best DPS: {}{}".format(result.best_dps, "" if interval is None else
+                                  " (95% CI {:.3f} to {:.3f})".format(*interval)))
+    print("Best Rotation: {}".format(result.best_rotation))
+
+
+def evaluate(args):
+    """
+    Function to score a single rotation.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed, use_numpy=False)
+
+    from Optimization.RotationEvaluator import RotationEvaluator
+
+    cfg = {
+        "num_fights": args.fights,
+        "fight_length": args.ticks,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp
+    }
+
+    try:
+        evaluator = RotationEvaluator(cfg)
+    except ValueError as e:
+        raise SystemExit(e)
+    evaluator.initialize()
+
+    try:
+        rotation = evaluator.combat_sim.player.get_rotation_indices(args.abilities)
+    except ValueError as e:
+        raise SystemExit(e)
+
+    # Tracing needs numpy, so it is only imported if a trace was asked for.
+    if args.trace is not None:
+        from Environment.TraceRecorder import TraceRecorder
+        evaluator.combat_sim.trace = TraceRecorder(evaluator.combat_sim.player, args.trace_capacity,
+                                                   args.trace_sample_rate)
+
+    print(evaluator.evaluate_rotation(rotation))
+    if args.objective == "ttk":
+        print("Mean kill time: {:.2f} ticks".format(evaluator.last_evaluation["mean_kill_ticks"]))
+    if args.variance_reduction is not None:
+        print("Standard error: {:.6f} ({:.1%} of the variance of a plain average removed by {})".format(
+            evaluator.last_evaluation["variance"]**0.5, evaluator.last_evaluation["variance_reduction"],
+            args.variance_reduction))
+
+    if args.trace is not None:
+        trace = evaluator.combat_sim.trace
+        if args.trace.endswith(".npy"):
+            trace.save(args.trace)
+        else:
+            trace.save_columns(args.trace)
+        print("Traced {} of {} casts ({} dropped) to {}".format(trace.num_recorded, trace.num_seen, trace.num_dropped(),
+                                                              args.trace))
+
+
+def sensitivity(args):
+    """
+    Function to run the sensitivity analysis of a rotation.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    import json
+    from Optimization.SensitivityAnalyzer import SensitivityAnalyzer, format_matrix
+
+    cfg = {
+        "seed": args.seed,
+        "num_fights": args.fights,
+        "fight_length": args.ticks,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "ttk_cutoff": False,
+        "num_workers": args.workers,
+        "sensitivity_cache": args.cache
+    }
+
+    try:
+        analyzer = SensitivityAnalyzer(cfg)
+    except ValueError as e:
+        raise SystemExit(e)
+
+    analyzer.initialize()
+    t1 = time.time()
+    try:
+        result = analyzer.analyze(args.abilities)
+    except ValueError as e:
+        raise SystemExit(e)
+    finally:
+        analyzer.close()
+
+    print("Base DPT: {}".format(result["dpt"]))
+    print("Scored {} variants ({} cached) in {:.2f}s with common random numbers. Off the diagonal is the change in DPT "
+          "from swapping two abilities, and on it the change from removing one.".format(
+              result["scored"] + result["cached"], result["cached"], time.time()-t1))
+    print(format_matrix(result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+def stream(args):
+    """
+    Function to score a stream of rotations read from a file or stdin.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed, use_numpy=False)
+
+    from Optimization import StreamingEvaluator
+
+    cfg = {
+        "seed": args.seed,
+        "num_fights": args.fights,
+        "fight_length": args.ticks,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "num_workers": args.workers,
+        "stream_chunk_size": args.chunk_size,
+        "stream_max_in_flight": args.max_in_flight,
+        "stream_ordered": not args.unordered,
+        "stream_incremental": args.command == "reevaluate"
+    }
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, 'r')
+    output_file = sys.stdout if args.output == "-" else open(args.output, 'w', newline='')
+
+    t1 = time.time()
+    evaluator = StreamingEvaluator(cfg)
+    try:
+        evaluator.run(input_file, output_file, args.format)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+    print("Scored {} rotations ({} errors) in {:.2f}s".format(evaluator.num_written, evaluator.num_errors,
+                                                             time.time()-t1), file=sys.stderr)
+    if args.command == "reevaluate":
+        print("Rescored {} stale rotations".format(evaluator.num_rescored), file=sys.stderr)
+
+
+def serve(args):
+    """
+    Function to run the rotation scoring service until it is interrupted.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed, use_numpy=False)
+
+    from Optimization.ScoringService import ScoringService
+
+    cfg = {
+        "seed": args.seed,
+        "num_fights": args.fights,
+        "fight_length": args.ticks,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "num_workers": args.workers,
+        "service_address": args.address,
+        "service_batch_size": args.batch_size,
+        "service_batch_wait": args.batch_wait_ms / 1000,
+        "service_verbose": args.verbose
+    }
+
+    service = ScoringService(cfg)
+    service.initialize()
+    service.serve_forever()
+
+
+def score(args):
+    """
+    Function to score a rotation with a running service, or print its metrics.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    import json
+    from Optimization.ScoringService import ScoringClient
+
+    client = ScoringClient(args.address)
+    try:
+        if args.metrics:
+            print(json.dumps(client.metrics(), indent=2))
+        else:
+            print(json.dumps(client.score(args.abilities)))
+    except (ValueError, OSError) as e:
+        raise SystemExit(e)
+
+
+def sweep(args):
+    """
+    Function to run an optimization for every cell of a scenario grid.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed)
+
+    import json
+    from Optimization import SweepRunner
+
+    with open(args.grid, 'r') as f:
+        grid = json.load(f)
+
+    cfg = {
+        "seed": args.seed,
+        "stdev": 6.0,
+        "returns_per_update": 300,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "num_workers": args.workers,
+        "sweep_grid": grid,
+        "sweep_epochs": args.epochs,
+        "sweep_checkpoint": args.checkpoint,
+        "sweep_output": args.output,
+        "evaluation_store": args.store
+    }
+
+    runner = SweepRunner(cfg)
+    runner.run()
+    print(runner.format_table())
+
+
+def replicate(args):
+    """
+    Function to compare optimizer configurations with successive halving over seeded replications.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    seed_everything(args.seed)
+
+    import json
+    from Optimization import ReplicationRunner
+
+    with open(args.grid, 'r') as f:
+        grid = json.load(f)
+
+    cfg = {
+        "seed": args.seed,
+        "stdev": 6.0,
+        "returns_per_update": 300,
+        "ability_folder": args.folder,
+        "variance_reduction": args.variance_reduction,
+        "objective": args.objective,
+        "enemy_hp": args.enemy_hp,
+        "num_workers": args.workers,
+        "replication_grid": grid,
+        "replication_count": args.replications,
+        "replication_min_ticks": args.min_ticks,
+        "replication_max_ticks": args.max_ticks,
+        "replication_eta": args.eta,
+        "replication_eval_fights": args.eval_fights,
+        "replication_checkpoint": args.checkpoint,
+        "replication_output": args.output
+    }
+
+    try:
+        runner = ReplicationRunner(cfg)
+    except ValueError as e:
+        raise SystemExit(e)
+
+    runner.run()
+    print(runner.format_report())
+
+
+def top(args):
+    """
+    Function to list the best rotations in an evaluation store.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    import os
+    from Optimization.EvaluationStore import EvaluationStore
+    from Environment.Abilities import AbilityBundle
+
+    if not os.path.exists(args.store):
+        raise SystemExit("No evaluation store at {}".format(args.store))
+
+    # Unless asked for everything, only show results measured with the current ability data.
+    ability_hash = None if args.all else AbilityBundle.get_data_hash(args.folder)
+
+    store = EvaluationStore(args.store)
+    try:
+        results = store.top(args.k, ability_hash)
+        print("{} stored results".format(store.count()))
+    finally:
+        store.close()
+
+    for rank, result in enumerate(results):
+        quantiles = "unknown"
+        if result["quantiles"] is not None:
+            quantiles = "/".join("{:.3f}".format(value) for value in result["quantiles"])
+
+        print("{:>3}. {:.3f} +/- {:.3f} DPT over {} fights (p10/p50/p90 {}) in {}".format(
+            rank + 1, result["mean"], result["variance"]**0.5, result["samples"], quantiles, result["scenario"]))
+        print("     {}".format(", ".join(result["rotation"])))
+
+
+def golden(args):
+    """
+    Function to check a simulator backend against the golden traces, or re-record them.
+    :param args: Parsed command line arguments.
+    :return: None
+    """
+    import os
+    from Environment import GoldenTrace
+    from Environment.Abilities import AbilityBundle
+
+    path = args.path if args.path is not None else GoldenTrace.get_golden_path(args.folder)
+    if args.record:
+        num_casts, num_ticks = GoldenTrace.record_golden(args.folder, path=path)
+        print("Recorded {} casts and {} ticks to {}".format(num_casts, num_ticks, path))
+        return
+
+    if not os.path.exists(os.path.join(path, "cases.json")):
+        raise SystemExit("No golden traces at {}. Record them with --record.".format(path))
+
+    try:
+        backend = GoldenTrace.load_backend(args.backend, args.folder)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise SystemExit(e)
+
+    info = GoldenTrace.load_golden(path)[0]
+    if info["ability_hash"] != AbilityBundle.get_data_hash(args.folder):
+        print("Warning: the ability data has changed since the goldens were recorded.")
+
+    t1 = time.time()
+    divergences = GoldenTrace.check_backend(backend, path)
+    for divergence in divergences:
+        print(GoldenTrace.format_divergence(divergence))
+
+    print("{} of {} cases match ({:.2f}s)".format(len(info["cases"]) - len(divergences), len(info["cases"]),
+                                                 time.time()-t1))
+    if len(divergences) > 0:
+        raise SystemExit(1)
+
+
+def bench(args):
+    from Optimization import benchmark
+    if args.bar_sizes is not None:
+        benchmark.run_bar_scaling(args.bar_sizes, args.workers)
+    else:
+        benchmark.run_transport_benchmark(args.rotations, args.workers)
+
+
+def compile_abilities(args):
+    from Environment.Abilities import AbilityBundle
+    bundle = AbilityBundle.compile_abilities(args.folder)
+    print("Compiled {} abilities from {} into {}".format(len(bundle["abilities"]) + 1, args.folder,
+                                                        AbilityBundle.get_bundle_path(args.folder)))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Runescape 3 combat simulator and rotation optimizer.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    sub = subparsers.add_parser("optimize", help="Search for the best rotation. This runs until it is killed.")
+    sub.add_argument("--workers", type=int, default=1, help="Number of worker processes to evaluate rotations with.")
+    sub.add_argument("--async", dest="use_async", action="store_true",
+                     help="Use the asyncio optimizer, which adopts new bests without waiting for the whole epoch.")
+    sub.add_argument("--tempering", action="store_true",
+                     help="Use parallel tempering, which runs replicas of the search at a ladder of temperatures.")
+    sub.add_argument("--bar-size", type=int, default=None,
+                     help="Number of slots on the action bar. With fewer slots than abilities, the best subset and order "
+                          "are searched for together.")
+    sub.add_argument("--conditional", action="store_true",
+                     help="Also search over conditions on each ability, like only using it while the target is stunned.")
+    sub.add_argument("--es", action="store_true",
+                     help="Follow an estimated gradient with an evolution strategy instead of the genetic algorithm. "
+                          "Can't be combined with --conditional.")
+    sub.add_argument("--metrics", default=None, help="Path of a JSON lines file to write metrics to.")
+    sub.add_argument("--memory-profile", type=int, default=None, metavar="N",
+                     help="Trace allocations and sample memory use every N epochs. This slows training down a lot.")
+    sub.add_argument("--checkpoint", default=None, help="Path to write checkpoints to.")
+    sub.add_argument("--warm-start", default=None, help="Results file to start from the best rotations of.")
+    sub.add_argument("--warm-start-count", type=int, default=10, help="Number of rotations to warm start from.")
+    sub.add_argument("--store", default=None,
+                     help="SQLite evaluation store to reuse results from previous runs from, and save new ones to.")
+    sub.add_argument("--time-limit", type=float, default=None, help="Stop after this many seconds.")
+    sub.add_argument("--max-ticks", type=int, default=None, help="Stop after simulating this many ticks.")
+    sub.add_argument("--target-dpt", type=float, default=None, help="Stop as soon as a rotation reaches this DPT.")
+    sub.set_defaults(func=optimize)
+
+    sub = subparsers.add_parser("evaluate", help="Score one rotation, given as ability names in priority order.")
+    sub.add_argument("abilities", nargs="+",
+                     help="Ability names, e.g. \"Snap Shot\" \"Needle Strike\". A name can end with a condition, like "
+                          "\"Snap Shot if stunned\".")
+    sub.add_argument("--fights", type=int, default=10, help="Number of fights to average over.")
+    sub.add_argument("--ticks", type=int, default=1000//2, help="Length of each fight in ticks.")
+    sub.add_argument("--trace", default=None,
+                     help="Record every cast to a .npy file, or to a folder with one file per column.")
+    sub.add_argument("--trace-sample-rate", type=int, default=1, help="Only record every Nth cast.")
+    sub.add_argument("--trace-capacity", type=int, default=65536, help="Maximum number of casts to keep in the trace.")
+    sub.set_defaults(func=evaluate)
+
+    sub = subparsers.add_parser("sensitivity", help="Measure how much every swap and removal changes a rotation's DPT.")
+    sub.add_argument("abilities", nargs="+", help="Ability names of the rotation, in priority order.")
+    sub.add_argument("--fights", type=int, default=50, help="Number of fights to score each variant with.")
+    sub.add_argument("--ticks", type=int, default=1000//2, help="Length of each fight in ticks.")
+    sub.add_argument("--workers", type=int, default=1, help="Number of worker processes to score variants with.")
+    sub.add_argument("--cache", default=None, help="JSON file to cache scores in, so repeated analyses are incremental.")
+    sub.add_argument("--output", default=None, help="JSON file to write the sensitivity matrix to.")
+    sub.set_defaults(func=sensitivity)
+
+    stream_parser = subparsers.add_parser("stream", help="Score every rotation in a JSON lines file.")
+    stream_parser.add_argument("input", help="JSON lines file to read rotations from, or - for stdin.")
+    reevaluate_parser = subparsers.add_parser("reevaluate", help="Rescore stale results after an ability data change.")
+    reevaluate_parser.add_argument("input", help="JSON lines results file written by stream or reevaluate.")
+
+    for sub in (stream_parser, reevaluate_parser):
+        sub.add_argument("--output", default="-", help="File to write results to, or - for stdout.")
+        sub.add_argument("--workers", type=int, default=None, help="Number of worker processes. Defaults to one per core.")
+        sub.add_argument("--chunk-size", type=int, default=256, help="Number of rotations sent to a worker at once.")
+        sub.add_argument("--max-in-flight", type=int, default=None,
+                         help="Maximum number of chunks being evaluated or waiting to be written. Defaults to 2 per worker.")
+        sub.add_argument("--unordered", action="store_true", help="Write results as they finish instead of in order.")
+        sub.add_argument("--fights", type=int, default=10, help="Number of fights to average over.")
+        sub.add_argument("--ticks", type=int, default=1000//2, help="Length of each fight in ticks.")
+        sub.set_defaults(func=stream)
+
+    # Incremental results carry cast counts and hashes, which only fit in JSON lines.
+    stream_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl", help="Output format.")
+    reevaluate_parser.set_defaults(format="jsonl")
+
+    sub = subparsers.add_parser("serve", help="Run a local service which scores rotations on request.")
+    sub.add_argument("--address", default="127.0.0.1:8765",
+                     help="Address to listen on, either host:port or unix:/path/to/socket.")
+    sub.add_argument("--workers", type=int, default=1, help="Number of worker processes to score batches with.")
+    sub.add_argument("--batch-size", type=int, default=64, help="Maximum number of rotations scored in one batch.")
+    sub.add_argument("--batch-wait-ms", type=float, default=5,
+                     help="Milliseconds to wait after the first rotation of a batch for more to arrive.")
+    sub.add_argument("--fights", type=int, default=10, help="Number of fights to average over.")
+    sub.add_argument("--ticks", type=int, default=1000//2, help="Length of each fight in ticks.")
+    sub.add_argument("--verbose", action="store_true", help="Log every request.")
+    sub.set_defaults(func=serve)
+
+    sub = subparsers.add_parser("score", help="Score a rotation with a running service.")
+    sub.add_argument("abilities", nargs="*", help="Ability names, e.g. \"Snap Shot\" \"Needle Strike\".")
+    sub.add_argument("--address", default="127.0.0.1:8765", help="Address of the service.")
+    sub.add_argument("--metrics", action="store_true", help="Print the service's metrics instead.")
+    sub.set_defaults(func=score)
+
+    sub = subparsers.add_parser("sweep", help="Find the best rotation for every cell of a scenario grid.")
+    sub.add_argument("grid", help="JSON file describing the grid, e.g. resources/sweeps/example.json.")
+    sub.add_argument("--epochs", type=int, default=10, help="Number of optimizer epochs to run for each cell.")
+    sub.add_argument("--workers", type=int, default=None, help="Number of worker processes. Defaults to one per core.")
+    sub.add_argument("--checkpoint", default=None, help="JSON lines file to record completed cells in, and resume from.")
+    sub.add_argument("--output", default=None, help="CSV file to write the consolidated results table to.")
+    sub.add_argument("--store", default=None, help="SQLite evaluation store shared by every cell.")
+    sub.set_defaults(func=sweep)
+
+    sub = subparsers.add_parser("replicate", help="Compare optimizer configurations over many seeded runs.")
+    sub.add_argument("grid", help="JSON file describing the configurations, e.g. resources/replications/example.json.")
+    sub.add_argument("--replications", type=int, default=5, help="Number of seeded runs of each configuration.")
+    sub.add_argument("--min-ticks", type=int, default=2000000,
+                     help="Ticks each run simulates in the first round. An epoch the budget cuts short is thrown away, "
+                          "so this must cover at least one whole epoch (about 1.65M ticks at the default 300 returns "
+                          "per update). With less, every configuration just reports its starting rotation.")
+    sub.add_argument("--max-ticks", type=int, default=18000000, help="Most ticks any run simulates.")
+    sub.add_argument("--eta", type=int, default=3,
+                     help="Keep the best 1/eta configurations after each round, and multiply the budget by eta.")
+    sub.add_argument("--eval-fights", type=int, default=100,
+                     help="Number of fresh fights the best rotation of every run is rescored with.")
+    sub.add_argument("--workers", type=int, default=None, help="Number of worker processes. Defaults to one per core.")
+    sub.add_argument("--checkpoint", default=None, help="JSON lines file to record finished runs in, and resume from.")
+    sub.add_argument("--output", default=None, help="CSV file to write the DPT-vs-budget curves to.")
+    sub.set_defaults(func=replicate)
+
+    sub = subparsers.add_parser("top", help="List the best rotations in an evaluation store.")
+    sub.add_argument("store", help="Path of the evaluation store.")
+    sub.add_argument("--k", type=int, default=10, help="Number of rotations to list.")
+    sub.add_argument("--all", action="store_true",
+                     help="Include results measured with old ability data, or data from any folder.")
+    sub.set_defaults(func=top)
+
+    sub = subparsers.add_parser("golden", help="Check a simulator backend against the golden traces.")
+    sub.add_argument("--backend", default="Environment.GoldenTrace:SimulatorBackend",
+                     help="Backend to check, as module:Class. The class is constructed with the ability folder.")
+    sub.add_argument("--path", default=None, help="Folder of golden traces. Defaults to resources/golden/<folder>.")
+    sub.add_argument("--record", action="store_true",
+                     help="Re-record the goldens with the reference simulator instead of checking anything.")
+    sub.set_defaults(func=golden)
+
+    sub = subparsers.add_parser("bench", help="Run the evaluation transport microbenchmark.")
+    sub.add_argument("--rotations", type=int, default=3000, help="Number of rotations in the benchmark population.")
+    sub.add_argument("--workers", type=int, default=None, help="Number of worker processes. Defaults to one per core.")
+    sub.add_argument("--bar-sizes", type=int, nargs="+", default=None,
+                     help="Report how the bar search scales with these bar sizes instead.")
+    sub.set_defaults(func=bench)
+
+    sub = subparsers.add_parser("compile-abilities", help="Compile an ability folder into a bundle.")
+    sub.set_defaults(func=compile_abilities)
+
+    # Options shared by several commands.
+    for name, sub in subparsers.choices.items():
+        sub.add_argument("--seed", type=int, default=GLOBAL_RNG_SEED, help="Seed for every RNG.")
+        if name not in ("bench", "sweep", "score"):
+            sub.add_argument("--folder", default="ranged", help="Ability folder to load abilities from.")
+        if name in ("optimize", "evaluate", "sensitivity", "stream", "reevaluate", "sweep", "replicate", "serve"):
+            sub.add_argument("--variance-reduction", choices=("antithetic", "control_variate"), default=None,
+                             help="Variance reduction to use when averaging fights.")
+            sub.add_argument("--objective", choices=("dpt", "ttk"), default="dpt",
+                             help="Maximize damage per tick, or minimize the time it takes to kill the enemy.")
+            sub.add_argument("--enemy-hp", type=int, default=None,
+                             help="Health of the enemy. Fights end as soon as it dies. Required by the ttk objective.")
+
+    return parser
+
+
+def main(argv=None):
+    """
+    Main function. This parses the command line and runs the requested command. With no command, it optimizes.
+    :param argv: Command line arguments. Defaults to sys.argv.
+    :return: None
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["optimize"])
+
+    args.func(args)
+
 
 if __name__ == "__main__":
     main()
-    test.run_test()
\ No newline at end of file